@@ -10,16 +10,52 @@ from __future__ import print_function
 # Activate automatic float divison for python2.
 from __future__ import division
 import sys
+import json
+import shutil
+import hashlib
 sys.path.append("../lib/")
 sys.path.append("../utils/")
 sys.path.append("../models/")
+# One BLAS thread per process unless the user sets it, so the worker processes
+# of run_jobs do not oversubscribe the cores. It must be set before numpy is
+# imported
+from blas_threads import set_blas_threads
+set_blas_threads(1)
 from inc import*
 from tools import*
 from data_loader import DataLoader
+from data_loader import corpus_words
+from scheduler import run_jobs
+from scheduler import job_seed
+from job_queue import JobQueue
+from job_queue import run_worker
+from job_queue import json_default
+from job_queue import write_json
+from job_queue import read_json
+from param_server import run_param_worker
+from checkpoint import write_checkpoint
+from checkpoint import add_to_archive
+from checkpoint import archive_names
+from checkpoint import write_training_state
 from metrics import*
 from abirnn import ABiRNN
+from abirnn_stack import ABiRNNStack
+from multi_verb_abirnn import MultiVerbABiRNN
+from baselines import MostFrequent
 from collections import OrderedDict
 
+# Parameters of train_and_test which change neither the models nor the scores
+CACHE_FREE_PARAMS = [
+    "training_detail", "n_workers", "stack_size", "queue_dir",
+    "prediction_results", "out_dir", "cache_dir", "word2vec_cache_dir",
+    "restrict_vocab", "embedding_store", "model_archive"
+]
+# Modules whose code decides the trained models and the scores
+CACHE_MODULES = [
+    "inc", "layer", "recurrent_layer", "lstm_layer", "birecurrent_layer",
+    "abirnn", "metrics", "baselines", "checkpoint"
+]
+
 
 def gen_print_info(field_names, values):
     """
@@ -46,6 +82,16 @@ def train_and_save_model():
         #  ("word2vec_path", "../data/sample_word2vec.txt"),
         ("word2vec_path", "../../data/word_vectors/glove.6B.300d.txt"),
         ("oov", "O_O_V"),
+        # Whether word2vec_path is in the binary format of word2vec
+        ("vec_binary", False),
+        # Directory of the binary caches of word vectors. None: no cache
+        ("word2vec_cache_dir", None),
+        # Directory of the word vectors shared by saved models. None: each
+        # model has its own copy
+        ("embedding_store", None),
+        # Only save the vectors of the words in the training data. The other
+        # words are oov for the saved models
+        ("prune_embedding", False),
         ("\nParameters for loading data", ""),
         ("train_path", "../../data/corpus/wsj_framnet/"),
         ("left_win", -1),
@@ -70,9 +116,26 @@ def train_and_save_model():
         ("use_lstm", True),
         ("max_epochs", 100),
         ("minibatch", 50), # ATTENTION TO THIS
+        # Split each minibatch into micro batches to bound memory (None: no split)
+        ("micro_batch", None),
+        # Number of processes sharing each minibatch (1: no parallelism)
+        ("n_workers", 1),
+        # 'sync', 'hogwild' (asynchronous updates without locks), 'thread' or
+        # 'param_server' (n_workers processes train with a parameter server)
+        ("parallel_method", "sync"),
+        # (host, port) of the parameter server for the workers on other
+        # machines (see param_server_worker). None: local workers
+        ("server_address", None),
+        # Secret key shared by the parameter server and its workers, e.g.,
+        # from param_server.new_authkey. It must be set for the workers on
+        # other machines, since the key lets them run code on the server
+        ("server_authkey", None),
         ("lr", 0.1),
         ("training_method", "fixed"),
         ("stable_method", "zero_one_loss"),
+        # Early stopping on the validation part
+        ("valid_freq", 1),
+        ("patience", 10),
         ("norm_func",'softmax'),
         ("show_key_words", False), # ATTENTION TO THIS
         ("key_words_tag", "keywordtag"),
@@ -82,6 +145,8 @@ def train_and_save_model():
         # Save the model
         ("freq", 4),
         ("result_dir", "../../results/nnfl/trained_models/721wsjfn.abirnn.fixed.noupvec.model"),
+        # Continue the training written to result_dir by an interrupted run
+        ("resume", False),
         ("vocab_path", "../../results/nnfl/trained_models/721wsjfn.abirnn.fixed.noupvec.model/vocab")
     ])
 
@@ -96,7 +161,8 @@ def train_and_save_model():
     else:
         # Get vocabulary and word vectors
         vocab, invocab, word2vec = load_word_vectors(
-            p["word2vec_path"], add_oov=True, oov=p["oov"]
+            p["word2vec_path"], add_oov=True, oov=p["oov"],
+            cache_dir=p["word2vec_cache_dir"], binary=p["vec_binary"]
         )
 
     # Write the vocab to file
@@ -109,7 +175,7 @@ def train_and_save_model():
         use_verb=p["use_verb"], lower=p["lower"], use_padding=p["use_padding"],
         show_key_words=p["show_key_words"], key_words_tag=p["key_words_tag"]
     )
-    train, _, _ = train_loader.get_data(
+    train, _, validation = train_loader.get_data(
         p["train_part"], p["test_part"], p["validation_part"],
         sent_num_threshold=0,
         frame_threshold=p["minimum_frame"], 
@@ -125,7 +191,7 @@ def train_and_save_model():
         word2vec=word2vec, n_h=p["n_h"],
         up_wordvec=p["up_wordvec"], use_bias=p["use_bias"],
         act_func=p["act_func"], use_lstm=p["use_lstm"],
-        norm_func=p["norm_func"]
+        norm_func=p["norm_func"], embedding_store=p["embedding_store"]
     )
     epoch = nn.minibatch_train(
         lr=p["lr"],
@@ -137,8 +203,27 @@ def train_and_save_model():
         stable_method=p["stable_method"],
         is_write_to_file=True,
         target_dir=p["result_dir"],
-        freq=p["freq"]
+        freq=p["freq"],
+        valid_x=validation[train_file][0],
+        valid_label_y=validation[train_file][1],
+        valid_split_pos=validation[train_file][2],
+        valid_freq=p["valid_freq"],
+        patience=p["patience"],
+        micro_batch=p["micro_batch"],
+        n_workers=p["n_workers"],
+        parallel_method=p["parallel_method"],
+        server_address=p["server_address"],
+        server_authkey=p["server_authkey"],
+        resume=p["resume"]
     )
+    if p["prune_embedding"]:
+        nn.write_to_files(p["result_dir"], prune_embedding=True)
+        # The training state of the full model (e.g., its best snapshot) does
+        # not fit the pruned one, so only the end of the training is kept
+        state = {"epoch": epoch, "finished": True}
+        if hasattr(nn, "best_epoch"):
+            state["best_epoch"] = nn.best_epoch
+        write_training_state(p["result_dir"], state)
 
 
 def load_and_test():
@@ -230,12 +315,356 @@ def load_and_test():
     print(gen_print_info(field_names, scores_overall / len(verbs)))
 
 
-def train_and_test():
-    p = OrderedDict([
+def build_verb_model(verb, context, copy_word2vec=True):
+    """
+    Return the initialized ABiRNN model of verb on its training data
+    verb: str
+    context: dict
+        The parameters, data and word vectors of train_and_test
+    copy_word2vec: bool
+        Whether the model gets its own copy of the word vectors when they are
+        updated. ABiRNNStack does not need it
+    """
+
+    p = context["p"]
+    train = context["train"]
+    # Updating word vectors only happens for one verb. So each verb starts from
+    # the loaded word vectors
+    word2vec = context["word2vec"]
+    if p["up_wordvec"] and copy_word2vec:
+        word2vec = np.array(word2vec, copy=True)
+
+    # Build ABiRNN model for each verb
+    rnn = ABiRNN()
+    rnn.init(
+        x=train[verb][0], label_y=train[verb][1],
+        word2vec=word2vec, n_h=p["n_h"],
+        up_wordvec=p["up_wordvec"], use_bias=p["use_bias"],
+        act_func=p["act_func"], use_lstm=p["use_lstm"],
+        norm_func=p["norm_func"], pretrained_dir=p["pretrained_dir"],
+        embedding_store=p["embedding_store"]
+    )
+    return rnn
+
+
+def hash_model_files(hasher, model_path):
+    """
+    Update hasher with the files of the model in model_path, which is a
+    directory written by write_to_files or a checkpoint. A model in an archive
+    is hashed by the whole archive file
+    """
+
+    model_path = os.path.normpath(model_path)
+    if os.path.isdir(model_path):
+        for (dir_path, dir_names, file_names) in os.walk(model_path):
+            dir_names.sort()
+            for name in sorted(file_names):
+                path = os.path.join(dir_path, name)
+                hasher.update(os.path.relpath(path, model_path).encode("utf-8"))
+                hash_file(hasher, path)
+        return
+    model_file = model_path
+    while model_file and not os.path.isfile(model_file):
+        model_file = os.path.dirname(model_file)
+    if not model_file:
+        logging.error("No model in %s" % model_path)
+        raise Exception
+    hash_file(hasher, model_file)
+
+
+def hash_file(hasher, path):
+    fh = open(path, "rb")
+    while True:
+        block = fh.read(1 << 20)
+        if not block:
+            break
+        hasher.update(block)
+    fh.close()
+
+
+def verb_cache_key(verb, context):
+    """
+    Return the key of verb in the training cache. It is the hash of everything
+    deciding the model and the scores of verb: the train, test and validation
+    data of verb with the vectors of their words, the parameters except
+    CACHE_FREE_PARAMS, the files of the model in p["pretrained_dir"] and the
+    code of CACHE_MODULES. The random seed is not part of it, so a cached
+    model keeps the random init of its first run.
+    verb: str
+    context: dict
+        The parameters, data and word vectors of train_and_test
+    """
+
+    p = context["p"]
+    word2vec = context["word2vec"]
+    hasher = hashlib.sha1()
+    config = [(key, value) for key, value in p.items()
+              if not key.startswith("\n") and key not in CACHE_FREE_PARAMS]
+    hasher.update(json.dumps(config, default=json_default).encode("utf-8"))
+    for module_name in CACHE_MODULES:
+        module_file = open(sys.modules[module_name].__file__, "rb")
+        hasher.update(module_file.read())
+        module_file.close()
+    if p.get("pretrained_dir") is not None:
+        # The pretrained model may be retrained into the same directory
+        hash_model_files(hasher, p["pretrained_dir"])
+
+    for data in [context["train"], context["test"], context["validation"]]:
+        for row in data[verb][0]:
+            row = np.asarray(row, dtype=np.int64)
+            hasher.update(np.int64(len(row)).tobytes())
+            hasher.update(row.tobytes())
+            hasher.update(np.ascontiguousarray(word2vec[row]).tobytes())
+        hasher.update(json.dumps([str(label) for label in data[verb][1]]).encode("utf-8"))
+        hasher.update(np.asarray(data[verb][2], dtype=np.int64).tobytes())
+        if p["show_key_words"]:
+            hasher.update(json.dumps(data[verb][3], default=json_default).encode("utf-8"))
+    return "%s.%s" % (verb, hasher.hexdigest())
+
+
+def train_and_test_verb(verb, context):
+    """
+    Train and test the model of one verb. This is the job of train_and_test
+    run by the scheduler. If p["cache_dir"] is given, the model and the
+    results of a verb whose key (see verb_cache_key) is in the cache are
+    reused instead of training. If p["skip_single_label"] is True, a verb with
+    one label in its training data is not trained, since the most frequent
+    label always gives the prediction (see constant_predictions).
+    verb: str
+    context: dict
+        The parameters, data and word vectors of train_and_test
+    Return
+    -----
+    scores: list, the values of the fields of train_and_test
+    pred_lines: list of str, the prediction results on test data
+    """
+
+    p = context["p"]
+    cache_dir = None
+    if p.get("cache_dir") is not None:
+        cache_dir = "%s/%s" % (p["cache_dir"], verb_cache_key(verb, context))
+        if os.path.exists("%s/result.json" % cache_dir):
+            return load_cached_verb(verb, context, cache_dir)
+
+    rnn = None
+    if p.get("skip_single_label") and len(set(context["train"][verb][1])) == 1:
+        (epoch, predictions) = constant_predictions(verb, context)
+    else:
+        rnn = build_verb_model(verb, context)
+        epoch = rnn.minibatch_train(
+            lr=p["lr"],
+            minibatch=p["minibatch"],
+            max_epochs=p["max_epochs"],
+            split_pos=context["train"][verb][2],
+            verbose=p["training_detail"],
+            training_method=p["training_method"],
+            stable_method=p["stable_method"]
+        )
+        predictions = verb_predictions(verb, context, rnn)
+        if context.get("model_dir") is not None:
+            write_verb_model(rnn, context["model_dir"], p)
+    (scores, pred_lines) = test_verb_model(verb, context, rnn, epoch, predictions)
+    if cache_dir is not None:
+        cache_verb(cache_dir, rnn, scores, pred_lines, predictions[0], p)
+    return (scores, pred_lines)
+
+
+def constant_predictions(verb, context):
+    """
+    Return the epoch (0) and the predictions (see test_verb_model) of a verb
+    without training. Each instance gets the most frequent label of the
+    training data, and the words of a sentence get the same attention.
+    """
+
+    most_freq = MostFrequent(context["train"][verb][1])
+    predictions = []
+    for data in [context["test"], context["validation"]]:
+        x = data[verb][0]
+        predictions.append(np.array(most_freq.select(len(x))))
+        predictions.append([np.ones(len(row)) / len(row) for row in x])
+    return (0, (predictions[0], predictions[1], predictions[2], predictions[3]))
+
+
+def verb_predictions(verb, context, rnn):
+    """
+    Return the predictions (see test_verb_model) of the trained model of verb
+    """
+
+    test = context["test"]
+    validation = context["validation"]
+    # Run trained model on test and validation data
+    y_pred = rnn.predict(test[verb][0], split_pos=test[verb][2])
+    attention_matrix = rnn.attention_matrix
+    valid_pred = rnn.predict(
+        validation[verb][0], split_pos=validation[verb][2]
+    )
+    valid_attention_matrix = rnn.attention_matrix
+    return (y_pred, attention_matrix, valid_pred, valid_attention_matrix)
+
+
+def write_verb_model(rnn, target, p):
+    """
+    Write the model of a verb to target, as one checkpoint file if
+    p["checkpoint"] is set
+    """
+
+    if p.get("checkpoint"):
+        write_checkpoint(rnn, target, p["prune_embedding"])
+    else:
+        rnn.write_to_files(target, p["prune_embedding"])
+
+
+def cache_verb(cache_dir, rnn, scores, pred_lines, y_pred, p):
+    """
+    Store the model (None for no model, written by write_verb_model) and the
+    results of a verb in cache_dir. The entry is written to a temporary directory which is then
+    renamed to cache_dir, so the workers of the scheduler can share the cache.
+    """
+
+    tmp_dir = "%s.%s.tmp" % (cache_dir, os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    if rnn is not None:
+        write_verb_model(rnn, "%s/model" % tmp_dir, p)
+    write_json("%s/result.json" % tmp_dir,
+               {"scores": scores, "pred_lines": pred_lines, "y_pred": y_pred})
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # Cached by another worker
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_cached_verb(verb, context, cache_dir):
+    """
+    Return the results of verb stored in cache_dir by cache_verb. The outputs
+    of test_verb_model are written again, and the cached model is copied to
+    context["model_dir"] if it is given.
+    """
+
+    logging.info("Reuse the results of %s in %s" % (verb, cache_dir))
+    result = read_json("%s/result.json" % cache_dir)
+    write_verb_output(context["p"], verb, context["test"][verb][1], result["y_pred"])
+    model_dir = context.get("model_dir")
+    if model_dir is not None and os.path.isdir("%s/model" % cache_dir):
+        if os.path.exists(model_dir):
+            shutil.rmtree(model_dir)
+        shutil.copytree("%s/model" % cache_dir, model_dir)
+    elif model_dir is not None and os.path.isfile("%s/model" % cache_dir):
+        shutil.copy("%s/model" % cache_dir, model_dir)
+    return (result["scores"], result["pred_lines"])
+
+
+def write_verb_output(p, verb, instance_ids, y_pred):
+    """
+    Write the predictions of verb to p["out_dir"]/verb
+    """
+
+    out_file = "%s/%s" % (p["out_dir"], verb)
+    out_fh = open(out_file, "w")
+    for instance_id, sense_tag in zip(instance_ids, y_pred):
+        print("%s %s %s" % (verb, instance_id, sense_tag), file=out_fh)
+    out_fh.close()
+
+
+def test_verb_model(verb, context, rnn, epoch, predictions=None):
+    """
+    Test the trained model of verb
+    verb: str
+    context: dict
+        The parameters, data and word vectors of train_and_test
+    rnn: ABiRNN, the trained model. It is not used if predictions are given
+    epoch: int, the epoch number of the training
+    predictions: tuple
+        (y_pred, attention_matrix, valid_pred, valid_attention_matrix) on the
+        test and validation data if they are computed elsewhere, e.g., by
+        ABiRNNStack.predict. None means they are computed by rnn
+    Return
+    -----
+    scores: list, the values of the fields of train_and_test
+    pred_lines: list of str, the prediction results on test data
+    """
+
+    p = context["p"]
+    train = context["train"]
+    test = context["test"]
+    validation = context["validation"]
+
+    if predictions is None:
+        predictions = verb_predictions(verb, context, rnn)
+    (y_pred, attention_matrix, valid_pred, valid_attention_matrix) = predictions
+
+    test_p, test_r, test_f = micro_average_score(
+        y_true=test[verb][1], y_pred=y_pred
+    )
+
+    # Output
+    write_verb_output(p, verb, test[verb][1], y_pred)
+
+    valid_p, valid_r, valid_f = micro_average_score(
+        y_true=validation[verb][1], y_pred=valid_pred
+    )
+
+    scores = [
+        test_p, test_r, test_f,
+        len(train[verb][1]),
+        len(test[verb][1]),
+        len(set(test[verb][1])),
+        epoch,
+        len(validation[verb][1]),
+        valid_f
+    ]
+    if p["show_key_words"]:
+        map_score = mean_average_precision(
+            y_trues_array=test[verb][3], y_scores_array=attention_matrix
+        )
+        valid_map_score = mean_average_precision(
+            y_trues_array=validation[verb][3],
+            y_scores_array=valid_attention_matrix
+        )
+        scores.append(map_score)
+        scores.append(valid_map_score)
+
+    # Prediction results
+    sents = indexs2sents(test[verb][0], context["invocab"])
+    pred_lines = ["verb: %s\tf-score:%f" % (verb, test_f)]
+    for i in range(0, len(test[verb][1])):
+        is_true = True if test[verb][1][i] == y_pred[i] else False
+        out_line = "%s\tpredict:%s\ttrue:%s\t" % (is_true, y_pred[i], test[verb][1][i])
+        out_line += " ".join(sents[i])
+        pred_lines.append(out_line)
+    return (scores, pred_lines)
+
+
+def train_and_test_params():
+    """
+    Return the parameters of train_and_test
+    """
+
+    return OrderedDict([
         ("\nParameters for word vectors", ""),
         #("word2vec_path", "../data/sample_word2vec.txt"),
         ("word2vec_path", "../../data/word_vectors/glove.6B.300d.txt" ),
         ("oov", "O_O_V"),
+        # Whether word2vec_path is in the binary format of word2vec
+        ("vec_binary", False),
+        # Directory of the binary caches of word vectors. None: no cache
+        ("word2vec_cache_dir", None),
+        # Directory of the word vectors shared by saved models. None: each
+        # model has its own copy
+        ("embedding_store", None),
+        # Only save the vectors of the words in the training data. The other
+        # words are oov for the saved models
+        ("prune_embedding", False),
+        # Write each model as one checkpoint file (see checkpoint.py) instead
+        # of a directory
+        ("checkpoint", False),
+        # Archive file (see checkpoint.py) to which collect_queue_results
+        # appends the models of the verbs. None: no archive
+        ("model_archive", None),
+        # Only load the vectors of the words in the train and test data
+        ("restrict_vocab", False),
         ("\nParameters for loading data", ""),
         ("train_path", "../../data/corpus/semeval_mic_test_and_pdev_train/train"),
         ("test_path", "../../data/corpus/semeval_mic_test_and_pdev_train/test/"),
@@ -268,28 +697,74 @@ def train_and_test():
         ("training_method", "fixed"),
         ("stable_method", "zero_one_loss"),
         ("norm_func",'softmax'),
+        # Do not train the verbs with one label in the training data. They
+        # get the label without a model, with epoch 0 and the same attention
+        # on every word in the results
+        ("skip_single_label", False),
+        # Model directory (e.g., written by train_and_save_model) whose
+        # recurrent layer each verb starts from. None: random init
+        ("pretrained_dir", None),
         ("random_vectors", False), # ATTENTION TO THIS
         ("show_key_words",False), # ATTENTION TO THIS
         ("key_words_tag", "keywordtag"),
         ("\nOther parameters", ""),
         ("training_detail", False), # ATTENTION TO THIS
+        # Number of processes training the verbs in parallel
+        ("n_workers", 1),
+        # Number of verbs trained together by train_and_test_stacked
+        ("stack_size", 16),
+        # Directory of the trained models and the results of verbs, which are
+        # reused while the data, the parameters and the code are unchanged.
+        # None: no cache
+        ("cache_dir", None),
+        # Shared directory of the job queue for training on many machines
+        ("queue_dir", "../../results/nnfl/abinn/queue"),
         ("prediction_results", "../../results/nnfl/abinn/65newupvecsemtest"),
         # For SemEval-2007 task 06
         ("out_dir", "../../results/nnfl/abinn/null_dir")
     ])
-    # Get train data
-    os.system("mkdir -p %s" % p["out_dir"])
 
-    # Get vocabulary and word vectors
-    vocab, invocab, word2vec = load_word_vectors(
-        p["word2vec_path"], add_oov=True,oov=p["oov"]
+
+def load_train_and_test_vectors(p):
+    """
+    Load the word vectors of train_and_test. If p["restrict_vocab"] is True,
+    only the vectors of the words in the train and test data are loaded
+    p: dict, the parameters of train_and_test
+    Return
+    -----
+    vocab, invocab, word2vec: see load_word_vectors
+    """
+
+    words = None
+    if p["restrict_vocab"]:
+        words = corpus_words(
+            [p["train_path"], p["test_path"]], lower=p["lower"],
+            show_key_words=p["show_key_words"], key_words_tag=p["key_words_tag"]
+        )
+    return load_word_vectors(
+        p["word2vec_path"], add_oov=True, oov=p["oov"],
+        cache_dir=p["word2vec_cache_dir"], words=words, binary=p["vec_binary"]
     )
 
+
+def load_train_and_test_data(p, vocab, file_names=None):
+    """
+    Load the train and test data of train_and_test. The test data is also
+    used as validation data
+    p: dict, the parameters of train_and_test
+    vocab: dict, word to word index
+    file_names: list of str, the verbs to load. None means all verbs
+    Return
+    -----
+    train, test, validation: dict, see DataLoader.get_data
+    """
+
     train_loader = DataLoader(
         data_path=p["train_path"], vocab=vocab, oov=p["oov"],
         left_win=p["left_win"], right_win=p["right_win"],
         use_verb=p["use_verb"], lower=p["lower"], use_padding=p["use_padding"],
-        show_key_words=p["show_key_words"], key_words_tag=p["key_words_tag"]
+        show_key_words=p["show_key_words"], key_words_tag=p["key_words_tag"],
+        file_names=file_names
     )
     train, _, validation = train_loader.get_data(
         1.0, 0.0, 0.0,
@@ -303,7 +778,8 @@ def train_and_test():
         data_path=p["test_path"], vocab=vocab, oov=p["oov"],
         left_win=p["left_win"], right_win=p["right_win"],
         use_verb=p["use_verb"], lower=p["lower"], use_padding=p["use_padding"],
-        show_key_words=p["show_key_words"], key_words_tag=p["key_words_tag"]
+        show_key_words=p["show_key_words"], key_words_tag=p["key_words_tag"],
+        file_names=file_names
     )
     _, test, _ = test_loader.get_data(
         0.0, 1.0, 0.0,
@@ -312,6 +788,13 @@ def train_and_test():
         verb_index=p["verb_index"]
     )
     validation = test
+    return (train, test, validation)
+
+
+def train_and_test_fields(p):
+    """
+    Return the names of the scores of train_and_test
+    """
 
     field_names = [
         'precision', 'recall', 'f-score',
@@ -325,105 +808,311 @@ def train_and_test():
     if p["show_key_words"]:
         field_names.append("test_map_score")
         field_names.append("valid_map_score")
+    return field_names
+
+
+def report_train_and_test(p, verb_results, n_verbs):
+    """
+    Print the scores of each verb and the average scores over all verbs, and
+    write the prediction results to p["prediction_results"]
+    p: dict, the parameters of train_and_test
+    verb_results: iterable of (verb, (scores, pred_lines)), see
+        train_and_test_verb
+    n_verbs: int, the number of verbs
+    """
 
+    field_names = train_and_test_fields(p)
     # Average statistics over all verbs
     scores_overall = np.zeros(len(field_names), dtype=FLOAT)
     verb_counter = 0
     fh_pr = open(p["prediction_results"], "w")
-    verbs = train.keys()
-    for verb in verbs:
+    for verb, (scores, pred_lines) in verb_results:
         verb_counter += 1
-        # Build TRNN model for each verb
-        rnn = ABiRNN()
-        rnn.init(
-            x=train[verb][0], label_y=train[verb][1],
-            word2vec=word2vec, n_h=p["n_h"],
-            up_wordvec=p["up_wordvec"], use_bias=p["use_bias"],
-            act_func=p["act_func"], use_lstm=p["use_lstm"],
-            norm_func=p["norm_func"]
-        )
+        scores_overall += scores
+        print("current verb:%s, scores are:" % verb)
+        print(gen_print_info(field_names, scores))
+        print("current completeness:%d/%d, average scores over %d verbs are:"
+              % (verb_counter, n_verbs, verb_counter))
+        print(gen_print_info(field_names, scores_overall / verb_counter))
 
-        epoch = rnn.minibatch_train(
+        # Print prediction results
+        for out_line in pred_lines:
+            print(out_line, file=fh_pr)
+
+    # File handles
+    fhs = [fh_pr, sys.stdout]
+    for fh in fhs:
+        print(gen_params_info(p), file=fh)
+        print("End of training and testing, the average "
+              "infomation over %d verbs are:" % n_verbs, file=fh)
+        print(gen_print_info(field_names, scores_overall / n_verbs),
+              file=fh)
+    fh_pr.close()
+
+
+def train_and_test():
+    p = train_and_test_params()
+    # Get train data
+    os.system("mkdir -p %s" % p["out_dir"])
+
+    # Get vocabulary and word vectors
+    vocab, invocab, word2vec = load_train_and_test_vectors(p)
+    train, test, validation = load_train_and_test_data(p, vocab)
+
+    verbs = train.keys()
+    context = {
+        "p": p, "train": train, "test": test, "validation": validation,
+        "word2vec": word2vec, "invocab": invocab
+    }
+    # Verbs are run in parallel processes forked after loading word vectors
+    results = run_jobs(
+        train_and_test_verb, verbs, context, n_workers=p["n_workers"],
+        job_size=lambda verb: len(train[verb][1]), seed=1
+    )
+    report_train_and_test(p, results, len(verbs))
+
+
+def train_and_test_stacked():
+    """
+    The same as train_and_test, but the verbs are trained in stacks of
+    p["stack_size"] models by ABiRNNStack, which keeps the CPU busy with the
+    small models of verbs. Verbs of similar sizes are stacked together.
+    """
+
+    p = train_and_test_params()
+    os.system("mkdir -p %s" % p["out_dir"])
+    vocab, invocab, word2vec = load_train_and_test_vectors(p)
+    train, test, validation = load_train_and_test_data(p, vocab)
+    context = {
+        "p": p, "train": train, "test": test, "validation": validation,
+        "word2vec": word2vec, "invocab": invocab
+    }
+
+    verbs = sorted(train.keys(), key=lambda verb: len(train[verb][1]))
+    verb_results = []
+    for start in range(0, len(verbs), p["stack_size"]):
+        stack_verbs = verbs[start:start + p["stack_size"]]
+        models = []
+        for verb in stack_verbs:
+            # Seeded as in train_and_test, so each verb starts from the same
+            # model
+            np.random.seed(job_seed(1, verb))
+            models.append(build_verb_model(verb, context, copy_word2vec=False))
+        stack = ABiRNNStack(models)
+        epochs = stack.minibatch_train(
             lr=p["lr"],
             minibatch=p["minibatch"],
             max_epochs=p["max_epochs"],
-            split_pos=train[verb][2],
+            split_pos=[train[verb][2] for verb in stack_verbs],
             verbose=p["training_detail"],
             training_method=p["training_method"],
             stable_method=p["stable_method"]
         )
 
-        # Run trained model on test data
-        y_pred = rnn.predict(test[verb][0], split_pos=test[verb][2])
-
-        attention_matrix = rnn.attention_matrix
-        test_p, test_r, test_f = micro_average_score(
-            y_true=test[verb][1], y_pred=y_pred
+        # The test and validation data of all verbs in the stack are predicted
+        # in one batched computation
+        y_preds = stack.predict([test[verb][0] for verb in stack_verbs],
+                                [test[verb][2] for verb in stack_verbs])
+        attention_matrices = stack.attention_matrices
+        valid_preds = stack.predict(
+            [validation[verb][0] for verb in stack_verbs],
+            [validation[verb][2] for verb in stack_verbs]
         )
+        valid_attention_matrices = stack.attention_matrices
+        for k, verb in enumerate(stack_verbs):
+            predictions = (y_preds[k], attention_matrices[k],
+                           valid_preds[k], valid_attention_matrices[k])
+            verb_results.append((verb, test_verb_model(
+                verb, context, stack.models[k], epochs[k], predictions
+            )))
+    report_train_and_test(p, verb_results, len(verbs))
 
-        # Output
-        out_file = "%s/%s" % (p["out_dir"], verb)
-        out_fh = open(out_file, "w")
-        for instance_id, sense_tag in zip(test[verb][1], y_pred):
-            print("%s %s %s" % (verb, instance_id, sense_tag), file=out_fh)
-        out_fh.close()
 
+def train_and_test_multi_verb():
+    """
+    The same as train_and_test, but one MultiVerbABiRNN is trained on the
+    sentences of all verbs, so the encoder is shared and each verb only has
+    its own frames in the output layer.
+    """
 
-        # Run trained model on validation data
-        valid_pred = rnn.predict(
-            validation[verb][0], split_pos=validation[verb][2]
-        )
+    p = train_and_test_params()
+    os.system("mkdir -p %s" % p["out_dir"])
+    vocab, invocab, word2vec = load_train_and_test_vectors(p)
+    train, test, validation = load_train_and_test_data(p, vocab)
+    context = {
+        "p": p, "train": train, "test": test, "validation": validation,
+        "word2vec": word2vec, "invocab": invocab
+    }
+
+    # Sentences of all verbs are mixed so that each minibatch has many verbs
+    verbs = list(train.keys())
+    x = []
+    sent_verbs = []
+    label_y = []
+    split_pos = []
+    for verb in verbs:
+        x += list(train[verb][0])
+        sent_verbs += [verb] * len(train[verb][1])
+        label_y += list(train[verb][1])
+        split_pos += list(train[verb][2])
+    np.random.seed(1)
+    order = np.random.permutation(len(x))
+    all_x = np.empty(len(x), dtype=object)
+    all_x[:] = [x[i] for i in order]
+    sent_verbs = [sent_verbs[i] for i in order]
+    label_y = np.array([label_y[i] for i in order])
+    split_pos = [split_pos[i] for i in order]
+
+    rnn = MultiVerbABiRNN()
+    rnn.init(
+        x=all_x, verbs=sent_verbs, label_y=label_y,
+        word2vec=word2vec, n_h=p["n_h"],
+        up_wordvec=p["up_wordvec"], use_bias=p["use_bias"],
+        act_func=p["act_func"], use_lstm=p["use_lstm"],
+        norm_func=p["norm_func"]
+    )
+    epoch = rnn.minibatch_train(
+        lr=p["lr"],
+        minibatch=p["minibatch"],
+        max_epochs=p["max_epochs"],
+        split_pos=split_pos,
+        verbose=p["training_detail"]
+    )
+
+    verb_results = []
+    for verb in verbs:
+        y_pred = rnn.predict(test[verb][0], [verb] * len(test[verb][0]),
+                             test[verb][2])
+        attention_matrix = rnn.attention_matrix
+        valid_pred = rnn.predict(validation[verb][0],
+                                 [verb] * len(validation[verb][0]),
+                                 validation[verb][2])
         valid_attention_matrix = rnn.attention_matrix
-        valid_p, valid_r, valid_f = micro_average_score(
-            y_true=validation[verb][1], y_pred=valid_pred
+        predictions = (y_pred, attention_matrix, valid_pred, valid_attention_matrix)
+        verb_results.append((verb, test_verb_model(
+            verb, context, rnn, epoch, predictions
+        )))
+    report_train_and_test(p, verb_results, len(verbs))
+
+
+def publish_verb_jobs():
+    """
+    Publish one job for each verb of train_and_test to the job queue in
+    p["queue_dir"]. The jobs are run by queue_worker on any machine sharing the
+    directory, and the results are reported by collect_queue_results.
+    """
+
+    p = train_and_test_params()
+    queue = JobQueue(p["queue_dir"])
+    for verb in sorted(os.listdir(p["train_path"])):
+        queue.publish(verb, p)
+    logging.info("Queue status: %s" % queue.status())
+
+
+def queue_train_and_test_verb(job, context, staging_dir):
+    """
+    The job of queue_worker. The data of the verb of job is loaded and
+    train_and_test_verb is run. The model is saved in staging_dir/model.
+    job: dict, see JobQueue.claim
+    context: dict, word vectors loaded by previous jobs
+    staging_dir: str
+    Return
+    -----
+    dict, the scores and the prediction lines of the verb. It is empty if the
+    verb is filtered out by the parameters
+    """
+
+    p = job["config"]
+    verb = job["verb"]
+    os.system("mkdir -p %s" % p["out_dir"])
+    # Word vectors are loaded once per worker
+    if context.get("word2vec_path") != p["word2vec_path"]:
+        context["vocab"], context["invocab"], context["word2vec"] = load_word_vectors(
+            p["word2vec_path"], add_oov=True,oov=p["oov"],
+            cache_dir=p["word2vec_cache_dir"], binary=p["vec_binary"]
         )
+        context["word2vec_path"] = p["word2vec_path"]
+    train, test, validation = load_train_and_test_data(p, context["vocab"], [verb])
+    if verb not in train:
+        return {}
 
-        scores = [
-            test_p, test_r, test_f,
-            len(train[verb][1]),
-            len(test[verb][1]),
-            len(set(test[verb][1])),
-            epoch,
-            len(validation[verb][1]),
-            valid_f
-        ]
-        if p["show_key_words"]:
-            map_score = mean_average_precision(
-                y_trues_array=test[verb][3], y_scores_array=attention_matrix
-            )
-            valid_map_score = mean_average_precision(
-                y_trues_array=validation[verb][3],
-                y_scores_array=valid_attention_matrix
-            )
-            scores.append(map_score)
-            scores.append(valid_map_score)
-        scores_overall += scores
-        print("current verb:%s, scores are:" % verb)
-        print(gen_print_info(field_names, scores))
-        print("current completeness:%d/%d, average scores over %d verbs are:"
-              % (verb_counter, len(verbs), verb_counter))
-        print(gen_print_info(field_names, scores_overall / verb_counter))
+    verb_context = {
+        "p": p, "train": train, "test": test, "validation": validation,
+        "word2vec": context["word2vec"], "invocab": context["invocab"],
+        "model_dir": "%s/model" % staging_dir
+    }
+    # Seeded as in train_and_test, so the result does not depend on the worker
+    # and the order of the jobs
+    np.random.seed(job_seed(1, verb))
+    (scores, pred_lines) = train_and_test_verb(verb, verb_context)
+    return {"scores": scores, "pred_lines": pred_lines}
 
-        # Print prediction results
-        sents = indexs2sents(test[verb][0], invocab)
-        print("verb: %s\tf-score:%f" % (verb, test_f), file=fh_pr)
-        for i in range(0, len(test[verb][1])):
-            is_true = True if test[verb][1][i] == y_pred[i] else False
-            out_line = "%s\tpredict:%s\ttrue:%s\t" % (is_true, y_pred[i], test[verb][1][i])
-            out_line += " ".join(sents[i])
-            print(out_line, file=fh_pr)
 
-    # File handles
-    fhs = [fh_pr, sys.stdout]
-    for fh in fhs:
-        print(gen_params_info(p), file=fh)
-        print("End of training and testing, the average "
-              "infomation over %d verbs are:" % len(verbs), file=fh)
-        print(gen_print_info(field_names, scores_overall / len(verbs)),
-              file=fh)
-    fh_pr.close()
+def queue_worker():
+    """
+    Run the jobs in the job queue until no job is left. Start as many workers
+    as wanted on each machine.
+    """
+
+    p = train_and_test_params()
+    queue = JobQueue(p["queue_dir"])
+    run_worker(queue, queue_train_and_test_verb, {}, wait=True)
+
+
+def collect_queue_results():
+    """
+    Report the results in the job queue in the same way as train_and_test. The
+    model of each verb is in the directory model of its result directory. If
+    p["model_archive"] is given, the models of the verbs which are not in the
+    archive yet are appended to it with the verbs as the names.
+    """
+
+    p = train_and_test_params()
+    queue = JobQueue(p["queue_dir"])
+    status = queue.status()
+    if status["pending"] != 0 or status["running"] != 0 or status["failed"] != 0:
+        logging.info("The queue is not finished: %s" % status)
+    config_id = queue.job_id("", p)
+    archived = set()
+    if p["model_archive"] is not None and os.path.exists(p["model_archive"]):
+        archived = set(archive_names(p["model_archive"]))
+    verb_results = []
+    for job_id, res in sorted(queue.results().items()):
+        # Only the jobs of current parameters
+        if not job_id.endswith(config_id) or len(res["result"]) == 0:
+            continue
+        verb = res["job"]["verb"]
+        verb_results.append((verb, (res["result"]["scores"], res["result"]["pred_lines"])))
+        model_path = "%s/model" % queue.result_dir(job_id)
+        if (p["model_archive"] is not None and verb not in archived
+                and os.path.exists(model_path)):
+            add_to_archive(p["model_archive"], verb, model_path)
+    report_train_and_test(p, verb_results, len(verb_results))
+
+
+def param_server_worker(server_address, server_authkey):
+    """
+    Run a worker for train_and_save_model with parallel_method 'param_server'
+    on this machine. The server waits for n_workers such workers at
+    server_address, which is the "server_address" parameter of
+    train_and_save_model.
+    server_address: tuple, (host, port)
+    server_authkey: str, the "server_authkey" parameter of train_and_save_model
+    """
+
+    run_param_worker(server_address, server_authkey)
 
 if __name__ == "__main__":
     #train_and_save_model()
     #load_and_test()
     train_and_test()
+    # Train the small models of verbs in stacks
+    #train_and_test_stacked()
+    # Train one model with a shared encoder on all verbs
+    #train_and_test_multi_verb()
+    # Train on many machines through a job queue in a shared directory
+    #publish_verb_jobs()
+    #queue_worker()
+    #collect_queue_results()
+    # Train one model with a parameter server and workers on many machines
+    #param_server_worker(("server_host", 47600), "the server_authkey")
@@ -13,9 +13,15 @@ import sys
 sys.path.append("../lib/")
 sys.path.append("../utils/")
 sys.path.append("../models/")
+# One BLAS thread per process unless the user sets it, so the worker processes
+# of run_jobs do not oversubscribe the cores. It must be set before numpy is
+# imported
+from blas_threads import set_blas_threads
+set_blas_threads(1)
 from inc import*
 from tools import*
 from data_loader import DataLoader
+from scheduler import run_jobs
 from metrics import*
 from fnn import FNN
 from collections import OrderedDict
@@ -38,6 +44,75 @@ def gen_print_info(field_names, values):
     return res
 
 
+def run_fnn_verb(verb, context):
+    """
+    Train and test the model of one verb. This is the job of run_fnn run by
+    the scheduler.
+    verb: str
+    context: dict
+        The parameters, data and word vectors of run_fnn
+    Return
+    -----
+    scores: list, the values of the fields of run_fnn
+    pred_lines: list of str, the prediction results on test data
+    """
+
+    p = context["p"]
+    train = context["train"]
+    test = context["test"]
+    validation = context["validation"]
+    # Updating word vectors only happens for one verb. So each verb starts from
+    # the loaded word vectors
+    word2vec = context["word2vec"]
+    if p["up_wordvec"]:
+        word2vec = np.array(word2vec, copy=True)
+
+    # Build FNN model for each verb
+    fnn = FNN(
+        x=train[verb][0], label_y=train[verb][1],
+        word2vec=word2vec, n_hs=p["n_hs"],
+        up_wordvec=p["up_wordvec"], use_bias=p["use_bias"],
+        act_func=p["act_func"]
+
+    )
+
+    epoch = fnn.minibatch_train(
+        lr=p["lr"],
+        minibatch=p["minibatch"],
+        max_epochs=p["max_epochs"],
+        verbose=p["training_detail"]
+    )
+
+    y_pred = fnn.predict(test[verb][0])
+    precision, recall, f_score = micro_average_f1(
+        y_true=test[verb][1], y_pred=y_pred
+    )
+    valid_pred = fnn.predict(validation[verb][0])
+    _, _, valid_f = micro_average_f1(
+        y_true=validation[verb][1], y_pred=valid_pred
+    )
+
+    scores = [
+        precision, recall, f_score,
+        len(train[verb][1]),
+        len(test[verb][1]),
+        len(set(test[verb][1])),
+        epoch,
+        len(validation[verb][1]),
+        valid_f
+    ]
+
+    # Prediction results
+    sents = indexs2sents(test[verb][0], context["invocab"])
+    pred_lines = ["verb: %s\tf-score:%f" % (verb, f_score)]
+    for i in range(0, len(test[verb][1])):
+        is_true = True if test[verb][1][i] == y_pred[i] else False
+        pred_lines.append("%s\tpredict:%s\ttrue:%s\t%s"
+                          % (is_true, y_pred[i], test[verb][1][i],
+                             " ".join(sents[i])))
+    return (scores, pred_lines)
+
+
 def run_fnn():
     p = OrderedDict([
         ("\nParameters for word vectors", ""),
@@ -70,6 +145,8 @@ def run_fnn():
         ("random_vectors", False), # ATTENTION TO THIS
         ("\nOther parameters", ""),
         ("training_detail", False), # ATTENTION TO THIS
+        # Number of processes training the verbs in parallel
+        ("n_workers", 1),
         ("prediction_results", "../result/attention_results")
     ])
     result_file = "fnn_win%s_lr%s_%s" % (p["left_win"], p["lr"],
@@ -94,10 +171,6 @@ def run_fnn():
         vocab, invocab, word2vec = load_word_vectors(
             p["word2vec_path"], add_oov=True,oov=p["oov"]
         )
-    # Updating word vectors only happens for one verb
-    #   So when one verb is done, word vectors should recover
-    if p["up_wordvec"]:
-        word2vec_bak = np.array(word2vec, copy=True)
 
     # Get data
     train_loader = DataLoader(
@@ -125,45 +198,17 @@ def run_fnn():
     verb_counter = 0
     fh_pr = open(p["prediction_results"], "w")
     verbs = train.keys()
-    for verb in verbs:
+    context = {
+        "p": p, "train": train, "test": test, "validation": validation,
+        "word2vec": word2vec, "invocab": invocab
+    }
+    # Verbs are run in parallel processes forked after loading word vectors
+    results = run_jobs(
+        run_fnn_verb, verbs, context, n_workers=p["n_workers"],
+        job_size=lambda verb: len(train[verb][1]), seed=1
+    )
+    for verb, (scores, pred_lines) in results:
         verb_counter += 1
-        # Recover the word vectors
-        if p["up_wordvec"] and verb_counter != 1:
-            word2vec = np.array(word2vec_bak, copy=True)
-        # Build FNN model for each verb
-        fnn = FNN(
-            x=train[verb][0], label_y=train[verb][1],
-            word2vec=word2vec, n_hs=p["n_hs"],
-            up_wordvec=p["up_wordvec"], use_bias=p["use_bias"],
-            act_func=p["act_func"]
-
-        )
-
-        epoch = fnn.minibatch_train(
-            lr=p["lr"],
-            minibatch=p["minibatch"],
-            max_epochs=p["max_epochs"],
-            verbose=p["training_detail"]
-        )
-
-        y_pred = fnn.predict(test[verb][0])
-        precision, recall, f_score = micro_average_f1(
-            y_true=test[verb][1], y_pred=y_pred
-        )
-        valid_pred = fnn.predict(validation[verb][0])
-        _, _, valid_f = micro_average_f1(
-            y_true=validation[verb][1], y_pred=valid_pred
-        )
-
-        scores = [
-            precision, recall, f_score,
-            len(train[verb][1]),
-            len(test[verb][1]),
-            len(set(test[verb][1])),
-            epoch,
-            len(validation[verb][1]),
-            valid_f
-        ]
         scores_overall += scores
         print("current verb:%s, scores are:" % verb)
         print(gen_print_info(field_names, scores))
@@ -172,13 +217,8 @@ def run_fnn():
         print(gen_print_info(field_names, scores_overall / verb_counter))
 
         # Print prediction results
-        sents = indexs2sents(test[verb][0], invocab)
-        print("verb: %s\tf-score:%f" % (verb, f_score), file=fh_pr)
-        for i in range(0, len(test[verb][1])):
-            is_true = True if test[verb][1][i] == y_pred[i] else False
-            print("%s\tpredict:%s\ttrue:%s\t%s"
-                  % (is_true, y_pred[i], test[verb][1][i],
-                     " ".join(sents[i])), file=fh_pr)
+        for out_line in pred_lines:
+            print(out_line, file=fh_pr)
 
     # File handles
     fhs = [fh_pr, sys.stdout]
@@ -14,9 +14,15 @@ import sys
 sys.path.append("../lib/")
 sys.path.append("../utils/")
 sys.path.append("../models/")
+# One BLAS thread per process unless the user sets it, so the worker processes
+# of run_jobs do not oversubscribe the cores. It must be set before numpy is
+# imported
+from blas_threads import set_blas_threads
+set_blas_threads(1)
 from inc import*
 from tools import*
 from data_loader import DataLoader
+from scheduler import run_jobs
 from metrics import*
 from trnn import TRNN
 from collections import OrderedDict
@@ -74,15 +80,34 @@ def train_and_save_model():
         ("use_lstm", True),
         ("max_epochs", 100),
         ("minibatch", 50), # ATTENTION TO THIS
+        # Split each minibatch into micro batches to bound memory (None: no split)
+        ("micro_batch", None),
+        # Number of processes sharing each minibatch (1: no parallelism)
+        ("n_workers", 1),
+        # 'sync', 'hogwild' (asynchronous updates without locks), 'thread' or
+        # 'param_server' (n_workers processes train with a parameter server)
+        ("parallel_method", "sync"),
+        # (host, port) of the parameter server for the workers on other
+        # machines (see param_server_worker in run_abirnn.py). None: local workers
+        ("server_address", None),
+        # Secret key shared by the parameter server and its workers, e.g.,
+        # from param_server.new_authkey. It must be set for the workers on
+        # other machines, since the key lets them run code on the server
+        ("server_authkey", None),
         ("lr", 0.1),
         ("training_method", "fixed"),
         ("stable_method", "zero_one_loss"),
+        # Early stopping on the validation part
+        ("valid_freq", 1),
+        ("patience", 10),
         ("random_vectors", False), # ATTENTION TO THIS
         ("\nOther parameters", ""),
         ("training_detail", True), # ATTENTION TO THIS
         # Save the model
         ("freq", 4),
         ("result_dir", model_path),
+        # Continue the training written to result_dir by an interrupted run
+        ("resume", False),
         ("vocab_path", "%s/vocab" % (model_path, ))
     ])
     
@@ -109,7 +134,7 @@ def train_and_save_model():
         left_win=p["left_win"], right_win=p["right_win"],
         use_verb=p["use_verb"], lower=p["lower"], use_padding=p["use_padding"]
     )
-    train, _, _ = train_loader.get_data(
+    train, _, validation = train_loader.get_data(
         p["train_part"], p["test_part"], p["validation_part"],
         sent_num_threshold=0,
         frame_threshold=p["minimum_frame"], 
@@ -136,7 +161,18 @@ def train_and_save_model():
         stable_method=p["stable_method"],
         is_write_to_file=True,
         target_dir=p["result_dir"],
-        freq=p["freq"]
+        freq=p["freq"],
+        valid_x=validation[train_file][0],
+        valid_label_y=validation[train_file][1],
+        valid_split_pos=validation[train_file][2],
+        valid_freq=p["valid_freq"],
+        patience=p["patience"],
+        micro_batch=p["micro_batch"],
+        n_workers=p["n_workers"],
+        parallel_method=p["parallel_method"],
+        server_address=p["server_address"],
+        server_authkey=p["server_authkey"],
+        resume=p["resume"]
     )
 
 def load_and_test():
@@ -213,6 +249,85 @@ def load_and_test():
           "infomation over %d verbs are:" % len(verbs))
     print(gen_print_info(field_names, scores_overall / len(verbs)))
 
+def train_and_test_verb(verb, context):
+    """
+    Train and test the model of one verb. This is the job of train_and_test
+    run by the scheduler.
+    verb: str
+    context: dict
+        The parameters, data and word vectors of train_and_test
+    Return
+    -----
+    scores: list, the values of the fields of train_and_test
+    pred_lines: list of str, the prediction results on test data
+    """
+
+    p = context["p"]
+    train = context["train"]
+    test = context["test"]
+    validation = context["validation"]
+    # Updating word vectors only happens for one verb. So each verb starts from
+    # the loaded word vectors
+    word2vec = context["word2vec"]
+    if p["up_wordvec"]:
+        word2vec = np.array(word2vec, copy=True)
+
+    # Build TRNN model for each verb
+    rnn = TRNN()
+    rnn.init(
+        x=train[verb][0], label_y=train[verb][1],
+        word2vec=word2vec, n_h=p["n_h"],
+        up_wordvec=p["up_wordvec"], use_bias=p["use_bias"],
+        act_func=p["act_func"], use_lstm=p["use_lstm"]
+    )
+
+    epoch = rnn.minibatch_train(
+        lr=p["lr"],
+        minibatch=p["minibatch"],
+        max_epochs=p["max_epochs"],
+        split_pos=train[verb][2],
+        verbose=p["training_detail"],
+        training_method=p["training_method"],
+        stable_method=p["stable_method"]
+    )
+
+    y_pred = rnn.predict(test[verb][0], split_pos=test[verb][2])
+    precision, recall, f_score = bcubed_score(
+        y_true=test[verb][1], y_pred=y_pred
+    )
+    # Output
+    out_file = "%s/%s" % (p["out_dir"], verb)
+    out_fh = open(out_file, "w")
+    for instance_id, sense_tag in zip(test[verb][1], y_pred):
+        print("%s %s %s" % (verb, instance_id, sense_tag), file=out_fh)
+    out_fh.close()
+    valid_pred = rnn.predict(validation[verb][0],
+                             split_pos=validation[verb][2])
+    _, _, valid_f = bcubed_score(
+        y_true=validation[verb][1], y_pred=valid_pred
+    )
+
+    scores = [
+        precision, recall, f_score,
+        len(train[verb][1]),
+        len(test[verb][1]),
+        len(set(test[verb][1])),
+        epoch,
+        len(validation[verb][1]),
+        valid_f
+    ]
+
+    # Prediction results
+    sents = indexs2sents(test[verb][0], context["invocab"])
+    pred_lines = ["verb: %s\tf-score:%f" % (verb, f_score)]
+    for i in range(0, len(test[verb][1])):
+        is_true = True if test[verb][1][i] == y_pred[i] else False
+        out_line = "%s\tpredict:%s\ttrue:%s\t" % (is_true, y_pred[i], test[verb][1][i])
+        out_line += " ".join(sents[i])
+        pred_lines.append(out_line)
+    return (scores, pred_lines)
+
+
 def train_and_test():
     p = OrderedDict([
         ("\nParameters for word vectors", ""),
@@ -251,6 +366,8 @@ def train_and_test():
         ("random_vectors", False), # ATTENTION TO THIS
         ("\nOther parameters", ""),
         ("training_detail", False), # ATTENTION TO THIS
+        # Number of processes training the verbs in parallel
+        ("n_workers", 1),
         ("prediction_results", "../../results/nnfl/brnn/text_trash"),
         # For SemEval-2007 task 06
         ("out_dir", "../../results/nnfl/brnn/null_dir")
@@ -311,52 +428,17 @@ def train_and_test():
     verb_counter = 0
     fh_pr = open(p["prediction_results"], "w")
     verbs = train.keys()
-    for verb in verbs:
+    context = {
+        "p": p, "train": train, "test": test, "validation": validation,
+        "word2vec": word2vec, "invocab": invocab
+    }
+    # Verbs are run in parallel processes forked after loading word vectors
+    results = run_jobs(
+        train_and_test_verb, verbs, context, n_workers=p["n_workers"],
+        job_size=lambda verb: len(train[verb][1]), seed=1
+    )
+    for verb, (scores, pred_lines) in results:
         verb_counter += 1
-        # Build TRNN model for each verb
-        rnn = TRNN()
-        rnn.init(
-            x=train[verb][0], label_y=train[verb][1],
-            word2vec=word2vec, n_h=p["n_h"],
-            up_wordvec=p["up_wordvec"], use_bias=p["use_bias"],
-            act_func=p["act_func"], use_lstm=p["use_lstm"]
-        )
-
-        epoch = rnn.minibatch_train(
-            lr=p["lr"],
-            minibatch=p["minibatch"],
-            max_epochs=p["max_epochs"],
-            split_pos=train[verb][2],
-            verbose=p["training_detail"],
-            training_method=p["training_method"],
-            stable_method=p["stable_method"]
-        )
-
-        y_pred = rnn.predict(test[verb][0], split_pos=test[verb][2])
-        precision, recall, f_score = bcubed_score(
-            y_true=test[verb][1], y_pred=y_pred
-        )
-        # Output
-        out_file = "%s/%s" % (p["out_dir"], verb)
-        out_fh = open(out_file, "w")
-        for instance_id, sense_tag in zip(test[verb][1], y_pred):
-            print("%s %s %s" % (verb, instance_id, sense_tag), file=out_fh)
-        out_fh.close()
-        valid_pred = rnn.predict(validation[verb][0],
-                                 split_pos=validation[verb][2])
-        _, _, valid_f = bcubed_score(
-            y_true=validation[verb][1], y_pred=valid_pred
-        )
-
-        scores = [
-            precision, recall, f_score,
-            len(train[verb][1]),
-            len(test[verb][1]),
-            len(set(test[verb][1])),
-            epoch,
-            len(validation[verb][1]),
-            valid_f
-        ]
         scores_overall += scores
         print("current verb:%s, scores are:" % verb)
         print(gen_print_info(field_names, scores))
@@ -365,12 +447,7 @@ def train_and_test():
         print(gen_print_info(field_names, scores_overall / verb_counter))
 
         # Print prediction results
-        sents = indexs2sents(test[verb][0], invocab)
-        print("verb: %s\tf-score:%f" % (verb, f_score), file=fh_pr)
-        for i in range(0, len(test[verb][1])):
-            is_true = True if test[verb][1][i] == y_pred[i] else False
-            out_line = "%s\tpredict:%s\ttrue:%s\t" % (is_true, y_pred[i], test[verb][1][i])
-            out_line += " ".join(sents[i])
+        for out_line in pred_lines:
             print(out_line, file=fh_pr)
 
     # File handles
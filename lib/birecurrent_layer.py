@@ -14,6 +14,7 @@ import copy
 from inc import*
 from gradient_checker import GradientChecker
 from layer import Layer
+import checkpoint
 import recurrent_layer
 import lstm_layer
 
@@ -101,13 +102,13 @@ class BiRecurrentLayer(Layer):
         """
 
         try:
-            os.makedirs(target_dir)
+            checkpoint.makedirs(target_dir)
         except:
             if not os.path.isdir(target_dir):
                 raise Exception("%s is not a directory" % (target_dir,))
 
         # Write the attributes to file
-        attributes_file = open("%s/attributes.txt" % target_dir, "w")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "w")
         attributes = "%s %s %s %s %s %s" % (self.n_i, self.n_o, self.act_func, self.use_bias,
                      self.use_lstm, self.tfloat)
         print(attributes, file=attributes_file)
@@ -127,7 +128,7 @@ class BiRecurrentLayer(Layer):
         """
 
         # Load attributes file
-        attributes_file = open("%s/attributes.txt" % target_dir, "r")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "r")
         #  try:
         (n_i, n_o, act_func, use_bias, use_lstm, tfloat) = (
             attributes_file.readline().strip().split(" ")
@@ -253,13 +254,35 @@ class BiRecurrentLayer(Layer):
                 gop[i][j] = upper_gop[i][j] + lower_gop[i][j]
     
         # Add the gradients on parameters together
-        self.gparams = []
-        for i in range(0, len(self.upper_layer.gparams)):
-            self.gparams.append(
-                self.upper_layer.gparams[i] + self.lower_layer.gparams[i]
-            )
+        for upper_gparam, lower_gparam in zip(self.upper_layer.gparams,
+                                              self.lower_layer.gparams):
+            upper_gparam += lower_gparam
+        self.gparams = self.upper_layer.gparams
         return gop
 
+    def bind_params(self, params):
+        """
+        Rebind the parameters of layer to the given arrays, e.g., views into a
+        flat parameter buffer. The upper and lower layer are rebound as well.
+        params: list of numpy.ndarray
+            The same shapes as self.params
+        """
+
+        self.upper_layer.bind_params(params)
+        self.lower_layer.bind_params(params)
+        Layer.bind_params(self, params)
+
+    def bind_gparams(self, gparams):
+        """
+        Let backprop write the gradients on parameters into the given arrays.
+        The gradients of the lower layer are added to them in place.
+        gparams: list of numpy.ndarray
+            The same shapes as self.params
+        """
+
+        self.upper_layer.bind_gparams(gparams)
+        self.gparams = self.upper_layer.gparams
+
 
 def layer_test():
     n_i = 3
@@ -0,0 +1,990 @@
+#! /usr/bin/env python3
+"""
+Authors: fengyukun
+Date: 2016-10-18
+Brief: Single file checkpoints of models.
+
+A checkpoint holds the same entries as the directory written by write_to_files
+of a model: the text files (e.g., attributes.txt, with the label map) are kept
+in a JSON header, and the arrays of the .npz files follow the header as raw
+uncompressed data aligned to ALIGNMENT bytes:
+
+    MAGIC | header length (uint64, little endian) | JSON header | padding | arrays
+
+The layers and the models read and write their files by the functions of this
+module (open_file, save_arrays, load_arrays, ...). A path inside a checkpoint
+(e.g., model.ckpt/SoftmaxLayer/parameters.npz) is served from the checkpoint,
+so load_from_files of a model loads a checkpoint file like a directory. The
+arrays are mapped into memory and read from disk only when they are used.
+
+An archive holds the checkpoints of many models (e.g., one per verb) in one
+file with an index from the model names to the checkpoints. The header points
+to the index (uint64 offset and length, little endian):
+
+    ARCHIVE_MAGIC | index offset | index length | padding | checkpoints and indexes
+
+A model is appended by writing its checkpoint and then a new index at the end
+of the file, and finally pointing the header to the new index. The other
+models are not rewritten, and a failed append leaves the old index in use.
+The index of each append stays in the file. The model name of an archive is
+loaded like a directory, e.g., load_from_files("verbs.archive/run").
+"""
+
+from __future__ import division
+from __future__ import print_function
+import os
+import io
+import json
+import hashlib
+import struct
+import threading
+import shutil
+import numpy as np
+import logging
+
+
+MAGIC = b"NNCKPT01"
+ARCHIVE_MAGIC = b"NNARCH01"
+ALIGNMENT = 64
+VERSION = 1
+
+# Checkpoints being written by write_checkpoint, absolute path => writer
+_writers = {}
+# Opened checkpoints and archives, absolute path => ((mtime, size), reader)
+_readers = {}
+_lock = threading.Lock()
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _file_magic(path):
+    if not os.path.isfile(path):
+        return None
+    fh = open(path, "rb")
+    magic = fh.read(len(MAGIC))
+    fh.close()
+    return magic
+
+
+def is_checkpoint(path):
+    """
+    Return whether path is a checkpoint file
+    """
+
+    return _file_magic(path) == MAGIC
+
+
+def is_archive(path):
+    """
+    Return whether path is an archive file
+    """
+
+    return _file_magic(path) == ARCHIVE_MAGIC
+
+
+class CheckpointWriter(object):
+    """
+    Collect the entries of a checkpoint and write them to a file
+    """
+    def __init__(self, checkpoint_file):
+        """
+        checkpoint_file: str
+            The target file
+        """
+
+        self.checkpoint_file = checkpoint_file
+        # Relative path => text
+        self.files = {}
+        # Relative path => {name: numpy.ndarray}
+        self.arrays = {}
+
+    def remove(self, name):
+        self.files.pop(name, None)
+        self.arrays.pop(name, None)
+
+    def write(self, model_name=None):
+        """
+        Write the checkpoint to checkpoint_file. The file is written to a
+        temporary file first and then renamed to checkpoint_file.
+        model_name: str
+            The class name of the model, which is kept in the header
+        """
+
+        tmp_file = "%s.%s.tmp" % (self.checkpoint_file, os.getpid())
+        fh = open(tmp_file, "wb")
+        self.write_to(fh, model_name)
+        fh.close()
+        os.rename(tmp_file, self.checkpoint_file)
+
+    def write_to(self, fh, model_name=None):
+        """
+        Write the checkpoint in one sequential pass to fh, whose position
+        should be aligned to ALIGNMENT bytes
+        fh: file
+            A binary file
+        model_name: str
+            The class name of the model, which is kept in the header
+        Return
+        -----
+        int, the number of bytes written
+        """
+
+        header = {"version": VERSION, "model": model_name, "files": self.files, "arrays": {}}
+        arrays = []
+        offset = 0
+        for name in sorted(self.arrays.keys()):
+            entry = {}
+            for key in sorted(self.arrays[name].keys()):
+                array = np.asarray(self.arrays[name][key])
+                if array.dtype.hasobject:
+                    logging.error("Array %s of %s can not be written to a checkpoint"
+                                  % (key, name))
+                    raise Exception
+                offset = _align(offset)
+                entry[key] = {"dtype": array.dtype.str, "shape": list(array.shape),
+                              "offset": offset}
+                arrays.append((offset, array))
+                offset += array.nbytes
+            header["arrays"][name] = entry
+        header_bytes = json.dumps(header, sort_keys=True).encode("utf-8")
+        data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+        fh.write(MAGIC)
+        fh.write(struct.pack("<Q", len(header_bytes)))
+        fh.write(header_bytes)
+        position = len(MAGIC) + 8 + len(header_bytes)
+        for (offset, array) in arrays:
+            fh.write(b"\0" * (data_start + offset - position))
+            array.tofile(fh)
+            position = data_start + offset + array.nbytes
+        return position
+
+
+class CheckpointReader(object):
+    """
+    Read the entries of a checkpoint file
+    """
+    def __init__(self, checkpoint_file, offset=0, length=None):
+        """
+        checkpoint_file: str
+            The checkpoint file, or the archive containing the checkpoint
+        offset: int
+            The position of the checkpoint in the file
+        length: int
+            The size of the checkpoint. None means the rest of the file
+        """
+
+        self.checkpoint_file = checkpoint_file
+        self.offset = offset
+        self.length = length
+        fh = open(checkpoint_file, "rb")
+        fh.seek(offset)
+        if fh.read(len(MAGIC)) != MAGIC:
+            fh.close()
+            logging.error("%s is not a checkpoint" % checkpoint_file)
+            raise Exception
+        (header_len, ) = struct.unpack("<Q", fh.read(8))
+        header = json.loads(fh.read(header_len).decode("utf-8"))
+        fh.close()
+        if header["version"] != VERSION:
+            logging.error("Unknown version %s of %s" % (header["version"], checkpoint_file))
+            raise Exception
+        self.model_name = header["model"]
+        self.files = header["files"]
+        self.array_infos = header["arrays"]
+        self.data_start = _align(len(MAGIC) + 8 + header_len)
+        self.buffer = None
+
+    def exists(self, name):
+        return name in self.files or name in self.array_infos
+
+    def arrays(self, name):
+        """
+        Return the arrays of entry name as a dict. The arrays are
+        copy-on-write views of the file mapped into memory, so their updates
+        are not written back.
+        """
+
+        if self.buffer is None:
+            self.buffer = np.memmap(self.checkpoint_file, dtype=np.uint8, mode='c',
+                                    offset=self.offset, shape=self.length)
+        arrays = {}
+        for (key, info) in self.array_infos[name].items():
+            arrays[key] = np.ndarray(tuple(info["shape"]), dtype=np.dtype(info["dtype"]),
+                                     buffer=self.buffer, offset=self.data_start + info["offset"])
+        return arrays
+
+
+def _read_archive_index(archive_file):
+    """
+    Return the index of archive_file (model name => [offset, length])
+    """
+
+    fh = open(archive_file, "rb")
+    if fh.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+        fh.close()
+        logging.error("%s is not an archive" % archive_file)
+        raise Exception
+    (index_start, index_len) = struct.unpack("<QQ", fh.read(16))
+    if index_start == 0:
+        # The archives written before the header had the pointer keep the
+        # index length and ARCHIVE_MAGIC at the end
+        fh.seek(-8 - len(ARCHIVE_MAGIC), os.SEEK_END)
+        (index_len, ) = struct.unpack("<Q", fh.read(8))
+        if fh.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            fh.close()
+            logging.error("The index of %s is broken" % archive_file)
+            raise Exception
+        fh.seek(-8 - len(ARCHIVE_MAGIC) - index_len, os.SEEK_END)
+        index_start = fh.tell()
+    fh.seek(index_start)
+    index = json.loads(fh.read(index_len).decode("utf-8"))
+    fh.close()
+    return index["models"]
+
+
+def _write_archive_index(fh, models):
+    """
+    Write the index at the position of fh and return its offset and length
+    """
+
+    index_bytes = json.dumps({"version": VERSION, "models": models},
+                             sort_keys=True).encode("utf-8")
+    index_start = fh.tell()
+    fh.write(index_bytes)
+    return (index_start, len(index_bytes))
+
+
+def _sync(fh):
+    fh.flush()
+    os.fsync(fh.fileno())
+
+
+def _point_to_index(fh, index_start, index_len):
+    """
+    Point the header of the archive fh to the index
+    """
+
+    fh.seek(len(ARCHIVE_MAGIC))
+    fh.write(struct.pack("<QQ", index_start, index_len))
+
+
+class ArchiveReader(object):
+    """
+    Read the checkpoints in an archive file
+    """
+    def __init__(self, archive_file):
+        """
+        archive_file: str
+            The archive file
+        """
+
+        self.archive_file = archive_file
+        self.models = _read_archive_index(archive_file)
+        self.readers = {}
+
+    def reader(self, name):
+        """
+        Return the CheckpointReader of model name, or None if there is no
+        such model
+        """
+
+        if name not in self.models:
+            return None
+        if name not in self.readers:
+            (offset, length) = self.models[name]
+            self.readers[name] = CheckpointReader(self.archive_file, offset, length)
+        return self.readers[name]
+
+
+def _open_reader(path):
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size)
+    if path not in _readers or _readers[path][0] != key:
+        if is_archive(path):
+            _readers[path] = (key, ArchiveReader(path))
+        else:
+            _readers[path] = (key, CheckpointReader(path))
+    return _readers[path][1]
+
+
+def _resolve(path):
+    """
+    Return the checkpoint (a writer or a reader) containing path and the name
+    of path in it, or (None, None) if path is on the file system
+    """
+
+    path = os.path.abspath(path)
+    with _lock:
+        for (checkpoint_file, writer) in _writers.items():
+            if path == checkpoint_file or path.startswith(checkpoint_file + os.sep):
+                return (writer, os.path.relpath(path, checkpoint_file).replace(os.sep, "/"))
+        if os.path.exists(path):
+            return (None, None)
+        head = os.path.dirname(path)
+        while head != os.path.dirname(head):
+            magic = _file_magic(head)
+            if magic == MAGIC:
+                reader = _open_reader(head)
+                return (reader, os.path.relpath(path, head).replace(os.sep, "/"))
+            if magic == ARCHIVE_MAGIC:
+                # The first part of the path in an archive is the model name
+                names = os.path.relpath(path, head).split(os.sep)
+                reader = _open_reader(head).reader(names[0])
+                if reader is None or len(names) == 1:
+                    return (None, None)
+                return (reader, "/".join(names[1:]))
+            if os.path.isdir(head):
+                break
+            head = os.path.dirname(head)
+    return (None, None)
+
+
+class _TextFile(io.StringIO):
+    """
+    A text file to be written into a checkpoint when it is closed
+    """
+    def __init__(self, writer, name):
+        io.StringIO.__init__(self)
+        self.writer = writer
+        self.name = name
+
+    def close(self):
+        if not self.closed:
+            self.writer.files[self.name] = self.getvalue()
+        io.StringIO.close(self)
+
+
+def makedirs(target_dir):
+    """
+    os.makedirs. The directories in a checkpoint need not be created
+    """
+
+    (checkpoint, _) = _resolve(target_dir)
+    if checkpoint is None:
+        os.makedirs(target_dir)
+
+
+def open_file(path, mode="r"):
+    """
+    open for the text files of models
+    mode: str
+        'r' or 'w'
+    """
+
+    (checkpoint, name) = _resolve(path)
+    if checkpoint is None:
+        return open(path, mode)
+    if isinstance(checkpoint, CheckpointWriter):
+        if mode == "w":
+            return _TextFile(checkpoint, name)
+    elif mode == "r" and name in checkpoint.files:
+        return io.StringIO(checkpoint.files[name])
+    logging.error("Can not open %s with mode %s" % (path, mode))
+    raise Exception
+
+
+def save_arrays(path, **arrays):
+    """
+    numpy.savez_compressed for the parameters of models
+    """
+
+    (checkpoint, name) = _resolve(path)
+    if checkpoint is None:
+        np.savez_compressed(path, **arrays)
+    else:
+        checkpoint.arrays[name] = arrays
+
+
+def load_arrays(path):
+    """
+    numpy.load for the files written by save_arrays
+    """
+
+    (checkpoint, name) = _resolve(path)
+    if checkpoint is None:
+        return np.load(path)
+    if not isinstance(checkpoint, CheckpointReader) or name not in checkpoint.array_infos:
+        logging.error("Can not load %s" % path)
+        raise Exception
+    return checkpoint.arrays(name)
+
+
+def path_exists(path):
+    """
+    os.path.exists for the files of models
+    """
+
+    (checkpoint, name) = _resolve(path)
+    if checkpoint is None:
+        return os.path.exists(path)
+    if isinstance(checkpoint, CheckpointWriter):
+        return name in checkpoint.files or name in checkpoint.arrays
+    return checkpoint.exists(name)
+
+
+def remove_file(path):
+    """
+    os.remove for the files of models
+    """
+
+    (checkpoint, name) = _resolve(path)
+    if checkpoint is None:
+        os.remove(path)
+    elif isinstance(checkpoint, CheckpointWriter):
+        checkpoint.remove(name)
+
+
+def write_checkpoint(model, checkpoint_file, *args, **kwargs):
+    """
+    Write model to checkpoint_file. The other arguments are passed to
+    model.write_to_files (e.g., prune_embedding). The model is loaded by
+    model.load_from_files(checkpoint_file).
+    model: object
+        A model with write_to_files (e.g., ABiRNN)
+    checkpoint_file: str
+        The target file
+    """
+
+    writer = _capture_model(model, checkpoint_file, args, kwargs)
+    writer.write(model.__class__.__name__)
+    logging.info("Finish writting %s to checkpoint %s" % (model.__class__.__name__,
+                                                          checkpoint_file))
+
+
+def _capture_model(model, target, args, kwargs, training_state=None):
+    """
+    Return a CheckpointWriter holding the files written by
+    model.write_to_files(target, *args, **kwargs) and by
+    write_training_state(target, training_state) if training_state is given
+    """
+
+    target = os.path.abspath(target)
+    writer = CheckpointWriter(target)
+    with _lock:
+        if target in _writers:
+            logging.error("%s is being written" % target)
+            raise Exception
+        _writers[target] = writer
+    try:
+        model.write_to_files(target, *args, **kwargs)
+        if training_state is not None:
+            write_training_state(target, training_state)
+    finally:
+        with _lock:
+            del _writers[target]
+    return writer
+
+
+def _capture_dir(model_dir):
+    """
+    Return a CheckpointWriter holding the files of model_dir
+    """
+
+    writer = CheckpointWriter(model_dir)
+    for (root, _, file_names) in os.walk(model_dir):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            name = os.path.relpath(path, model_dir).replace(os.sep, "/")
+            if file_name.endswith(".npz"):
+                npz = np.load(path)
+                writer.arrays[name] = dict((key, npz[key]) for key in npz.files)
+                npz.close()
+            else:
+                fh = open(path, "r")
+                writer.files[name] = fh.read()
+                fh.close()
+    return writer
+
+
+def dir_to_checkpoint(model_dir, checkpoint_file):
+    """
+    Convert the directory of a model written by write_to_files into a
+    checkpoint
+    model_dir: str
+        The directory of the model
+    checkpoint_file: str
+        The target file
+    """
+
+    writer = _capture_dir(model_dir)
+    writer.checkpoint_file = checkpoint_file
+    writer.write()
+
+
+def checkpoint_to_dir(checkpoint_file, model_dir):
+    """
+    Convert a checkpoint into the directory of a model as written by
+    write_to_files. Files in model_dir are replaced.
+    checkpoint_file: str
+        The checkpoint file
+    model_dir: str
+        The target directory
+    """
+
+    reader = CheckpointReader(checkpoint_file)
+    if os.path.exists(model_dir):
+        shutil.rmtree(model_dir)
+    arrays = dict((name, reader.arrays(name)) for name in reader.array_infos)
+    _write_dir(reader.files, arrays, model_dir)
+
+
+def _link_file(source, target):
+    """
+    Make target a hard link to source, or a copy if links are not supported
+    """
+
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _link_tree(source, target):
+    if os.path.isdir(source):
+        os.makedirs(target)
+        for name in os.listdir(source):
+            _link_tree(os.path.join(source, name), os.path.join(target, name))
+    else:
+        _link_file(source, target)
+
+
+def _write_dir(files, arrays, model_dir, reused=None):
+    """
+    Write the text files (name => text) and the arrays (name => {key: array})
+    of a model to model_dir in the layout of write_to_files. The entries in
+    reused (name => path) are hard links to (or copies of) the existing files
+    instead.
+    """
+
+    if reused is None:
+        reused = {}
+    for name in list(files.keys()) + list(arrays.keys()):
+        path = os.path.join(model_dir, *name.split("/"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if name in reused:
+            _link_file(reused[name], path)
+        elif name in files:
+            fh = open(path, "w")
+            fh.write(files[name])
+            fh.close()
+        else:
+            np.savez_compressed(path, **arrays[name])
+
+
+def _array_digest(array):
+    array = np.ascontiguousarray(array)
+    hasher = hashlib.sha1()
+    hasher.update(("%s %s" % (array.dtype.str, array.shape)).encode("utf-8"))
+    hasher.update(array.data)
+    return hasher.hexdigest()
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Write models in a background thread. write takes a snapshot of the model
+    (the files of write_to_files are kept in memory, with copies of the
+    arrays) and returns, so training goes on while the snapshot is written.
+    The snapshot is written next to the target and renamed to the target, so
+    the target is never a half-written model. At most one snapshot is in
+    flight: write waits for the previous one. A directory is swapped by two
+    renames (see recover_dir for a crash between them).
+
+    The other files in a target directory (e.g., a vocabulary) are kept. A
+    file or directory belongs to the model if the part of its name before the
+    first dot is the same as that of an entry of the snapshot (e.g.,
+    embedding_out.ref for embedding_out.npz), otherwise it is kept.
+
+    The directories are written as deltas: the .npz files whose arrays are
+    the same as in the last write to the same target (by their sha1) are
+    linked from it instead of being written again. The hash of the word
+    vectors which are not updated is computed once.
+    """
+    def __init__(self, checkpoint=False):
+        """
+        checkpoint: bool
+            Whether the models are written as checkpoint files instead of the
+            directories of write_to_files
+        """
+
+        self.checkpoint = checkpoint
+        self.thread = None
+        self.error = None
+        # The target of the last write and the sha1 of its .npz files
+        self.last_target = None
+        self.last_digests = {}
+        # The frozen word vectors and their sha1
+        self.frozen = None
+        self.frozen_digest = None
+
+    def write(self, model, target, *args, **kwargs):
+        """
+        Start writing a snapshot of model to target. The other arguments are
+        passed to model.write_to_files, except the keyword argument
+        training_state (a dict), which is written with the model by
+        write_training_state. The error of the previous write is raised here.
+        model: object
+            A model with write_to_files (e.g., ABiRNN)
+        target: str
+            The target directory or checkpoint file
+        """
+
+        self.wait()
+        # "model/" would put the temporary directory into the target
+        target = os.path.normpath(target)
+        training_state = kwargs.pop("training_state", None)
+        writer = _capture_model(model, target, args, kwargs, training_state)
+        # Word vectors which are not updated need no copy
+        frozen = None
+        if not getattr(model, "up_wordvec", True):
+            frozen = model.embedding_layer.word2vec
+        if frozen is not self.frozen:
+            self.frozen = frozen
+            self.frozen_digest = None
+        for entry in writer.arrays.values():
+            for key in entry.keys():
+                if entry[key] is not frozen:
+                    entry[key] = np.array(entry[key])
+        self.thread = threading.Thread(
+            target=self._run, args=(writer, model.__class__.__name__, target)
+        )
+        self.thread.start()
+
+    def _run(self, writer, model_name, target):
+        try:
+            if self.checkpoint:
+                writer.checkpoint_file = target
+                writer.write(model_name)
+            else:
+                digests = dict((name, self._digest(entry))
+                               for (name, entry) in writer.arrays.items())
+                reused = {}
+                if os.path.abspath(target) == self.last_target:
+                    for (name, digest) in digests.items():
+                        path = os.path.join(target, *name.split("/"))
+                        if self.last_digests.get(name) == digest and os.path.exists(path):
+                            reused[name] = path
+                tmp_dir = "%s.%s.tmp" % (target, os.getpid())
+                if os.path.exists(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+                _write_dir(writer.files, writer.arrays, tmp_dir, reused)
+                if os.path.isdir(target):
+                    model_names = set(name.split("/")[0].split(".")[0]
+                                      for name in list(writer.files) + list(writer.arrays))
+                    for name in os.listdir(target):
+                        if name.split(".")[0] not in model_names:
+                            _link_tree(os.path.join(target, name), os.path.join(tmp_dir, name))
+                # A directory can not replace another one by a rename, so
+                # the old model is moved away first
+                old_dir = "%s.%s.old" % (target, os.getpid())
+                if os.path.exists(old_dir):
+                    shutil.rmtree(old_dir)
+                if os.path.isdir(target):
+                    os.rename(target, old_dir)
+                os.rename(tmp_dir, target)
+                shutil.rmtree(old_dir, ignore_errors=True)
+                self.last_target = os.path.abspath(target)
+                self.last_digests = digests
+            logging.info("Finish writting %s to %s" % (model_name, target))
+        except Exception as e:
+            logging.error("Failed to write %s to %s: %s" % (model_name, target, e))
+            self.error = e
+
+    def _digest(self, entry):
+        """
+        Return the sha1 of the keys, the types, the shapes and the values of
+        the arrays of an entry
+        """
+
+        hasher = hashlib.sha1()
+        for key in sorted(entry.keys()):
+            array = entry[key]
+            if array is self.frozen:
+                if self.frozen_digest is None:
+                    self.frozen_digest = _array_digest(array)
+                digest = self.frozen_digest
+            else:
+                digest = _array_digest(array)
+            hasher.update(("%s %s " % (key, digest)).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def wait(self):
+        """
+        Wait for the snapshot in flight. Its error is raised if it failed
+        """
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+
+def recover_dir(target_dir):
+    """
+    Finish the swap of AsyncCheckpointWriter if the process died between the
+    rename of target_dir to target_dir.PID.old and the rename of the complete
+    snapshot target_dir.PID.tmp to target_dir. The snapshot is renamed to
+    target_dir, or the old model if there is no snapshot. Nothing is done if
+    target_dir exists.
+    target_dir: str
+    Return
+    -----
+    bool, whether target_dir is recovered
+    """
+
+    target_dir = os.path.normpath(target_dir)
+    if os.path.exists(target_dir):
+        return False
+    (parent, base) = os.path.split(target_dir)
+    old_dirs = []
+    for name in os.listdir(parent or "."):
+        pid = name[len(base) + 1:-len(".old")]
+        if name.startswith(base + ".") and name.endswith(".old") and pid.isdigit():
+            old_dirs.append(os.path.join(parent, name))
+    if len(old_dirs) == 0:
+        return False
+    old_dir = max(old_dirs, key=os.path.getmtime)
+    tmp_dir = "%s.tmp" % old_dir[0:-len(".old")]
+    if os.path.isdir(tmp_dir):
+        # The old model is only moved away when the snapshot is complete
+        os.rename(tmp_dir, target_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        os.rename(old_dir, target_dir)
+    logging.info("Recover %s from an interrupted write" % target_dir)
+    return True
+
+
+def write_training_state(target_dir, state):
+    """
+    Write the state of a training (e.g., the epoch and the learning rate) to
+    target_dir/training_state.json and target_dir/training_state.npz, with the
+    state of numpy.random
+    target_dir: str
+        The directory (or checkpoint) of the model
+    state: dict
+        The values are numbers, strings, None, numpy arrays or lists of numpy
+        arrays (e.g., a snapshot of the parameters)
+    """
+
+    values = {}
+    lists = {}
+    arrays = {}
+    for (key, value) in state.items():
+        if isinstance(value, np.ndarray):
+            arrays[key] = value
+        elif isinstance(value, list) and all(isinstance(v, np.ndarray) for v in value):
+            lists[key] = len(value)
+            for (i, array) in enumerate(value):
+                arrays["%s.%d" % (key, i)] = array
+        else:
+            values[key] = value
+    random_state = np.random.get_state()
+    arrays["random_state.keys"] = random_state[1]
+    values["random_state"] = [random_state[0]] + list(random_state[2:])
+
+    state_file = open_file("%s/training_state.json" % target_dir, "w")
+    json.dump({"values": values, "lists": lists}, state_file,
+              default=lambda value: value.item())
+    state_file.close()
+    save_arrays("%s/training_state.npz" % target_dir, **arrays)
+
+
+def load_training_state(target_dir):
+    """
+    Return the state written by write_training_state to target_dir, or None
+    if there is none. The state of numpy.random is under the key
+    random_state, in the form of numpy.random.get_state
+    """
+
+    if not path_exists("%s/training_state.json" % target_dir):
+        return None
+    state_file = open_file("%s/training_state.json" % target_dir, "r")
+    header = json.load(state_file)
+    state_file.close()
+    arrays = load_arrays("%s/training_state.npz" % target_dir)
+    state = header["values"]
+    for (key, length) in header["lists"].items():
+        state[key] = [np.array(arrays["%s.%d" % (key, i)]) for i in range(length)]
+    for key in arrays.keys():
+        if "." not in key:
+            state[key] = np.array(arrays[key])
+    random_state = state["random_state"]
+    state["random_state"] = (random_state[0], np.array(arrays["random_state.keys"]),
+                             random_state[1], random_state[2], random_state[3])
+    return state
+
+
+
+def resume_training(model, target_dir):
+    """
+    Load the model and the training state written to target_dir by
+    minibatch_train of model (ABiRNN or TRNN). The training data of model (see
+    init) is kept, and its labels are mapped to the outputs of the loaded
+    model. A write interrupted by a crash is recovered first (see
+    recover_dir).
+    model: ABiRNN or TRNN
+    target_dir: str
+        The target_dir of minibatch_train
+    Return
+    -----
+    dict, the training state (see load_training_state), or None if target_dir
+    has no training state, in which case model is not changed
+    """
+
+    recover_dir(target_dir)
+    state = load_training_state(target_dir)
+    if state is None:
+        return None
+    (x, label_y) = (model.x, model.label_y)
+    model.load_from_files(target_dir)
+    model.x = x
+    model.label_y = label_y
+    # The labels are strings in the files
+    str_to_y = dict((label, y) for (y, label) in model.y_to_label.items())
+    unknown_labels = set(str(label) for label in label_y) - set(str_to_y.keys())
+    if len(unknown_labels) != 0:
+        logging.error("Labels %s are not in the model in %s" % (unknown_labels, target_dir))
+        raise Exception
+    model.label_to_y = dict((label, str_to_y[str(label)]) for label in set(label_y))
+    model.y_to_label = dict((y, label) for (label, y) in model.label_to_y.items())
+    model.y = np.array([model.label_to_y[label] for label in label_y])
+    model.word2vec = model.embedding_layer.word2vec
+    return state
+
+def _append_to_archive(archive_file, name, write_record):
+    """
+    Append a checkpoint written by write_record(fh) (which returns its size)
+    to archive_file as model name. A model with the same name is replaced in
+    the index. The archive is created if it does not exist. Appending to an
+    archive from several processes at the same time is not supported.
+    The checkpoint and the new index are written after the end of the file
+    and synced before the header is pointed to the new index, so the archive
+    keeps its old models if the append fails (e.g., the disk is full).
+    """
+
+    if not name or "/" in name or os.sep in name:
+        logging.error("Bad model name %s" % name)
+        raise Exception
+    if not os.path.exists(archive_file):
+        tmp_file = "%s.%s.tmp" % (archive_file, os.getpid())
+        fh = open(tmp_file, "wb")
+        fh.write(ARCHIVE_MAGIC)
+        fh.write(b"\0" * (ALIGNMENT - len(ARCHIVE_MAGIC)))
+        (index_start, index_len) = _write_archive_index(fh, {})
+        _point_to_index(fh, index_start, index_len)
+        _sync(fh)
+        fh.close()
+        os.rename(tmp_file, archive_file)
+    models = _read_archive_index(archive_file)
+    fh = open(archive_file, "r+b")
+    fh.seek(0, os.SEEK_END)
+    end = fh.tell()
+    start = _align(end)
+    fh.write(b"\0" * (start - end))
+    models[name] = [start, write_record(fh)]
+    (index_start, index_len) = _write_archive_index(fh, models)
+    _sync(fh)
+    _point_to_index(fh, index_start, index_len)
+    _sync(fh)
+    fh.close()
+
+
+def append_to_archive(archive_file, name, model, *args, **kwargs):
+    """
+    Append model to archive_file as model name. The other arguments are
+    passed to model.write_to_files. The model is loaded by
+    model.load_from_files("%s/%s" % (archive_file, name)).
+    archive_file: str
+        The archive file. It is created if it does not exist
+    name: str
+        The model name, e.g., a verb
+    model: object
+        A model with write_to_files (e.g., ABiRNN)
+    """
+
+    writer = _capture_model(model, "%s/%s" % (archive_file, name), args, kwargs)
+    model_name = model.__class__.__name__
+    _append_to_archive(archive_file, name, lambda fh: writer.write_to(fh, model_name))
+    logging.info("Finish appending %s to archive %s" % (name, archive_file))
+
+
+def add_to_archive(archive_file, name, model_path):
+    """
+    Append a saved model to archive_file as model name
+    archive_file: str
+        The archive file. It is created if it does not exist
+    name: str
+        The model name, e.g., a verb
+    model_path: str
+        The directory of the model written by write_to_files or a checkpoint
+    """
+
+    if is_checkpoint(model_path):
+        def write_record(fh):
+            source_fh = open(model_path, "rb")
+            shutil.copyfileobj(source_fh, fh)
+            source_fh.close()
+            return os.path.getsize(model_path)
+    else:
+        writer = _capture_dir(model_path)
+        write_record = writer.write_to
+    _append_to_archive(archive_file, name, write_record)
+
+
+def archive_names(archive_file):
+    """
+    Return the sorted model names in archive_file
+    """
+
+    return sorted(_read_archive_index(archive_file).keys())
+
+
+def checkpoint_test():
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    checkpoint_file = "%s/test.ckpt" % tmp_dir
+
+    class Model(object):
+        def write_to_files(self, target_dir):
+            makedirs(target_dir)
+            fh = open_file("%s/attributes.txt" % target_dir, "w")
+            print("3 4", file=fh)
+            fh.close()
+            save_arrays("%s/Layer/parameters.npz" % target_dir, w=np.arange(12.0).reshape(3, 4),
+                        b=np.int64(2))
+
+        def load_from_files(self, target_dir):
+            fh = open_file("%s/attributes.txt" % target_dir, "r")
+            self.attributes = fh.read()
+            fh.close()
+            self.params = load_arrays("%s/Layer/parameters.npz" % target_dir)
+
+    write_checkpoint(Model(), checkpoint_file)
+    model = Model()
+    model.load_from_files(checkpoint_file)
+    print(model.attributes.strip(), model.params['w'].sum(), int(model.params['b']))
+    checkpoint_to_dir(checkpoint_file, "%s/model" % tmp_dir)
+    dir_to_checkpoint("%s/model" % tmp_dir, "%s/copy.ckpt" % tmp_dir)
+    model.load_from_files("%s/copy.ckpt" % tmp_dir)
+    print(model.attributes.strip(), model.params['w'].sum(), int(model.params['b']))
+
+    archive_file = "%s/test.archive" % tmp_dir
+    append_to_archive(archive_file, "a", Model())
+    add_to_archive(archive_file, "b", checkpoint_file)
+    add_to_archive(archive_file, "c", "%s/model" % tmp_dir)
+    print(archive_names(archive_file))
+    for name in archive_names(archive_file):
+        model.load_from_files("%s/%s" % (archive_file, name))
+        print(name, model.attributes.strip(), model.params['w'].sum(), int(model.params['b']))
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    checkpoint_test()
@@ -237,6 +237,254 @@ def set_jagged_array(jagged_array, val):
                 jagged_array[i][j][k] = val
 
 
+def copy_arrays(arrays):
+    """
+    Copy each array in arrays. Used to keep in-memory snapshots of parameters
+    arrays: list of numpy.ndarray
+    Return
+    -----
+    list of numpy.ndarray, the copies
+    """
+
+    return [np.copy(array) for array in arrays]
+
+
+def assign_arrays(targets, sources):
+    """
+    Assign sources to targets in place. The objects of targets are kept, so
+    any layer referring to them will see the new values
+    targets: list of numpy.ndarray
+    sources: list of numpy.ndarray, the same shapes as targets
+    """
+
+    if len(targets) != len(sources):
+        logging.error("targets:%d and sources:%d are not the same length"
+                      % (len(targets), len(sources)))
+        raise Exception
+    for target, source in zip(targets, sources):
+        target[...] = source
+
+
+def flat_views(flat_array, shapes):
+    """
+    Split a flat array into views with the given shapes. The views share
+    memory with flat_array
+    flat_array: 1d numpy.ndarray, contiguous
+    shapes: list of tuple
+    Return
+    -----
+    list of numpy.ndarray
+    """
+
+    size = sum([int(np.prod(shape)) for shape in shapes])
+    if size != flat_array.shape[0]:
+        logging.error("flat array size:%d does not match the shapes:%d"
+                      % (flat_array.shape[0], size))
+        raise Exception
+    views = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        views.append(flat_array[offset:offset + size].reshape(shape))
+        offset += size
+    return views
+
+
+def flatten_arrays(arrays, dtype='float64'):
+    """
+    Copy arrays into one contiguous flat array
+    arrays: list of numpy.ndarray
+    dtype: str, type of the flat array
+    Return
+    -----
+    flat_array: 1d numpy.ndarray
+    views: list of numpy.ndarray, views into flat_array with the shapes of
+    arrays
+    """
+
+    size = sum([array.size for array in arrays])
+    flat_array = np.zeros(shape=(size, ), dtype=dtype)
+    views = flat_views(flat_array, [array.shape for array in arrays])
+    assign_arrays(views, arrays)
+    return (flat_array, views)
+
+
+
+class FlatParamsMixin(object):
+    """
+    Keep all parameters of a model in one contiguous flat buffer
+    self.flat_params and the gradients on them in self.flat_gparams. The model
+    gives its layers by param_layers.
+    """
+
+    def param_layers(self):
+        """
+        Return the layers holding self.params in the same order. An item may be
+        a list of layers sharing the same parameters, in which only the first
+        layer gets the gradients
+        """
+
+        logging.error("%s does not give its layers" % self.__class__.__name__)
+        raise Exception
+
+    def init_flat_params(self):
+        """
+        Move the parameters into one contiguous flat buffer self.flat_params
+        and the gradients on them into self.flat_gparams. self.params and the
+        parameters of layers become views into the buffers, so the update of
+        all parameters is a single vectorized operation and backprop does not
+        allocate gradients any more.
+        """
+
+        (flat_params, _) = flatten_arrays(self.params)
+        self.bind_flat_params(flat_params)
+        self.bind_flat_gparams(np.zeros(flat_params.shape))
+
+    def _layer_groups(self):
+        groups = []
+        for item in self.param_layers():
+            if not isinstance(item, list):
+                item = [item]
+            groups.append(item)
+        return groups
+
+    def bind_flat_params(self, flat_params):
+        """
+        Rebind the parameters to views into the given flat buffer (e.g., one in
+        shared memory). The values are not copied.
+        flat_params: 1d numpy.ndarray
+            The same size as self.flat_params
+        """
+
+        params = flat_views(flat_params, [param.shape for param in self.params])
+        start = 0
+        for layers in self._layer_groups():
+            end = start + len(layers[0].params)
+            for neural_layer in layers:
+                neural_layer.bind_params(params[start:end])
+            start = end
+        self.params = params
+        self.flat_params = flat_params
+
+    def bind_flat_gparams(self, flat_gparams):
+        """
+        Let backprop write the gradients on parameters into the given flat
+        buffer.
+        flat_gparams: 1d numpy.ndarray
+            The same size as self.flat_params
+        """
+
+        gparams = flat_views(flat_gparams, [param.shape for param in self.params])
+        start = 0
+        for layers in self._layer_groups():
+            end = start + len(layers[0].params)
+            layers[0].bind_gparams(gparams[start:end])
+            start = end
+        self.flat_gparams = flat_gparams
+
+
+class EarlyStopping(object):
+    """
+    Keep the parameters with the lowest validation loss during the training
+    and tell when the loss has not been improved for patience evaluations.
+    The parameters are restored when the training ends.
+    """
+
+    def __init__(self, model, patience=None):
+        """
+        model: a model with flat parameters (see FlatParamsMixin)
+            The word vectors are only kept when they are updated
+        patience: int
+            None means no early stopping
+        """
+
+        # The views taken now, so it is created after the flat parameters are
+        # rebound (e.g., by parallel.make_trainer)
+        self.targets = [model.flat_params]
+        if model.up_wordvec:
+            self.targets.append(model.embedding_layer.word2vec)
+        self.patience = patience
+        self.best_valid_error = None
+        self.best_snapshot = None
+        self.best_epoch = 0
+        self.bad_times = 0
+
+    def update(self, epoch, valid_error, verbose=False):
+        """
+        Record the validation loss after epoch
+        epoch: int
+        valid_error: float
+        verbose: bool
+        Return
+        -----
+        bool, whether to stop the training
+        """
+
+        if verbose:
+            logging.info("epoch: %d, on validation data, zero-one loss: %f"
+                         % (epoch, valid_error))
+        if self.best_valid_error is None or valid_error < self.best_valid_error:
+            self.best_valid_error = valid_error
+            self.best_snapshot = copy_arrays(self.targets)
+            self.best_epoch = epoch
+            self.bad_times = 0
+            return False
+        self.bad_times += 1
+        if self.patience is not None and self.bad_times >= self.patience:
+            if verbose:
+                logging.info("The validation loss is not improved for %s times. "
+                             "Stop training" % self.bad_times)
+            return True
+        return False
+
+    def restore(self, verbose=False):
+        """
+        Restore the parameters with the lowest validation loss, if any
+        verbose: bool
+        """
+
+        if self.best_snapshot is None:
+            return
+        if verbose:
+            logging.info("Restore the parameters of epoch %d with validation zero-one "
+                         "loss: %f" % (self.best_epoch, self.best_valid_error))
+        assign_arrays(self.targets, self.best_snapshot)
+
+    def state(self):
+        """
+        Return the state to resume from, see load_state
+        """
+
+        return {"best_valid_error": self.best_valid_error,
+                "best_epoch": self.best_epoch, "bad_times": self.bad_times,
+                "best_snapshot": self.best_snapshot}
+
+    def load_state(self, state):
+        """
+        Continue from a state given by state
+        state: dict
+        """
+
+        self.best_valid_error = state["best_valid_error"]
+        self.best_epoch = state["best_epoch"]
+        self.bad_times = state["bad_times"]
+        self.best_snapshot = state.get("best_snapshot")
+
+def batch_word_indexs(x):
+    """
+    Return the distinct word indexs in x
+    x: numpy.ndarray, 2d array or 2d jagged array
+    Return
+    -----
+    1d numpy.ndarray (int)
+    """
+
+    rows = [np.ravel(np.asarray(row, dtype=np.int64)) for row in x]
+    if len(rows) == 0:
+        return np.zeros(shape=(0, ), dtype=np.int64)
+    return np.unique(np.concatenate(rows))
+
+
 def jagged_array_test():
     n_row = 5
     min_col = 1
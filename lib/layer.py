@@ -11,15 +11,59 @@ from __future__ import print_function
 from __future__ import division
 import copy
 import os
+import json
+import hashlib
 from inc import*
 from gradient_checker import GradientChecker
+import checkpoint
 
 
 class Layer(object):
     """
-    Base layer(empty)
+    Base layer
     """
-    pass
+
+    def bind_params(self, params):
+        """
+        Rebind the parameters of layer to the given arrays, e.g., views into a
+        flat parameter buffer. Each parameter is an attribute named as in
+        self.param_names.
+        params: list of numpy.ndarray
+            The same shapes as self.params
+        """
+
+        for param_name, param in zip(self.param_names, params):
+            setattr(self, param_name, param)
+        # The list object is kept since layers sharing parameters share it
+        self.params[:] = params
+
+    def bind_gparams(self, gparams):
+        """
+        Let backprop write the gradients on parameters into the given arrays,
+        e.g., views into a flat gradient buffer.
+        gparams: list of numpy.ndarray
+            The same shapes as self.params
+        """
+
+        self.gparams = list(gparams)
+        for param_name, gparam in zip(self.param_names, self.gparams):
+            setattr(self, "g" + param_name, gparam)
+
+    def reset_gparams(self):
+        """
+        Zero the gradients on parameters in place. They are allocated on the
+        first call (or given by bind_gparams) and reused by the later calls.
+        The gradients on each parameter is an attribute named as 'g' plus its
+        name in self.param_names.
+        """
+
+        if (getattr(self, 'gparams', None) is None or
+           [gparam.shape for gparam in self.gparams] !=
+           [param.shape for param in self.params]):
+            self.bind_gparams([np.zeros(param.shape) for param in self.params])
+        else:
+            for gparam in self.gparams:
+                gparam.fill(0)
 
 
 class NormlizationLayer(Layer):
@@ -264,6 +308,29 @@ class GeneralLayer(Layer):
             self.params.append(self.b)
             self.param_names.append('b')
 
+    def add_units(self, n_new):
+        """
+        Add n_new output units. The weights of the existing units are kept and
+        the new ones are initialized as in init_params.
+        n_new: int
+            The number of new units
+        """
+
+        new_w = np.random.uniform(
+            low=-np.sqrt(1. / self.n_i),
+            high=np.sqrt(1. / self.n_i),
+            size=(n_new, self.n_i)
+        ).astype(dtype=self.w.dtype, copy=False)
+        params = [np.concatenate([self.w, new_w])]
+        if self.use_bias:
+            params.append(np.concatenate(
+                [self.b, np.zeros(shape=n_new, dtype=self.b.dtype)]
+            ))
+        self.n_o += n_new
+        self.params = []
+        self.bind_params(params)
+        self.gparams = None
+
     def write_to_files(self, target_dir):
         """Write the attributes and the parameters to files
 
@@ -273,21 +340,21 @@ class GeneralLayer(Layer):
         """
 
         try:
-            os.makedirs(target_dir)
+            checkpoint.makedirs(target_dir)
         except:
             if not os.path.isdir(target_dir):
                 raise Exception("%s is not a directory" % (target_dir,))
 
         # Write the attributes to file
-        attributes_file = open("%s/attributes.txt" % target_dir, "w")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "w")
         print("%s %s %s %s" % (self.n_i, self.n_o, self.use_bias, self.tfloat),
               file=attributes_file)
         attributes_file.close()
         # Write paramters to file
         if self.use_bias:
-            np.savez_compressed("%s/parameters.npz" % target_dir, w=self.w, b=self.b)
+            checkpoint.save_arrays("%s/parameters.npz" % target_dir, w=self.w, b=self.b)
         else:
-            np.savez_compressed("%s/parameters.npz" % target_dir, w=self.w)
+            checkpoint.save_arrays("%s/parameters.npz" % target_dir, w=self.w)
         logging.info("Finish writting %s layer to %s" % (self.__class__.__name__, target_dir))
 
     def load_from_files(self, target_dir):
@@ -299,7 +366,7 @@ class GeneralLayer(Layer):
 
         logging.info("Start loading %s layer from %s" % (self.__class__.__name__, target_dir))
         # Load attributes file
-        attributes_file = open("%s/attributes.txt" % target_dir, "r")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "r")
         try:
             (n_i, n_o, use_bias, tfloat) = attributes_file.readline().strip().split(" ")
             self.n_i = int(n_i)
@@ -314,7 +381,7 @@ class GeneralLayer(Layer):
         attributes_file.close()
         
         # Load parameters file
-        paramters = np.load("%s/parameters.npz" % target_dir)
+        paramters = checkpoint.load_arrays("%s/parameters.npz" % target_dir)
         self.w = paramters['w']
         self.params = [self.w]
         self.param_names = ['w']
@@ -411,12 +478,10 @@ class GeneralLayer(Layer):
         gnet = self.grad_out_to_net_input(go)
 
         # Gradients on the parameters
-        self.gparams = []
-        gw = gnet.T.dot(self.x)
-        self.gparams.append(gw)
+        self.reset_gparams()
+        self.gw[...] = gnet.T.dot(self.x)
         if self.use_bias:
-            gb = gnet.sum(axis=0)
-            self.gparams.append(gb)
+            self.gb[...] = gnet.sum(axis=0)
 
         # Gradients on output of previous layer
         gop = gnet.dot(self.w)
@@ -468,15 +533,45 @@ class SoftmaxLayer(GeneralLayer):
         gradients on the net input
         """
 
-        gnet = np.zeros(go.shape)
-        for t in range(0, go.shape[0]):
-            go_t = go[t]
-            gnet_t = gnet[t]
-            tmp_sum = (go_t * self.forward_out[t]).sum()
-            for i in range(0, go_t.shape[0]):
-                gnet_t[i] = self.forward_out[t][i] * (go_t[i] - tmp_sum)
+        tmp_sum = (go * self.forward_out).sum(axis=1).reshape((go.shape[0], 1))
+        return self.forward_out * (go - tmp_sum)
 
-        return gnet
+
+class MaskedSoftmaxLayer(SoftmaxLayer):
+    """
+    Softmax layer whose outputs are restricted to the allowed units of each
+    instance, e.g., the frames of the verb of each sentence. The other units
+    have zero output, so the gradients of SoftmaxLayer on them are zero.
+    """
+    def __init__(self):
+        SoftmaxLayer.__init__(self)
+        self.mask = None
+
+    def set_mask(self, mask):
+        """
+        Set the allowed units of the instances of the following forward passes
+        mask: numpy.ndarray
+            Boolean array with the shape (num_instances, num_outputs). Each
+            instance needs at least one allowed unit. None means all units are
+            allowed
+        """
+
+        if mask is not None and not np.all(np.any(mask, axis=1)):
+            logging.error("Instances %s have no allowed unit"
+                          % np.where(~np.any(mask, axis=1))[0].tolist())
+            raise Exception
+        self.mask = mask
+
+    def net_input_to_out(self, net_input):
+        """
+        Net input to out. Softmax over the allowed units
+        net_input: numpy.ndarray
+            Net input
+        """
+
+        if self.mask is not None:
+            net_input = np.where(self.mask, net_input, -np.inf)
+        return softmax(net_input)
 
 
 class HiddenLayer(GeneralLayer):
@@ -566,42 +661,196 @@ class HiddenLayer(GeneralLayer):
         return forward_out
 
 
+def word_vectors_hash(word2vec):
+    """
+    Return the sha1 of the shape, the type and the values of word2vec
+    """
+
+    word2vec = np.ascontiguousarray(word2vec)
+    hasher = hashlib.sha1()
+    hasher.update(("%s %s" % (word2vec.dtype.str, word2vec.shape)).encode("utf-8"))
+    hasher.update(word2vec.data)
+    return hasher.hexdigest()
+
+
+def store_word_vectors(word2vec, store_dir, digest=None):
+    """
+    Put word2vec into the shared store in store_dir, where each matrix is the
+    file HASH.npy named by word_vectors_hash. Nothing is written if the same
+    matrix is in the store.
+    digest: str
+        word_vectors_hash of word2vec if it is known. None means computing it
+    Return
+    -----
+    str, the file of word2vec in the store
+    """
+
+    try:
+        os.makedirs(store_dir)
+    except OSError:
+        if not os.path.isdir(store_dir):
+            raise Exception("%s is not a directory" % (store_dir,))
+    if digest is None:
+        digest = word_vectors_hash(word2vec)
+    store_file = os.path.join(store_dir, "%s.npy" % digest)
+    if not os.path.exists(store_file):
+        tmp_file = "%s.%s.tmp.npy" % (store_file[0:-len(".npy")], os.getpid())
+        np.save(tmp_file, word2vec)
+        os.rename(tmp_file, store_file)
+        logging.info("Add word vectors %s to the store" % store_file)
+    return store_file
+
+
 class EmbeddingLayer(Layer):
     """
     EmbeddingLayer class
     """
     def __init__(self):
-        pass
-
-    def init_layer(self, word2vec):
+        self.store_dir = None
+        self.word_indexs = None
+        self.oov_index = None
+        self.frozen = False
+        # word2vec and its word_vectors_hash when the layer is frozen
+        self.store_digest = None
+
+    def init_layer(self, word2vec, store_dir=None, frozen=False):
         """
         word2vec: numpy.ndarray, 2d array
             Word vectors. each row represents word vectors.
             E.g., word_vectors = word2vec[word_index]
+        store_dir: str
+            The directory of the shared store of word vectors. If it is given,
+            write_to_files puts word2vec into the store (see
+            store_word_vectors) and only writes a reference to it, so the
+            models with the same (e.g., not updated) word vectors share one
+            file. None means word2vec is written to each model
+        frozen: boolean
+            Whether word2vec is not updated (e.g., up_wordvec is False). The
+            hash of a frozen word2vec for the store is computed only once
         """
 
         self.word2vec = word2vec
+        self.store_dir = store_dir
+        self.frozen = frozen
+        self.word_indexs = None
+        self.oov_index = None
+
+    def local_indexs(self, x):
+        """
+        Map word indexs of the whole vocabulary to the rows of a pruned
+        word2vec (see write_to_files). The words without rows are mapped to
+        the row of oov.
+        x: numpy.ndarray (int), word indexs
+        Return
+        -----
+        numpy.ndarray (int), the rows of x in word2vec
+        """
 
-    def write_to_files(self, target_file):
+        x = np.asarray(x, dtype=np.int64)
+        if self.word_indexs is None:
+            return x
+        pos = np.minimum(np.searchsorted(self.word_indexs, x), len(self.word_indexs) - 1)
+        oov_row = np.searchsorted(self.word_indexs, self.oov_index)
+        return np.where(self.word_indexs[pos] == x, pos, oov_row)
+
+    def write_to_files(self, target_file, word_indexs=None, oov_index=None):
         """Write the word2vec to file
 
-        :target_file: str, the target file
+        :target_file: str, the target file. If the layer has a store, the reference to the store is
+        written to the file with the extension .ref instead.
+        :word_indexs: 1d array like (int), if it is given, only the vectors of these words (e.g., the
+        words of the training data) and oov are written, with the remap table from the word indexs
+        to the rows to the file with the extension .remap.npz. A pruned layer stays pruned when it
+        is written without word_indexs.
+        :oov_index: int, the word index of oov, which is used for the words without vectors in a
+        pruned layer. None means the last row of word2vec.
 
         """
 
-        # Write vectors to file
-        np.savez_compressed(target_file, word2vec=self.word2vec)
+        word2vec = self.word2vec
+        remap = None
+        if word_indexs is not None:
+            if oov_index is None:
+                oov_index = self.oov_index
+            if oov_index is None:
+                oov_index = word2vec.shape[0] - 1
+            word_indexs = np.unique(np.append(np.asarray(word_indexs, dtype=np.int64), oov_index))
+            word2vec = np.ascontiguousarray(self.word2vec[self.local_indexs(word_indexs)])
+            remap = (word_indexs, oov_index)
+        elif self.word_indexs is not None:
+            remap = (self.word_indexs, self.oov_index)
+
+        base_file = os.path.splitext(target_file)[0]
+        ref_file = "%s.ref" % base_file
+        remap_file = "%s.remap.npz" % base_file
+        if self.store_dir is None:
+            # Write vectors to file
+            checkpoint.save_arrays(target_file, word2vec=word2vec)
+            stale_files = [ref_file]
+        else:
+            digest = None
+            if self.frozen and word2vec is self.word2vec:
+                if self.store_digest is None or self.store_digest[0] is not word2vec:
+                    self.store_digest = (word2vec, word_vectors_hash(word2vec))
+                digest = self.store_digest[1]
+            store_file = store_word_vectors(word2vec, self.store_dir, digest)
+            ref_fh = checkpoint.open_file(ref_file, "w")
+            # The relative path works when the models and the store are moved
+            # together, and the absolute one when a model is copied elsewhere
+            json.dump({
+                "store_file": os.path.relpath(store_file, os.path.dirname(os.path.abspath(ref_file))),
+                "store_path": os.path.abspath(store_file),
+                "shape": list(word2vec.shape)
+            }, ref_fh)
+            ref_fh.close()
+            stale_files = [target_file]
+        if remap is not None:
+            checkpoint.save_arrays(remap_file, word_indexs=remap[0], oov_index=remap[1])
+        else:
+            stale_files.append(remap_file)
+        for stale_file in stale_files:
+            if checkpoint.path_exists(stale_file):
+                checkpoint.remove_file(stale_file)
         logging.info("Finish writting %s layer to %s" % (self.__class__.__name__, target_file))
 
     def load_from_files(self, target_file):
         """Write the word2vec to file
 
-        :target_file: str, the target file
+        :target_file: str, the target file. If it refers to the store (see write_to_files), the
+        word vectors in the store are mapped into memory, so the models loaded from the same store
+        share one copy. Updates of word vectors are only seen by this layer.
 
         """
-        # Load parameters file
-        paramters = np.load(target_file)
-        self.word2vec = paramters['word2vec']
+
+        base_file = os.path.splitext(target_file)[0]
+        ref_file = "%s.ref" % base_file
+        if checkpoint.path_exists(ref_file):
+            ref_fh = checkpoint.open_file(ref_file, "r")
+            ref = json.load(ref_fh)
+            ref_fh.close()
+            store_file = os.path.normpath(os.path.join(
+                os.path.dirname(os.path.abspath(ref_file)), ref["store_file"]
+            ))
+            if not os.path.exists(store_file):
+                store_file = ref["store_path"]
+            self.word2vec = np.load(store_file, mmap_mode='c')
+            if list(self.word2vec.shape) != ref["shape"]:
+                logging.error("The shape of %s is not %s" % (store_file, ref["shape"]))
+                raise Exception
+            self.store_dir = os.path.dirname(store_file)
+        else:
+            # Load parameters file
+            paramters = checkpoint.load_arrays(target_file)
+            self.word2vec = paramters['word2vec']
+            self.store_dir = None
+
+        self.word_indexs = None
+        self.oov_index = None
+        remap_file = "%s.remap.npz" % base_file
+        if checkpoint.path_exists(remap_file):
+            remap = checkpoint.load_arrays(remap_file)
+            self.word_indexs = remap['word_indexs']
+            self.oov_index = int(remap['oov_index'])
         logging.info("Finish loading %s layer from %s" % (self.__class__.__name__, target_file))
 
     def forward(self, x, input_opt='regular'):
@@ -622,6 +871,12 @@ class EmbeddingLayer(Layer):
 
         """
 
+        if self.word_indexs is not None:
+            # The word indexs of a pruned layer are the rows of word2vec
+            if input_opt == 'regular':
+                x = self.local_indexs(x)
+            else:
+                x = [self.local_indexs(row) for row in x]
         if input_opt == 'regular':
             vectorized_x = self.word2vec[x].reshape(
                 (x.shape[0], self.word2vec.shape[1] * x.shape[1])
@@ -682,6 +937,39 @@ class EmbeddingLayer(Layer):
         else:
             return (self.vectorized_x, go)
 
+    def sparse_backprop(self, go, gword_vectors=None):
+        """
+        Backprop pass which sums the gradients on the same word vector. Note
+        that it is only based on the last forward pass.
+
+        go: 3d array-like or 2d numpy array(when input_opt is regular)
+            Gradients on the output of current layer.
+        gword_vectors: dict
+            Word index to the gradients on its vector. The gradients of this
+            pass are accumulated into it. If it is None, a new dict is used.
+
+        Return
+        ---------
+        gword_vectors: dict, word index to the gradients on its vector
+        """
+
+        if not hasattr(self, 'x'):
+            logging.error("No forward pass is computed")
+            raise Exception
+        if gword_vectors is None:
+            gword_vectors = {}
+        if self.input_opt == 'regular':
+            # Split each row of go into the gradients on its word vectors
+            word_dim = self.word2vec.shape[1]
+            go = [grow.reshape((len(row), word_dim)) for row, grow in zip(self.x, go)]
+        for row, grow in zip(self.x, go):
+            for word_index, gword_vector in zip(row, grow):
+                if word_index in gword_vectors:
+                    gword_vectors[word_index] += gword_vector
+                else:
+                    gword_vectors[word_index] = np.array(gword_vector, copy=True)
+        return gword_vectors
+
 
 class AttentionLayer(Layer):
 
@@ -786,7 +1074,12 @@ def layer_test():
     funcnorm_layer = FuncNormLayer(x.shape[1], act_func='softmax')
     general_layer = GeneralLayer()
     general_layer.init_layer(n_i=n_i, n_o=n_o, use_bias=use_bias)
-    general_layer_list = [softmax_layer, hidden_layer, general_layer]
+    masked_softmax_layer = MaskedSoftmaxLayer()
+    masked_softmax_layer.init_layer(n_i=n_i, n_o=n_o, use_bias=use_bias)
+    masked_softmax_layer.set_mask(np.random.randint(0, 2, size=(x_num, n_o)) == 1)
+    masked_softmax_layer.mask[:, 0] = True
+    general_layer_list = [softmax_layer, hidden_layer, general_layer,
+                          masked_softmax_layer]
     norm_layer_list = [norm_layer, funcnorm_layer]
 
     gc = GradientChecker()
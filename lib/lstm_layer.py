@@ -14,6 +14,7 @@ import os
 from inc import*
 from gradient_checker import GradientChecker
 from layer import Layer
+import checkpoint
 
 
 class LSTMLayer(Layer):
@@ -57,27 +58,27 @@ class LSTMLayer(Layer):
         """
 
         try:
-            os.makedirs(target_dir)
+            checkpoint.makedirs(target_dir)
         except:
             if not os.path.isdir(target_dir):
                 raise Exception("%s is not a directory" % (target_dir,))
 
         # Write the attributes to file
-        attributes_file = open("%s/attributes.txt" % target_dir, "w")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "w")
         print("%s %s %s %s %s" % (self.n_i, self.n_o, self.act_func, self.use_bias, self.tfloat),
               file=attributes_file)
         attributes_file.close()
 
         # Write paramters to file
         if self.use_bias:
-            np.savez_compressed("%s/parameters.npz" % target_dir, wxi=self.wxi, wxf=self.wxf,
-                                wxc=self.wxc, wxo=self.wxo, whi=self.whi, whc=self.whc,
-                                whf=self.whf, who=self.who, ib=self.ib, fb=self.fb, cb=self.cb,
-                                ob=self.ob)
+            checkpoint.save_arrays("%s/parameters.npz" % target_dir, wxi=self.wxi, wxf=self.wxf,
+                                   wxc=self.wxc, wxo=self.wxo, whi=self.whi, whc=self.whc,
+                                   whf=self.whf, who=self.who, ib=self.ib, fb=self.fb, cb=self.cb,
+                                   ob=self.ob)
         else:
-            np.savez_compressed("%s/parameters.npz" % target_dir, wxi=self.wxi, wxf=self.wxf,
-                                wxc=self.wxc, wxo=self.wxo, whi=self.whi, whc=self.whc,
-                                whf=self.whf, who=self.who)
+            checkpoint.save_arrays("%s/parameters.npz" % target_dir, wxi=self.wxi, wxf=self.wxf,
+                                   wxc=self.wxc, wxo=self.wxo, whi=self.whi, whc=self.whc,
+                                   whf=self.whf, who=self.who)
         logging.info("Finish writting %s layer to %s" % (self.__class__.__name__, target_dir))
 
     def load_from_files(self, target_dir):
@@ -88,7 +89,7 @@ class LSTMLayer(Layer):
         """
 
         # Load attributes file
-        attributes_file = open("%s/attributes.txt" % target_dir, "r")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "r")
         try:
             (n_i, n_o, act_func, use_bias, tfloat) = attributes_file.readline().strip().split(" ")
             self.n_i = int(n_i)
@@ -104,7 +105,7 @@ class LSTMLayer(Layer):
         attributes_file.close()
         
         # Load parameters file
-        paramters = np.load("%s/parameters.npz" % target_dir)
+        paramters = checkpoint.load_arrays("%s/parameters.npz" % target_dir)
         self.wxi = paramters['wxi']
         self.wxf = paramters['wxf']
         self.wxc = paramters['wxc']
@@ -603,41 +604,8 @@ class LSTMLayer(Layer):
             go = inverse_jagged_array(go)
         gop = copy.deepcopy(self.hts)
 
-        # Init gradients on parameters
-        self.gparams = []
-        self.gwxi = np.zeros(self.wxi.shape)
-        self.gparams.append(self.gwxi)
-        if self.use_bias:
-            self.gib = np.zeros(self.ib.shape)
-            self.gparams.append(self.gib)
-
-        self.gwxf = np.zeros(self.wxf.shape)
-        self.gparams.append(self.gwxf)
-        if self.use_bias:
-            self.gfb = np.zeros(self.fb.shape)
-            self.gparams.append(self.gfb)
-
-        self.gwxc = np.zeros(self.wxc.shape)
-        self.gparams.append(self.gwxc)
-        if self.use_bias:
-            self.gcb = np.zeros(self.cb.shape)
-            self.gparams.append(self.gcb)
-
-        self.gwxo = np.zeros(self.wxo.shape)
-        self.gparams.append(self.gwxo)
-        if self.use_bias:
-            self.gob = np.zeros(self.ob.shape)
-            self.gparams.append(self.gob)
-
-        # Gradients on recurrent weights
-        self.gwhi = np.zeros(self.whi.shape)
-        self.gparams.append(self.gwhi)
-        self.gwhc = np.zeros(self.whc.shape)
-        self.gparams.append(self.gwhc)
-        self.gwhf = np.zeros(self.whf.shape)
-        self.gparams.append(self.gwhf)
-        self.gwho = np.zeros(self.who.shape)
-        self.gparams.append(self.gwho)
+        # Zero gradients on parameters
+        self.reset_gparams()
 
         for i in range(0, len(self.hts)):
             ght = np.zeros((self.n_o, ))
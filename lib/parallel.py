@@ -0,0 +1,613 @@
+#! /usr/bin/env python3
+"""
+Authors: fengyukun
+Date: 2016-10-18
+Brief:  Multiprocess training of the models
+"""
+
+# For python2
+from __future__ import print_function
+# Activate automatic float divison for python2.
+from __future__ import division
+import sys
+import copy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import traceback
+from inc import*
+
+
+def shared_array(shape, dtype='float64'):
+    """
+    Allocate an array in shared memory. The array is shared with the
+    processes forked after the allocation.
+    shape: tuple
+        Shape of the array
+    dtype: str or numpy.dtype
+        Type of the array
+    Return
+    -----
+    numpy.ndarray, zero filled
+    """
+
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw_array = multiprocessing.RawArray(np.ctypeslib.as_ctypes_type(dtype), size)
+    return np.frombuffer(raw_array, dtype=dtype).reshape(shape)
+
+
+def shard_bounds(n_samples, n_shards):
+    """
+    Split n_samples samples into at most n_shards contiguous shards. The first
+    n_samples % n_shards shards have one more sample. Empty shards are dropped.
+    n_samples: int
+    n_shards: int
+    Return
+    -----
+    list of (start, end) tuple
+    """
+
+    bounds = []
+    start = 0
+    for rank in range(0, min(n_shards, n_samples)):
+        end = start + int(n_samples / n_shards)
+        if rank < n_samples % n_shards:
+            end += 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def compute_gradients(model, x, y, split_pos=None, micro_batch=None,
+                      up_wordvec=False):
+    """
+    Compute the gradients of model on x. The gradients on parameters are left in
+    model.flat_gparams. The model is not updated.
+    model: ABiRNN, TRNN, RNN or FNN
+        The model with flat parameters
+    x: numpy.ndarray, 2d array or 2d jagged array
+        The input data. The index of words
+    y: numpy.ndarray
+        Normalized correct label of x
+    split_pos: 1d array like
+        split_pos of x. It is only used by the models whose forward pass
+        takes split_pos.
+    micro_batch: int
+        If it is given and smaller than the number of samples in x, x is split
+        into micro batches of this size whose gradients are accumulated. Only
+        the intermediate variables of one micro batch are kept. The
+        accumulated gradients are kept in a buffer of model, which is reused
+        by the following calls.
+    up_wordvec: bool
+        Whether to compute the gradients on word vectors
+    Return
+    -----
+    gword_vectors: dict, word index to the gradients on its vector. Empty if
+    up_wordvec is False
+    """
+
+    if micro_batch is None or micro_batch >= len(x):
+        micro_batch = len(x)
+        acc_flat_gparams = None
+    else:
+        if (not hasattr(model, 'acc_flat_gparams') or
+           model.acc_flat_gparams.shape != model.flat_gparams.shape):
+            model.acc_flat_gparams = np.zeros(model.flat_gparams.shape)
+        else:
+            model.acc_flat_gparams.fill(0)
+        acc_flat_gparams = model.acc_flat_gparams
+    gword_vectors = {}
+
+    for start in range(0, len(x), micro_batch):
+        end = start + micro_batch
+        if split_pos is None:
+            model.forward(x[start:end])
+        else:
+            model.forward(x[start:end], split_pos[start:end])
+        gx = model.backprop(y[start:end])
+        if acc_flat_gparams is not None:
+            acc_flat_gparams += model.flat_gparams
+        if up_wordvec:
+            model.embedding_layer.sparse_backprop(gx, gword_vectors)
+
+    if acc_flat_gparams is not None:
+        model.flat_gparams[...] = acc_flat_gparams
+    return gword_vectors
+
+
+def replicate_model(model, flat_gparams):
+    """
+    Make a replica of model which shares the parameters and the word vectors
+    with model, but has its own layers, so that the intermediate variables of
+    forward and backprop are private. The gradients of the replica are written
+    into flat_gparams.
+    model: ABiRNN, TRNN, RNN or FNN
+        The model with flat parameters
+    flat_gparams: 1d numpy.ndarray
+        The same size as model.flat_params
+    Return
+    -----
+    The replica
+    """
+
+    # The shared arrays are not copied
+    shared = [model.flat_params, model.embedding_layer.word2vec, model.x,
+              model.y, model.label_y]
+    memo = dict([(id(array), array) for array in shared])
+    replica = copy.deepcopy(model, memo)
+    replica.bind_flat_params(model.flat_params)
+    replica.bind_flat_gparams(flat_gparams)
+    return replica
+
+
+def data_parallel_worker(rank, conn, model, shared_params, shared_gparams,
+                         shared_word2vec):
+    """
+    The loop of one worker process of DataParallelTrainer. The worker reads the
+    parameters from shared_params and writes its gradients into
+    shared_gparams[rank] for every job received from conn.
+    """
+
+    model.bind_flat_params(shared_params)
+    model.bind_flat_gparams(shared_gparams[rank])
+    if shared_word2vec is not None:
+        model.embedding_layer.word2vec = shared_word2vec
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        (x, y, split_pos, micro_batch) = job
+        try:
+            gword_vectors = compute_gradients(model, x, y, split_pos,
+                                              micro_batch,
+                                              shared_word2vec is not None)
+            conn.send((True, gword_vectors))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
+def hogwild_worker(rank, conn, model, bounds, split_pos):
+    """
+    The loop of one worker process of HogwildTrainer. The parameters of model
+    are in shared memory. For every epoch received from conn, the worker trains
+    on its shard bounds[rank] of model.x and updates the shared parameters
+    after each minibatch without any lock.
+    """
+
+    (start, end) = bounds[rank]
+    x = model.x[start:end]
+    y = model.y[start:end]
+    if split_pos is not None:
+        split_pos = split_pos[start:end]
+    word2vec = model.embedding_layer.word2vec
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        (lr, minibatch, micro_batch) = job
+        try:
+            for batch_start in range(0, len(x), minibatch):
+                batch_end = batch_start + minibatch
+                batch_split_pos = None
+                if split_pos is not None:
+                    batch_split_pos = split_pos[batch_start:batch_end]
+                gword_vectors = compute_gradients(
+                    model, x[batch_start:batch_end], y[batch_start:batch_end],
+                    batch_split_pos, micro_batch, model.up_wordvec
+                )
+                model.flat_params -= lr * model.flat_gparams
+                for word_index, gword_vector in gword_vectors.items():
+                    word2vec[word_index] -= lr * gword_vector
+            conn.send((True, None))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
+class ProcessTrainer(object):
+    """
+    Base class of the trainers with forked worker processes. Each worker is
+    connected to this process by a pipe. A job sent to a worker is answered by
+    (succeeded, result) where result is the traceback when it failed.
+    """
+    def start_workers(self, n_workers, target, args):
+        """
+        Fork the workers. target is called with (rank, conn) + args in the
+        worker. Since the workers are forked, args are not pickled and the
+        shared memory allocated before is shared with the workers.
+        n_workers: int
+            Number of worker processes
+        target: function
+        args: tuple
+        """
+
+        if n_workers < 1:
+            logging.error("n_workers should be positive: %s" % n_workers)
+            raise Exception
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            logging.error("%s needs the fork start method" % self.__class__.__name__)
+            raise Exception
+
+        self.n_workers = n_workers
+        self.conns = []
+        self.workers = []
+        for rank in range(0, n_workers):
+            (parent_conn, child_conn) = context.Pipe()
+            worker = context.Process(target=target,
+                                     args=(rank, child_conn) + tuple(args))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+    def send_jobs(self, jobs):
+        """
+        Send jobs[rank] to the worker rank and wait for their results.
+        jobs: list
+            At most one job per worker
+        Return
+        -----
+        list, the results of jobs
+        """
+
+        if self.workers is None:
+            logging.error("The trainer has been closed")
+            raise Exception
+        for rank, job in enumerate(jobs):
+            self.conns[rank].send(job)
+        results = []
+        failures = []
+        for rank in range(0, len(jobs)):
+            (succeeded, res) = self.conns[rank].recv()
+            if succeeded:
+                results.append(res)
+            else:
+                failures.append(res)
+        if len(failures) != 0:
+            logging.error("Worker failed:\n%s" % failures[0])
+            raise Exception
+        return results
+
+    def close(self):
+        """
+        Stop the workers
+        """
+
+        if self.workers is None:
+            return
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+            conn.close()
+        for worker in self.workers:
+            worker.join()
+        self.workers = None
+        self.conns = None
+
+
+class DataParallelTrainer(ProcessTrainer):
+    """
+    Synchronous data-parallel training. Each minibatch is split into n_workers
+    shards. Every worker process holds a replica of the model and computes the
+    gradients of one shard. The gradients are summed through shared memory and
+    the model is updated in this process, after which the updated parameters
+    are published to the replicas. The result is the same as batch_train of
+    the model up to the order of floating point sums.
+    The model itself keeps its own parameter buffers. Only the copies in
+    shared memory are seen by the workers.
+    """
+    def __init__(self, model, n_workers):
+        """
+        Init the trainer and start the workers. The workers are forked, so
+        this is only supported on the platforms with fork.
+        model: ABiRNN, TRNN, RNN or FNN
+            The model to train. It must have flat parameters
+        n_workers: int
+            Number of worker processes
+        """
+
+        self.model = model
+        n_params = model.flat_params.shape[0]
+        self.shared_params = shared_array((n_params, ))
+        self.shared_params[...] = model.flat_params
+        self.shared_gparams = shared_array((max(n_workers, 1), n_params))
+        self.shared_word2vec = None
+        if model.up_wordvec:
+            word2vec = model.embedding_layer.word2vec
+            self.shared_word2vec = shared_array(word2vec.shape, word2vec.dtype)
+            self.shared_word2vec[...] = word2vec
+        self.start_workers(n_workers, data_parallel_worker,
+                           (model, self.shared_params, self.shared_gparams,
+                            self.shared_word2vec))
+
+    def batch_train(self, x, y, lr, split_pos=None, micro_batch=None):
+        """
+        Batch training on x given right label y. The arguments are the same as
+        batch_train of the model.
+        x: numpy.ndarray, 2d array or 2d jagged array
+            The input data. The index of words
+        y: numpy.ndarray
+            Normalized correct label of x
+        lr: float
+            Learning rate
+        split_pos: 1d array like
+            split_pos of x. None for the models without split_pos
+        micro_batch: int
+            Micro batch size used by each worker on its shard. None means no
+            split
+        """
+
+        jobs = []
+        for (start, end) in shard_bounds(len(x), self.n_workers):
+            shard_split_pos = None
+            if split_pos is not None:
+                shard_split_pos = split_pos[start:end]
+            jobs.append((x[start:end], y[start:end], shard_split_pos, micro_batch))
+
+        gword_vectors = {}
+        for res in self.send_jobs(jobs):
+            for word_index, gword_vector in res.items():
+                if word_index in gword_vectors:
+                    gword_vectors[word_index] += gword_vector
+                else:
+                    gword_vectors[word_index] = gword_vector
+
+        # Reduce the gradients of workers and update parameters
+        np.sum(self.shared_gparams[0:len(jobs)], axis=0, out=self.model.flat_gparams)
+        self.model.flat_params -= lr * self.model.flat_gparams
+        self.shared_params[...] = self.model.flat_params
+        word2vec = self.model.embedding_layer.word2vec
+        for word_index, gword_vector in gword_vectors.items():
+            word2vec[word_index] -= lr * gword_vector
+            self.shared_word2vec[word_index] = word2vec[word_index]
+
+
+class ThreadParallelTrainer(object):
+    """
+    Data-parallel training with threads in this process. Each minibatch is
+    split into n_threads shards whose gradients are computed by replicas of
+    the model (see replicate_model) in a thread pool. The replicas share the
+    parameters with the model, so no memory is copied except the
+    intermediate variables and the gradients. The gradients are summed before
+    one update, which is the same as batch_train of the model up to the order
+    of floating point sums. The speed-up comes from the numpy calls which
+    release the GIL.
+    """
+    def __init__(self, model, n_threads):
+        """
+        model: ABiRNN, TRNN, RNN or FNN
+            The model to train. It must have flat parameters
+        n_threads: int
+            Number of threads
+        """
+
+        if n_threads < 1:
+            logging.error("n_threads should be positive: %s" % n_threads)
+            raise Exception
+        self.model = model
+        self.n_threads = n_threads
+        self.gparams = np.zeros((n_threads, model.flat_params.shape[0]))
+        self.replicas = [replicate_model(model, self.gparams[i])
+                         for i in range(0, n_threads)]
+        self.pool = ThreadPool(n_threads)
+
+    def batch_train(self, x, y, lr, split_pos=None, micro_batch=None):
+        """
+        Batch training on x given right label y. The arguments are the same as
+        batch_train of the model.
+        x: numpy.ndarray, 2d array or 2d jagged array
+            The input data. The index of words
+        y: numpy.ndarray
+            Normalized correct label of x
+        lr: float
+            Learning rate
+        split_pos: 1d array like
+            split_pos of x. None for the models without split_pos
+        micro_batch: int
+            Micro batch size used by each thread on its shard. None means no
+            split
+        """
+
+        if self.pool is None:
+            logging.error("The trainer has been closed")
+            raise Exception
+
+        jobs = []
+        for rank, (start, end) in enumerate(shard_bounds(len(x), self.n_threads)):
+            shard_split_pos = None
+            if split_pos is not None:
+                shard_split_pos = split_pos[start:end]
+            jobs.append((self.replicas[rank], x[start:end], y[start:end],
+                         shard_split_pos, micro_batch, self.model.up_wordvec))
+        results = self.pool.map(lambda job: compute_gradients(*job), jobs)
+
+        # Reduce the gradients of threads and update parameters
+        np.sum(self.gparams[0:len(jobs)], axis=0, out=self.model.flat_gparams)
+        self.model.flat_params -= lr * self.model.flat_gparams
+        word2vec = self.model.embedding_layer.word2vec
+        for gword_vectors in results:
+            for word_index, gword_vector in gword_vectors.items():
+                word2vec[word_index] -= lr * gword_vector
+
+    def close(self):
+        """
+        Stop the threads
+        """
+
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        self.replicas = None
+
+
+class HogwildTrainer(ProcessTrainer):
+    """
+    Asynchronous (Hogwild) training. The training data of the model is split
+    into n_workers shards. Each worker process trains on its own shard and
+    updates the parameters, and the word vectors if up_wordvec, in shared
+    memory without locks. The workers are synchronized only at the end of each
+    epoch, so the model can be evaluated between epochs.
+    The model is bound to the shared memory until close, which copies the
+    parameters back to the buffers of the model.
+    """
+    def __init__(self, model, n_workers, split_pos=None):
+        """
+        Init the trainer and start the workers. The workers are forked, so
+        this is only supported on the platforms with fork.
+        model: ABiRNN, TRNN, RNN or FNN
+            The model to train. It must have flat parameters. Its x and y are
+            the training data
+        n_workers: int
+            Number of worker processes
+        split_pos: 1d array like
+            split_pos of model.x. None for the models without split_pos
+        """
+
+        self.model = model
+        self.flat_params = model.flat_params
+        self.shared_params = shared_array(model.flat_params.shape)
+        self.shared_params[...] = model.flat_params
+        model.bind_flat_params(self.shared_params)
+        self.word2vec = None
+        if model.up_wordvec:
+            self.word2vec = model.embedding_layer.word2vec
+            shared_word2vec = shared_array(self.word2vec.shape, self.word2vec.dtype)
+            shared_word2vec[...] = self.word2vec
+            model.embedding_layer.word2vec = shared_word2vec
+
+        bounds = shard_bounds(len(model.x), n_workers)
+        self.start_workers(len(bounds), hogwild_worker,
+                           (model, bounds, split_pos))
+
+    def train_epoch(self, lr, minibatch, micro_batch=None):
+        """
+        Let each worker go through its shard once
+        lr: float
+            Learning rate
+        minibatch: int
+            Mini batch size
+        micro_batch: int
+            Micro batch size. None means no split
+        """
+
+        self.send_jobs([(lr, minibatch, micro_batch)] * self.n_workers)
+
+    def close(self):
+        """
+        Stop the workers and move the parameters back to the buffers of the
+        model. The word vectors are copied back to the original array.
+        """
+
+        if self.workers is None:
+            return
+        ProcessTrainer.close(self)
+        self.flat_params[...] = self.shared_params
+        self.model.bind_flat_params(self.flat_params)
+        if self.word2vec is not None:
+            self.word2vec[...] = self.model.embedding_layer.word2vec
+            self.model.embedding_layer.word2vec = self.word2vec
+
+
+PARALLEL_METHODS = ['sync', 'hogwild', 'thread', 'param_server']
+
+
+def make_trainer(model, n_workers, method, split_pos=None, address=None,
+                 authkey=None):
+    """
+    Choose the trainer of minibatch_train of the models
+    model: ABiRNN, TRNN, RNN or FNN
+        The model to train. Its x and y are the training data
+    n_workers: int
+        Number of workers. 1 means training in this process, except for
+        'param_server'
+    method: str, four options are:
+        'sync': Synchronous data parallelism over each minibatch, see
+        DataParallelTrainer.
+        'hogwild': The training data is split among the processes which
+        update the shared parameters asynchronously without locks, see
+        HogwildTrainer.
+        'thread': Like 'sync', but n_workers threads in this process compute
+        the gradients, see ThreadParallelTrainer.
+        'param_server': Used for any n_workers. n_workers processes train on
+        their shards of x, pulling the parameters from and pushing the
+        gradients to a server in this process over TCP, see
+        param_server.ParamServerTrainer.
+    split_pos: 1d array like
+        split_pos of model.x. None for the models without split_pos
+    address: tuple
+        (host, port) where the parameter server waits for n_workers remote
+        workers. Only used by 'param_server'
+    authkey: str
+        The secret key of the parameter server and its remote workers, see
+        param_server.ParamServerTrainer
+    Return
+    -----
+    The model itself when it trains in this process, otherwise the trainer,
+    which must be closed. The trainers of 'hogwild' and 'param_server' train
+    by train_epoch, the others by batch_train.
+    """
+
+    if method not in PARALLEL_METHODS:
+        logging.error("Unknown parallel method argument: %s" % method)
+        raise Exception
+    if method == 'param_server':
+        # param_server imports this module
+        from param_server import ParamServerTrainer
+        return ParamServerTrainer(model, n_workers, split_pos, address, authkey)
+    if n_workers <= 1:
+        return model
+    if method == 'sync':
+        return DataParallelTrainer(model, n_workers)
+    if method == 'thread':
+        return ThreadParallelTrainer(model, n_workers)
+    # The parameters are in shared memory until trainer is closed
+    return HogwildTrainer(model, n_workers, split_pos)
+
+
+def parallel_test():
+    sys.path.append("../models/")
+    from abirnn import ABiRNN
+
+    def train(method, n_workers):
+        np.random.seed(1)
+        x = np.array(make_jagged_array(31, 3, 7, 20), dtype=object)
+        label_y = np.random.randint(0, 4, size=31)
+        word2vec = np.random.uniform(-1, 1, size=(20, 4))
+        split_pos = [1] * 31
+        model = ABiRNN()
+        model.init(x, label_y, word2vec, 5, up_wordvec=True, use_lstm=True)
+        model.minibatch_train(0.1, 7, 5, split_pos, training_method='fixed',
+                              n_workers=n_workers, parallel_method=method)
+        return (np.concatenate([model.flat_params, word2vec.ravel()]),
+                model.cost(x, model.y, split_pos))
+
+    (params, cost) = train('sync', 1)
+    print("single process, cost: %f" % cost)
+    # The synchronous trainers sum the same gradients, so only the rounding
+    # differs from the training in one process
+    for method in ['sync', 'thread']:
+        (method_params, method_cost) = train(method, 3)
+        print("%s, cost: %f, max parameter difference: %g"
+              % (method, method_cost, np.abs(method_params - params).max()))
+    (_, hogwild_cost) = train('hogwild', 3)
+    print("hogwild (asynchronous), cost: %f" % hogwild_cost)
+
+
+if __name__ == "__main__":
+    parallel_test()
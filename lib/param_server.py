@@ -0,0 +1,350 @@
+#! /usr/bin/env python3
+"""
+Authors: fengyukun
+Date: 2016-10-18
+Brief:  Parameter server training over TCP. The server keeps the parameters
+of the model. Each worker, on this machine or another one, trains on its shard
+of the training data: it pulls the parameters and the word vectors of the
+minibatch, computes the gradients and pushes them to the server, which updates
+the parameters.
+"""
+
+# For python2
+from __future__ import print_function
+# Activate automatic float divison for python2.
+from __future__ import division
+import os
+import sys
+import copy
+import time
+import select
+import binascii
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.connection import Listener
+from multiprocessing.connection import Client
+from inc import*
+from parallel import shard_bounds
+from parallel import compute_gradients
+
+# Hosts whose workers can only be on this machine
+LOOPBACK_HOSTS = ["127.0.0.1", "localhost", "::1"]
+# Seconds between the checks of the local workers while waiting for them
+ACCEPT_POLL_INTERVAL = 1.0
+
+
+def new_authkey():
+    """
+    Return a random key of the connections, which is printable for passing
+    it to the workers
+    """
+
+    return binascii.hexlify(os.urandom(16))
+
+
+def as_authkey(authkey):
+    if not isinstance(authkey, bytes):
+        authkey = authkey.encode("utf-8")
+    return authkey
+
+
+def model_skeleton(model, start, end):
+    """
+    Copy model for a worker. The training data is cut to [start, end) and the
+    word vectors are dropped, since the worker pulls them from the server.
+    """
+
+    memo = {
+        id(model.x): model.x[start:end],
+        id(model.y): model.y[start:end],
+        id(model.label_y): model.label_y[start:end],
+        id(model.embedding_layer.word2vec): None
+    }
+    return copy.deepcopy(model, memo)
+
+
+class ParamServerTrainer(object):
+    """
+    Training with a parameter server in this process. The training data of the
+    model is split into n_workers shards. On start each worker receives a copy
+    of the model with its shard, so a remote worker only needs the address of
+    the server (see run_param_worker). In each epoch the workers go through
+    their shards asynchronously and the server applies every pushed gradient
+    under a lock. The gradients on word vectors are pushed as sparse rows.
+    """
+    def __init__(self, model, n_workers, split_pos=None, address=None,
+                 authkey=None):
+        """
+        Start the server and wait for n_workers workers.
+        model: ABiRNN, TRNN, RNN or FNN
+            The model to train. It must have flat parameters. Its x and y are
+            the training data
+        n_workers: int
+            Number of workers
+        split_pos: 1d array like
+            split_pos of model.x. None for the models without split_pos
+        address: tuple
+            (host, port) where the server listens for the workers started by
+            run_param_worker. None means the workers are forked in this machine
+            and connect over loopback
+        authkey: bytes or str
+            The secret key of the connections. The workers unpickle what the
+            server sends and the other way round, so anyone with the key can
+            run code on them. It is needed when address is not on loopback.
+            None means a random key (see new_authkey), which is logged for the
+            workers when address is given
+        """
+
+        if n_workers < 1:
+            logging.error("n_workers should be positive: %s" % n_workers)
+            raise Exception
+        if authkey is None:
+            if address is not None and address[0] not in LOOPBACK_HOSTS:
+                logging.error("A secret authkey is needed for the workers at %s:%s"
+                              % (address[0], address[1]))
+                raise Exception
+            authkey = new_authkey()
+            if address is not None:
+                logging.info("The key of the workers is %s" % authkey.decode("ascii"))
+        authkey = as_authkey(authkey)
+        self.model = model
+        self.lock = threading.Lock()
+        self.local_workers = []
+        listen_address = address
+        if address is None:
+            listen_address = ('127.0.0.1', 0)
+        self.listener = Listener(listen_address, authkey=authkey)
+        self.address = self.listener.address
+
+        if address is None:
+            try:
+                context = multiprocessing.get_context('fork')
+            except ValueError:
+                logging.error("Local workers need the fork start method")
+                raise Exception
+            for rank in range(0, n_workers):
+                worker = context.Process(target=run_param_worker,
+                                         args=(self.address, authkey))
+                worker.daemon = True
+                worker.start()
+                self.local_workers.append(worker)
+        else:
+            logging.info("Waiting for %d workers at %s:%s"
+                         % (n_workers, self.address[0], self.address[1]))
+
+        word2vec = model.embedding_layer.word2vec
+        bounds = shard_bounds(len(model.x), n_workers)
+        self.conns = []
+        for rank in range(0, n_workers):
+            conn = self.accept_worker()
+            (start, end) = (0, 0)
+            if rank < len(bounds):
+                (start, end) = bounds[rank]
+            shard_split_pos = None
+            if split_pos is not None:
+                shard_split_pos = split_pos[start:end]
+            conn.send((model_skeleton(model, start, end), shard_split_pos,
+                       word2vec.shape, word2vec.dtype.str))
+            self.conns.append(conn)
+
+    def accept_worker(self):
+        """
+        Wait for the connection of the next worker. The local workers are
+        checked while waiting, so a worker which exits before it connects is
+        an error instead of a hang
+        """
+
+        sock = self.listener._listener._socket
+        while len(self.local_workers) != 0:
+            (readable, _, _) = select.select([sock], [], [], ACCEPT_POLL_INTERVAL)
+            if len(readable) != 0:
+                break
+            exit_codes = [worker.exitcode for worker in self.local_workers
+                          if not worker.is_alive()]
+            if len(exit_codes) != 0:
+                for worker in self.local_workers:
+                    worker.terminate()
+                    worker.join()
+                self.listener.close()
+                logging.error("Local workers exited before connecting to the "
+                              "server, exit codes: %s" % exit_codes)
+                raise Exception
+        return self.listener.accept()
+
+    def serve(self, conn, lr, errors):
+        """
+        Serve the requests of one worker until its epoch is done
+        """
+
+        word2vec = self.model.embedding_layer.word2vec
+        try:
+            while True:
+                request = conn.recv()
+                if request[0] == 'pull':
+                    word_indexs = request[1]
+                    with self.lock:
+                        flat_params = np.copy(self.model.flat_params)
+                        rows = word2vec[word_indexs]
+                    conn.send((flat_params, rows))
+                elif request[0] == 'push':
+                    (_, flat_gparams, word_indexs, gword_vectors) = request
+                    with self.lock:
+                        self.model.flat_params -= lr * flat_gparams
+                        if len(word_indexs) != 0:
+                            word2vec[word_indexs] -= lr * gword_vectors
+                elif request[0] == 'done':
+                    return
+                else:
+                    errors.append(request[1])
+                    return
+        except Exception:
+            errors.append(traceback.format_exc())
+
+    def train_epoch(self, lr, minibatch, micro_batch=None):
+        """
+        Let each worker go through its shard once
+        lr: float
+            Learning rate
+        minibatch: int
+            Mini batch size
+        micro_batch: int
+            Micro batch size. None means no split
+        """
+
+        if self.conns is None:
+            logging.error("The trainer has been closed")
+            raise Exception
+        errors = []
+        threads = []
+        for conn in self.conns:
+            conn.send(('epoch', minibatch, micro_batch))
+            thread = threading.Thread(target=self.serve, args=(conn, lr, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if len(errors) != 0:
+            logging.error("Worker failed:\n%s" % errors[0])
+            raise Exception
+
+    def close(self):
+        """
+        Stop the workers and the server
+        """
+
+        if self.conns is None:
+            return
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+            conn.close()
+        self.listener.close()
+        for worker in self.local_workers:
+            worker.join()
+        self.conns = None
+
+
+def run_param_worker(address, authkey):
+    """
+    Run a worker of ParamServerTrainer until the server closes.
+    address: tuple
+        (host, port) of the server
+    authkey: bytes or str
+        The secret key of the server
+    """
+
+    conn = Client(tuple(address), authkey=as_authkey(authkey))
+    (model, split_pos, word2vec_shape, word2vec_dtype) = conn.recv()
+    # Only the rows pulled from the server are filled
+    word2vec = np.zeros(shape=word2vec_shape, dtype=np.dtype(word2vec_dtype))
+    model.embedding_layer.word2vec = word2vec
+    model.init_flat_params()
+    x = model.x
+    y = model.y
+
+    while True:
+        try:
+            command = conn.recv()
+        except EOFError:
+            break
+        if command is None:
+            break
+        (_, minibatch, micro_batch) = command
+        try:
+            for start in range(0, len(x), minibatch):
+                end = start + minibatch
+                batch_split_pos = None
+                if split_pos is not None:
+                    batch_split_pos = split_pos[start:end]
+                word_indexs = batch_word_indexs(x[start:end])
+                conn.send(('pull', word_indexs))
+                (flat_params, rows) = conn.recv()
+                model.flat_params[...] = flat_params
+                word2vec[word_indexs] = rows
+                gword_vectors = compute_gradients(
+                    model, x[start:end], y[start:end], batch_split_pos,
+                    micro_batch, model.up_wordvec
+                )
+                gword_indexs = np.array(list(gword_vectors.keys()),
+                                        dtype=np.int64)
+                gword_rows = np.array([gword_vectors[i] for i in gword_indexs])
+                conn.send(('push', model.flat_gparams, gword_indexs, gword_rows))
+            conn.send(('done', ))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+
+def param_server_test():
+    sys.path.append("../models/")
+    from abirnn import ABiRNN
+
+    def train(method, n_workers, address=None, authkey=None):
+        np.random.seed(1)
+        x = np.array(make_jagged_array(31, 3, 7, 20), dtype=object)
+        label_y = np.random.randint(0, 4, size=31)
+        word2vec = np.random.uniform(-1, 1, size=(20, 4))
+        split_pos = [1] * 31
+        model = ABiRNN()
+        model.init(x, label_y, word2vec, 5, up_wordvec=True, use_lstm=True)
+        model.minibatch_train(0.1, 7, 5, split_pos, training_method='fixed',
+                              n_workers=n_workers, parallel_method=method,
+                              server_address=address, server_authkey=authkey)
+        return (np.concatenate([model.flat_params, word2vec.ravel()]),
+                model.cost(x, model.y, split_pos))
+
+    def remote_worker(address, authkey):
+        # Retry until the server listens
+        for attempt in range(0, 100):
+            try:
+                run_param_worker(address, authkey)
+                return
+            except (IOError, OSError):
+                time.sleep(0.1)
+
+    (params, cost) = train('sync', 1)
+    print("single process, cost: %f" % cost)
+    # One worker does the same updates in the same order as one process
+    (server_params, server_cost) = train('param_server', 1)
+    print("one local worker, cost: %f, max parameter difference: %g"
+          % (server_cost, np.abs(server_params - params).max()))
+    address = ('127.0.0.1', 47600)
+    authkey = new_authkey()
+    worker = multiprocessing.get_context('fork').Process(target=remote_worker,
+                                                         args=(address, authkey))
+    worker.start()
+    (server_params, server_cost) = train('param_server', 1, address, authkey)
+    worker.join()
+    print("one remote worker, cost: %f, max parameter difference: %g"
+          % (server_cost, np.abs(server_params - params).max()))
+    (_, server_cost) = train('param_server', 3)
+    print("three local workers (asynchronous), cost: %f" % server_cost)
+
+
+if __name__ == "__main__":
+    param_server_test()
@@ -158,10 +158,7 @@ class RecurrentLayer(HiddenLayer):
             raise Exception
 
         gop = copy.copy(self.x)
-        self.gw = np.zeros(shape=self.w.shape)
-        if self.use_bias:
-            self.gb = np.zeros(shape=self.b.shape)
-        self.grw = np.zeros(shape=self.rw.shape)
+        self.reset_gparams()
         for t in range(0, len(self.forward_out)):
             previous_grad = np.zeros(shape=(self.n_o, ))
             start = len(self.forward_out[t]) - 1
@@ -189,11 +186,6 @@ class RecurrentLayer(HiddenLayer):
                 gop[t][i] = self.w.T.dot(gnet)
                 previous_grad = self.rw.T.dot(gnet)
 
-        self.gparams = [self.gw]
-        if self.use_bias:
-            self.gparams.append(self.gb)
-        self.gparams.append(self.grw)
-
         return gop
 
 
@@ -16,20 +16,24 @@ sys.path.append("../utils/")
 from inc import*
 from gradient_checker import GradientChecker
 import layer
+import checkpoint
 import metrics
 import birecurrent_layer
 from layer import FuncNormLayer
 from layer import AttentionLayer
+from parallel import make_trainer
+from parallel import compute_gradients
 import copy
 
 
-class ABiRNN(object):
+class ABiRNN(FlatParamsMixin):
     """
     Attention-based Bidirectional Recurrent Neural Network (ABiRNN) class
     """
     def init(self, x, label_y, word2vec, n_h, up_wordvec=False,
              use_bias=True, act_func='tanh',
-             use_lstm=True, norm_func='softmax', global_independent=False):
+             use_lstm=True, norm_func='softmax', global_independent=False,
+             pretrained_dir=None, embedding_store=None):
         """
         Init ABRiNN
         x: numpy.ndarray, 2d jagged arry
@@ -58,6 +62,18 @@ class ABiRNN(object):
             together with x.
             False: the global infomation inx will be treated equally as all x.
             The position of global infomation is specified by split_pos
+        pretrained_dir: str
+            The directory of a trained model (e.g., written by write_to_files
+            after training on a larger corpus). If it is given, the
+            bidirectional recurrent layer starts from the parameters of that
+            model and only the output layer is initialized randomly for the
+            labels of x. The layer of that model should have the same n_i,
+            n_h, act_func, use_bias and use_lstm. None means random init
+        embedding_store: str
+            The directory of the shared store of word vectors. If it is given,
+            write_to_files only writes a reference to the word vectors in the
+            store (see layer.EmbeddingLayer). None means the word vectors are
+            written to the model directory
         """
 
         self.x = x
@@ -86,7 +102,7 @@ class ABiRNN(object):
 
         # Init layers
         self.embedding_layer = layer.EmbeddingLayer()
-        self.embedding_layer.init_layer(self.word2vec)
+        self.embedding_layer.init_layer(self.word2vec, embedding_store, not up_wordvec)
         self.layers = []
         self.params = []
         self.param_names = []
@@ -97,6 +113,8 @@ class ABiRNN(object):
                                   act_func=self.act_func,
                                   use_bias=self.use_bias,
                                   use_lstm=self.use_lstm)
+        if pretrained_dir is not None:
+            self.load_pretrained_layer(pretrained_dir)
 
         self.params += self.bir_layer.params
         self.param_names += self.bir_layer.param_names
@@ -110,23 +128,61 @@ class ABiRNN(object):
                                  use_bias=self.use_bias)
         self.params += self.softmax_layer.params
         self.param_names += self.softmax_layer.param_names
+        self.init_flat_params()
 
-    def write_to_files(self, target_dir):
+    def load_pretrained_layer(self, pretrained_dir):
+        """
+        Replace the bidirectional recurrent layer by the one of the trained
+        model in pretrained_dir. The attention layer has no parameters, so the
+        attention of the trained model comes with the recurrent layer.
+        pretrained_dir: str
+            The directory of a model written by write_to_files
+        """
+
+        bir_layer = birecurrent_layer.BiRecurrentLayer()
+        bir_layer.load_from_files(
+            "%s/%s" % (pretrained_dir, bir_layer.__class__.__name__)
+        )
+        attributes = ["n_i", "act_func", "use_bias", "use_lstm"]
+        expected = [self.n_i, self.act_func, self.use_bias, self.use_lstm]
+        loaded = [getattr(bir_layer, name) for name in attributes]
+        attributes.append("n_h")
+        expected.append(self.n_h)
+        loaded.append(bir_layer.n_o)
+        if loaded != expected:
+            logging.error("The layer in %s does not match the model. "
+                          "%s: %s (expected %s)"
+                          % (pretrained_dir, attributes, loaded, expected))
+            raise Exception
+        self.bir_layer = bir_layer
+
+    def param_layers(self):
+        """
+        Return the layers holding self.params, see FlatParamsMixin
+        """
+
+        return [self.bir_layer, self.softmax_layer]
+
+    def write_to_files(self, target_dir, prune_embedding=False, oov_index=None):
         """Write the attributes and the parameters to files
 
         :target_dir: str, a directory where the attribute file and paramter file are. A directory
         will be created if the target_dir does not exist.
+        :prune_embedding: bool, whether only the vectors of the words in the training data and oov
+        are written (see layer.EmbeddingLayer.write_to_files). The words of other data are mapped to
+        oov by the loaded model. A loaded model has no training data and keeps its vectors.
+        :oov_index: int, the word index of oov. None means the last row of word2vec.
 
         """
 
         try:
-            os.makedirs(target_dir)
+            checkpoint.makedirs(target_dir)
         except:
             if not os.path.isdir(target_dir):
                 raise Exception("%s is not a directory" % (target_dir,))
 
         # Write the attributes to file
-        attributes_file = open("%s/attributes.txt" % target_dir, "w")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "w")
         print("%s %s %s %s %s %s %s %s %s" % (self.n_i, self.n_o, self.act_func, self.use_bias,
               self.use_lstm, self.n_h, self.up_wordvec, self.norm_func, self.global_independent),
               file=attributes_file)
@@ -135,7 +191,11 @@ class ABiRNN(object):
         attributes_file.close()
 
         # Write paramters to file
-        self.embedding_layer.write_to_files("%s/embedding_out.npz" % (target_dir,))
+        word_indexs = None
+        if prune_embedding and getattr(self, 'x', None) is not None:
+            word_indexs = batch_word_indexs(self.x)
+        self.embedding_layer.write_to_files("%s/embedding_out.npz" % (target_dir,),
+                                            word_indexs, oov_index)
         bilayer_dir = "%s/%s" % (target_dir, self.bir_layer.__class__.__name__)
         self.bir_layer.write_to_files(bilayer_dir)
         softmax_target_dir = "%s/%s" % (target_dir, self.softmax_layer.__class__.__name__)
@@ -150,7 +210,7 @@ class ABiRNN(object):
         """
 
         # Load attributes file
-        attributes_file = open("%s/attributes.txt" % target_dir, "r")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "r")
         try:
             (n_i, n_o, act_func, use_bias, use_lstm, n_h, up_wordvec,
              norm_func, global_independent) = (attributes_file.readline().strip().split(" "))
@@ -188,6 +248,7 @@ class ABiRNN(object):
 
         self.embedding_layer = layer.EmbeddingLayer()
         self.embedding_layer.load_from_files("%s/embedding_out.npz" % (target_dir,))
+        self.embedding_layer.frozen = not self.up_wordvec
 
         self.layers = []
         self.params = []
@@ -207,6 +268,7 @@ class ABiRNN(object):
         self.softmax_layer.load_from_files(softmax_target_dir)
         self.params += self.softmax_layer.params
         self.param_names += self.softmax_layer.param_names
+        self.init_flat_params()
 
         logging.info("Finish loading %s from %s" % (self.__class__.__name__, target_dir))
 
@@ -285,7 +347,7 @@ class ABiRNN(object):
         self.gparams = self.bir_layer.gparams + self.gparams
         return gx
 
-    def batch_train(self, x, y, lr, split_pos):
+    def batch_train(self, x, y, lr, split_pos, micro_batch=None):
         """
         Batch training on x given right label y
         x: numpy.ndarray, 2d arry
@@ -300,12 +362,24 @@ class ABiRNN(object):
             and the right_layer will compute from split_pos to last.
             If split_pos is None, split_pos will
             be the half of current row of x.
+        micro_batch: int
+            If it is given and smaller than the number of samples in x, x is
+            split into micro batches whose gradients are accumulated before a
+            single update on parameters. Only the intermediate variables of one
+            micro batch are kept, while the update is the same as on whole x.
         """
+        if micro_batch is not None and micro_batch < len(x):
+            gword_vectors = compute_gradients(self, x, y, split_pos,
+                                              micro_batch, self.up_wordvec)
+            # Update parameters
+            self.flat_params -= lr * self.flat_gparams
+            for word_index, gword_vector in gword_vectors.items():
+                self.embedding_layer.word2vec[word_index] -= lr * gword_vector
+            return
         self.forward(x, split_pos)
         gx = self.backprop(y)
         # Update parameters
-        for gparam, param in zip(self.gparams, self.params):
-            param -= lr * gparam
+        self.flat_params -= lr * self.flat_gparams
         if self.up_wordvec:
             (vectorized_x, go) = self.embedding_layer.backprop(gx)
             for i in range(0, len(vectorized_x)):
@@ -315,7 +389,12 @@ class ABiRNN(object):
     def minibatch_train(self, lr=0.1, minibatch=5, max_epochs=100,
                         split_pos=None, verbose=False,
                         training_method='dynamic', stable_method='zero_one_loss',
-                        is_write_to_file=False, target_dir=None, freq=None):
+                        is_write_to_file=False, target_dir=None, freq=None,
+                        valid_x=None, valid_label_y=None, valid_split_pos=None,
+                        valid_freq=1, patience=None, micro_batch=None,
+                        n_workers=1, parallel_method='sync',
+                        server_address=None, server_authkey=None, background_write=True,
+                        resume=False):
         """
         Minibatch training over x. Training will be stopped when the zero-one
         loss is zero on x.
@@ -344,12 +423,65 @@ class ABiRNN(object):
         is_write_to_file:, bool, whether write models to file in a real time. 
         target_dir: model is saved in target_dir if is_write_to_file is True
         freq: int, save the model every freq epoch
+        valid_x: numpy.ndarray, 2d jagged array
+            Validation data. If it is given, the zero-one loss on it is
+            computed every valid_freq epochs, the parameters with the lowest
+            loss are kept in memory and restored when the training ends.
+        valid_label_y: numpy.ndarray, 1d array
+            The right label of valid_x
+        valid_split_pos: 1d array like
+            split_pos of valid_x
+        valid_freq: int, evaluate on valid_x every valid_freq epoch
+        patience: int
+            Stop the training when the validation loss is not improved for
+            patience evaluations. None means no early stopping
+        micro_batch: int
+            Split each minibatch into micro batches of this size whose
+            gradients are accumulated. None means no split
+        n_workers: int
+            Number of processes among which each minibatch is split. The
+            gradients of the shards are summed before one update, see
+            parallel.DataParallelTrainer. 1 means training in this process
+        parallel_method: str
+            'sync', 'hogwild', 'thread' or 'param_server'. See
+            parallel.make_trainer
+        server_address: tuple
+            (host, port) where the parameter server waits for n_workers remote
+            workers started by param_server.run_param_worker. None means the
+            workers are started on this machine
+        server_authkey: str
+            The secret key of the parameter server, which the remote workers
+            pass to run_param_worker. It is needed unless server_address is on
+            loopback
+        background_write: bool
+            Whether the models are written by a background thread while the
+            training goes on (see checkpoint.AsyncCheckpointWriter). The last
+            model is written before minibatch_train returns
+        resume: bool
+            Whether to continue the training whose model and training state
+            (the epoch, the learning rate, the counters of the stopping rules,
+            the best validation snapshot and the state of numpy.random) were
+            written to target_dir, see checkpoint.resume_training. The data
+            and the other arguments should be the same as the interrupted
+            call. The training starts from the beginning if there is no state
         Return
         ----
         train_epoch: int
             The epoch number during traing on train data
         """
 
+        state = None
+        if resume:
+            if target_dir is None:
+                logging.error("target_dir is needed to resume the training")
+                raise Exception
+            state = checkpoint.resume_training(self, target_dir)
+            if state is not None and state["finished"]:
+                logging.info("The training in %s is finished" % target_dir)
+                if "best_epoch" in state:
+                    self.best_epoch = state["best_epoch"]
+                return state["epoch"]
+
         if training_method not in ['dynamic', 'fixed']:
             logging.error("Unknown training method argument: %s" % training_method)
             raise Exception
@@ -366,90 +498,226 @@ class ABiRNN(object):
             stable_max_times = 3
             stable_times = 0
 
-        for epoch in range(1, max_epochs + 1):
-            n_batches = int(self.y.shape[0] / minibatch)
-            batch_i = 0
-            for batch_i in range(0, n_batches):
-                self.batch_train(
-                    self.x[batch_i * minibatch:(batch_i + 1) * minibatch],
-                    self.y[batch_i * minibatch:(batch_i + 1) * minibatch],
-                    lr,
-                    split_pos[batch_i * minibatch:(batch_i + 1) * minibatch]
-                )
-            # Train the rest if it has
-            if n_batches * minibatch != self.y.shape[0]:
-                self.batch_train(
-                    self.x[(batch_i + 1) * minibatch:],
-                    self.y[(batch_i + 1) * minibatch:],
-                    lr,
-                    split_pos[(batch_i + 1) * minibatch:]
-                )
-            label_preds = self.predict(self.x, split_pos)
-            error = metrics.zero_one_loss(self.label_y, label_preds)
-            cost = self.cost(self.x, self.y, split_pos)
-            if verbose:
-                logging.info("epoch: %d training,on train data, "
-                             "cross-entropy:%f, zero-one loss: %f"
-                             % (epoch, cost, error))
+        trainer = make_trainer(self, n_workers, parallel_method, split_pos, server_address,
+                               server_authkey)
 
-            if is_write_to_file and epoch % freq == 0:
-                if verbose:
-                    logging.info("write models to %s" % target_dir)
-                self.write_to_files(target_dir)
+        use_validation = valid_x is not None and len(valid_x) > 0
+        if use_validation:
+            early_stopping = EarlyStopping(self, patience)
+            self.best_epoch = 0
 
+        def training_state(epoch, finished=False):
+            # The state after epoch, which is written with the model
+            state = {"epoch": epoch, "lr": lr, "finished": finished}
             if training_method == 'dynamic':
-                # The first epoch
-                if last_cost is None:
-                    last_cost = cost
-                    continue
-                # If the cost is stable for stable_max_times within stable_threshold,
-                # the training is stopped.
-                if stable_method == 'cost_stable':
-                    if abs(cost - last_cost) <= stable_threshold:
-                        stable_times += 1
-                        if verbose:
-                            logging.info("The cost is continuously stable for %s times" % stable_times)
-                        if stable_times >= stable_max_times:
-                            break
-                    else:
-                        stable_times = 0
-                if stable_method == 'zero_one_loss':
-                    if abs(error - 0.0) <= 0.0001:
+                state.update({"last_cost": last_cost, "stable_times": stable_times})
+            if use_validation:
+                state.update(early_stopping.state())
+            return state
+
+        start_epoch = 1
+        if state is not None:
+            start_epoch = state["epoch"] + 1
+            lr = state["lr"]
+            if training_method == 'dynamic':
+                last_cost = state["last_cost"]
+                stable_times = state["stable_times"]
+            if use_validation:
+                early_stopping.load_state(state)
+                self.best_epoch = early_stopping.best_epoch
+            np.random.set_state(state["random_state"])
+            logging.info("Resume the training from epoch %d" % start_epoch)
+
+        model_writer = checkpoint.AsyncCheckpointWriter()
+        epoch = start_epoch - 1
+        try:
+            for epoch in range(start_epoch, max_epochs + 1):
+                # The model is written at the start of the next epoch, when the
+                # training state (e.g., the learning rate) of its epoch is final
+                if is_write_to_file and epoch > start_epoch and (epoch - 1) % freq == 0:
+                    if verbose:
+                        logging.info("write models to %s" % target_dir)
+                    model_writer.write(self, target_dir, training_state=training_state(epoch - 1))
+                    if not background_write:
+                        model_writer.wait()
+
+                if trainer is not self and parallel_method in ['hogwild', 'param_server']:
+                    trainer.train_epoch(lr, minibatch, micro_batch)
+                else:
+                    n_batches = int(self.y.shape[0] / minibatch)
+                    batch_i = 0
+                    for batch_i in range(0, n_batches):
+                        trainer.batch_train(
+                            self.x[batch_i * minibatch:(batch_i + 1) * minibatch],
+                            self.y[batch_i * minibatch:(batch_i + 1) * minibatch],
+                            lr,
+                            split_pos[batch_i * minibatch:(batch_i + 1) * minibatch],
+                            micro_batch
+                        )
+                    # Train the rest if it has
+                    if n_batches * minibatch != self.y.shape[0]:
+                        trainer.batch_train(
+                            self.x[(batch_i + 1) * minibatch:],
+                            self.y[(batch_i + 1) * minibatch:],
+                            lr,
+                            split_pos[(batch_i + 1) * minibatch:],
+                            micro_batch
+                        )
+                label_preds = self.predict(self.x, split_pos)
+                error = metrics.zero_one_loss(self.label_y, label_preds)
+                cost = self.cost(self.x, self.y, split_pos)
+                if verbose:
+                    logging.info("epoch: %d training,on train data, "
+                                 "cross-entropy:%f, zero-one loss: %f"
+                                 % (epoch, cost, error))
+
+                if use_validation and epoch % valid_freq == 0:
+                    valid_preds = self.predict(valid_x, valid_split_pos)
+                    valid_error = metrics.zero_one_loss(valid_label_y, valid_preds)
+                    stop = early_stopping.update(epoch, valid_error, verbose)
+                    self.best_epoch = early_stopping.best_epoch
+                    if stop:
                         break
 
-                # Dynamically adjust the learning rate.
-                # If cost is reduced bigger than reduced_percentage, the learning rate is increased
-                # by increased_percentage.
-                reduced_percentage = 0.10
-                increased_percentage = 0.05
-                diff = last_cost - cost
-                if (diff > 0 and (diff / last_cost) >= reduced_percentage):
-                    lr *= (1 + increased_percentage)
-                    if verbose:
-                        logging.info("The cost has been reduced by more than %s. Learning rate "\
-                                "is increased to %s" % (reduced_percentage, lr))
-                # If cost is actually increasing by cost_dec_percentage, decrease the learning rate
-                # by decrease_percentage
-                decrease_percentage = 0.05
-                cost_dec_percentage = 0.05
-                if diff < 0 and abs(diff) / last_cost >= cost_dec_percentage:
-                    lr *= (1 - decrease_percentage) 
-                    if verbose:
-                        logging.info("The cost increased. Learning rate is decreased to %s" % lr)
+                if training_method == 'dynamic':
+                    # The first epoch
+                    if last_cost is None:
+                        last_cost = cost
+                        continue
+                    # If the cost is stable for stable_max_times within stable_threshold,
+                    # the training is stopped.
+                    if stable_method == 'cost_stable':
+                        if abs(cost - last_cost) <= stable_threshold:
+                            stable_times += 1
+                            if verbose:
+                                logging.info("The cost is continuously stable for %s times" % stable_times)
+                            if stable_times >= stable_max_times:
+                                break
+                        else:
+                            stable_times = 0
+                    if stable_method == 'zero_one_loss':
+                        if abs(error - 0.0) <= 0.0001:
+                            break
 
-                last_cost = cost
+                    # Dynamically adjust the learning rate.
+                    # If cost is reduced bigger than reduced_percentage, the learning rate is increased
+                    # by increased_percentage.
+                    reduced_percentage = 0.10
+                    increased_percentage = 0.05
+                    diff = last_cost - cost
+                    if (diff > 0 and (diff / last_cost) >= reduced_percentage):
+                        lr *= (1 + increased_percentage)
+                        if verbose:
+                            logging.info("The cost has been reduced by more than %s. Learning rate "\
+                                    "is increased to %s" % (reduced_percentage, lr))
+                    # If cost is actually increasing by cost_dec_percentage, decrease the learning rate
+                    # by decrease_percentage
+                    decrease_percentage = 0.05
+                    cost_dec_percentage = 0.05
+                    if diff < 0 and abs(diff) / last_cost >= cost_dec_percentage:
+                        lr *= (1 - decrease_percentage) 
+                        if verbose:
+                            logging.info("The cost increased. Learning rate is decreased to %s" % lr)
 
-            if training_method == 'fixed' and stable_method == 'zero_one_loss':
-                # If the zero-one loss is zero, the training is stopped.
-                if abs(error - 0.0) <= 0.0001:
-                    break
+                    last_cost = cost
+
+                if training_method == 'fixed' and stable_method == 'zero_one_loss':
+                    # If the zero-one loss is zero, the training is stopped.
+                    if abs(error - 0.0) <= 0.0001:
+                        break
+
+            if use_validation:
+                early_stopping.restore(verbose)
+        finally:
+            if trainer is not self:
+                trainer.close()
 
         if is_write_to_file:
             if verbose:
                 logging.info("Finally, write models to %s" % target_dir)
-            self.write_to_files(target_dir)
+            model_writer.write(self, target_dir, training_state=training_state(epoch, True))
+        model_writer.wait()
         return epoch
 
+    def add_labels(self, labels):
+        """
+        Add the labels not known by the model. The output layer grows by one
+        unit for each new label, and the outputs of the known labels are
+        unchanged until the model is trained again.
+        labels: 1d array like
+        Return
+        -----
+        list, the new labels in the order of their output units
+        """
+
+        # The labels are strings after load_from_files, so they are compared
+        # by str as in checkpoint.resume_training
+        str_to_y = dict((str(label), y) for (y, label) in self.y_to_label.items())
+        new_labels = []
+        for label in labels:
+            if str(label) not in str_to_y:
+                str_to_y[str(label)] = len(str_to_y)
+                new_labels.append(label)
+        if len(new_labels) == 0:
+            return new_labels
+
+        for label in new_labels:
+            self.y_to_label[str_to_y[str(label)]] = label
+        self.softmax_layer.add_units(len(new_labels))
+        self.n_o = self.softmax_layer.n_o
+        self.params = self.bir_layer.params + self.softmax_layer.params
+        self.init_flat_params()
+        if hasattr(self, 'label_to_y'):
+            self.label_to_y = dict((label, y) for (y, label) in self.y_to_label.items())
+        return new_labels
+
+    def online_train(self, x, label_y, split_pos=None, lr=0.1, minibatch=5,
+                     max_updates=10, target_dir=None):
+        """
+        Train the model (e.g., recovered by load_from_files) on new labeled
+        instances without training from scratch. The new labels are added by
+        add_labels, then at most max_updates minibatch updates go through x
+        (repeatedly if x has less than max_updates minibatches).
+        x: numpy.ndarray, 2d jagged arry
+            The new instances. The index of words
+        label_y: numpy.ndarray, 1d array
+            The right label of x
+        split_pos: 1d array like
+            Start position in x. See batch_train
+        lr: float
+            Learning rate
+        minibatch: int
+            Mini batch size
+        max_updates: int
+            The max number of updates
+        target_dir: str
+            The model is written to target_dir after the updates. None means
+            not to write
+        Return
+        -----
+        new_labels: list, the labels added to the model
+        """
+
+        new_labels = self.add_labels(label_y)
+        str_to_y = dict((str(label), y) for (y, label) in self.y_to_label.items())
+        y = np.array([str_to_y[str(label)] for label in label_y])
+        if split_pos is None:
+            split_pos = [int(len(row) / 2) for row in x]
+
+        n_updates = 0
+        while len(x) != 0 and n_updates < max_updates:
+            for start in range(0, len(x), minibatch):
+                if n_updates >= max_updates:
+                    break
+                end = start + minibatch
+                self.batch_train(x[start:end], y[start:end], lr,
+                                 split_pos[start:end])
+                n_updates += 1
+
+        if target_dir is not None:
+            self.write_to_files(target_dir)
+        return new_labels
+
     def predict(self, x, split_pos=None):
         """
         Prediction of FNN on x
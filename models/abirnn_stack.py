@@ -0,0 +1,789 @@
+#! /usr/bin/env python3
+"""
+Authors: fengyukun
+Date: 2016-10-18
+Brief:  Training a stack of ABiRNN models of the same shape in one batched pass
+"""
+
+# For python2
+from __future__ import print_function
+# Activate automatic float divison for python2.
+from __future__ import division
+import sys
+sys.path.append("../lib/")
+sys.path.append("../utils/")
+from inc import*
+from abirnn import ABiRNN
+
+# The order of the gates in the stacked LSTM weights
+GATE_NAMES = ["i", "f", "c", "o"]
+
+
+def stable_sigmoid(x):
+    """
+    Numerically-stable sigmoid function on arrays. The same values as
+    sigmoid_array, without calling sigmoid on each element.
+    x: numpy.ndarray
+    """
+
+    exp_x = np.exp(-np.abs(x))
+    return np.where(x >= 0, 1 / (1 + exp_x), exp_x / (exp_x + 1))
+
+
+class ABiRNNStack(object):
+    """
+    A stack of K ABiRNN models with the same n_i, n_h and options, e.g., the
+    models of K verbs. The weights of the models are stacked into 3d arrays
+    whose first axis is the model. In each step every model takes its next
+    minibatch and all models are advanced together by batched matrix
+    multiplications (numpy.matmul over the model axis). The rows of a step are
+    padded to the same length and the models to the same number of labels;
+    the padded positions and labels are masked. Each model stops on its own
+    condition as in ABiRNN.minibatch_train. The trained parameters are copied
+    back into the models, which are written and used as usual.
+    """
+    def __init__(self, models):
+        """
+        Stack the parameters of models
+        models: list of ABiRNN
+            Initialized models with LSTM layers. Their x and y are the training
+            data. If up_wordvec is True, the word vectors of each model are
+            updated separately as in the training of one model, so the models
+            may share them (see unstack_model).
+        """
+
+        if len(models) == 0:
+            logging.error("No model to stack")
+            raise Exception
+        options = [(model.n_i, model.n_h, model.act_func, model.use_bias,
+                    model.norm_func, model.up_wordvec) for model in models]
+        if len(set(options)) != 1:
+            logging.error("Models of different shapes can not be stacked: %s"
+                          % set(options))
+            raise Exception
+        if not all(model.use_lstm for model in models):
+            logging.error("Only models with LSTM layers can be stacked")
+            raise Exception
+
+        self.models = models
+        self.n_models = len(models)
+        self.n_i = models[0].n_i
+        self.n_h = models[0].n_h
+        self.act_func = models[0].act_func
+        self.use_bias = models[0].use_bias
+        self.norm_func = models[0].norm_func
+        self.up_wordvec = models[0].up_wordvec
+
+        # Labels of model k are the first models[k].n_o ones
+        self.n_o = max(model.n_o for model in models)
+        self.label_mask = np.zeros((self.n_models, self.n_o), dtype=bool)
+        for k, model in enumerate(models):
+            self.label_mask[k, 0:model.n_o] = True
+
+        # The word tables of the training data, see set_train_data
+        self.vocabs = None
+        self.local_x = None
+        self.word_table = None
+        self.stack_params()
+
+    def word_vectors(self, k, words):
+        """
+        Return the current vectors of words of model k. The vectors trained in
+        the word table are used if the word vectors are updated.
+        k: int
+        words: 1d numpy.ndarray, word indexs
+        """
+
+        embedding_layer = self.models[k].embedding_layer
+        vectors = embedding_layer.word2vec[embedding_layer.local_indexs(words)]
+        if self.up_wordvec and self.vocabs is not None:
+            vocab = self.vocabs[k]
+            pos = np.minimum(np.searchsorted(vocab, words), vocab.shape[0] - 1)
+            trained = vocab[pos] == words
+            vectors[trained] = self.word_table[k, pos[trained]]
+        return vectors
+
+    def build_word_tables(self, xs):
+        """
+        Each model looks up the words of its rows in its own table, so that
+        its word vectors can be updated separately and the tables are only as
+        large as the vocabulary of the rows.
+        xs: list of 2d jagged arrays, the rows of each model
+        Return
+        -----
+        vocabs: list of 1d numpy.ndarray, the words in the table of each model
+        local_x: list of list of 1d numpy.ndarray, the rows as the row
+            numbers in the tables
+        word_table: numpy.ndarray, (K, number of words, n_i)
+        """
+
+        vocabs = []
+        local_x = []
+        for x in xs:
+            rows = [np.asarray(row, dtype=np.int64) for row in x]
+            if len(rows) == 0:
+                vocab = np.zeros(shape=(0, ), dtype=np.int64)
+            else:
+                vocab = np.unique(np.concatenate(rows))
+            vocabs.append(vocab)
+            local_x.append([np.searchsorted(vocab, row) for row in rows])
+        n_words = max([vocab.shape[0] for vocab in vocabs] + [1])
+        word_table = np.zeros((self.n_models, n_words, self.n_i))
+        for k, vocab in enumerate(vocabs):
+            word_table[k, 0:vocab.shape[0]] = self.word_vectors(k, vocab)
+        return (vocabs, local_x, word_table)
+
+    def set_train_data(self):
+        """
+        Build the word tables of the training data (x of the models) once
+        """
+
+        if self.vocabs is None:
+            (self.vocabs, self.local_x, self.word_table) = (
+                self.build_word_tables([model.x for model in self.models])
+            )
+
+    def stack_params(self):
+        """
+        Copy the parameters of the models into the stacked arrays. wx, wh and
+        b hold the weights of the gates in the order of GATE_NAMES.
+        """
+
+        n_gates = len(GATE_NAMES) * self.n_h
+        self.wx = np.zeros((self.n_models, n_gates, self.n_i))
+        self.wh = np.zeros((self.n_models, n_gates, self.n_h))
+        self.b = np.zeros((self.n_models, n_gates))
+        self.wo = np.zeros((self.n_models, self.n_o, self.n_h))
+        self.bo = np.zeros((self.n_models, self.n_o))
+        for k, model in enumerate(self.models):
+            bir_layer = model.bir_layer
+            for gate_i, gate in enumerate(GATE_NAMES):
+                gate_rows = slice(gate_i * self.n_h, (gate_i + 1) * self.n_h)
+                self.wx[k, gate_rows] = getattr(bir_layer, "wx" + gate)
+                self.wh[k, gate_rows] = getattr(bir_layer, "wh" + gate)
+                if self.use_bias:
+                    self.b[k, gate_rows] = getattr(bir_layer, gate + "b")
+            self.wo[k, 0:model.n_o] = model.softmax_layer.w
+            if self.use_bias:
+                self.bo[k, 0:model.n_o] = model.softmax_layer.b
+
+    def unstack_model(self, k):
+        """
+        Copy the stacked parameters of model k back into it. If the word
+        vectors are updated, the model gets a copy of its word vectors with
+        the updated rows, so the given ones are never changed.
+        k: int
+        Return
+        -----
+        ABiRNN, the model k
+        """
+
+        model = self.models[k]
+        bir_layer = model.bir_layer
+        for gate_i, gate in enumerate(GATE_NAMES):
+            gate_rows = slice(gate_i * self.n_h, (gate_i + 1) * self.n_h)
+            getattr(bir_layer, "wx" + gate)[...] = self.wx[k, gate_rows]
+            getattr(bir_layer, "wh" + gate)[...] = self.wh[k, gate_rows]
+            if self.use_bias:
+                getattr(bir_layer, gate + "b")[...] = self.b[k, gate_rows]
+        model.softmax_layer.w[...] = self.wo[k, 0:model.n_o]
+        if self.use_bias:
+            model.softmax_layer.b[...] = self.bo[k, 0:model.n_o]
+
+        if self.up_wordvec and self.vocabs is not None:
+            # The word vectors given to the model may be shared
+            word2vec = np.array(model.embedding_layer.word2vec, copy=True)
+            vocab = self.vocabs[k]
+            rows = model.embedding_layer.local_indexs(vocab)
+            word2vec[rows] = self.word_table[k, 0:vocab.shape[0]]
+            model.embedding_layer.word2vec = word2vec
+            model.word2vec = word2vec
+        return model
+
+    def unstack_params(self):
+        """
+        Copy the stacked parameters back into all models
+        """
+
+        for k in range(0, self.n_models):
+            self.unstack_model(k)
+
+    def make_batch(self, xs, starts, minibatch, split_pos, ys=None):
+        """
+        Pad the minibatches of the models into arrays.
+        xs: list of the rows of each model, see build_word_tables
+        starts: list of int
+            The first sample of the minibatch of each model. None means the
+            model has no minibatch in this step
+        minibatch: int
+        split_pos: list of split_pos of the models
+        ys: list of the normalized labels of the models. None means unknown
+        Return
+        -----
+        batch: dict
+            x: (K, minibatch, T) row numbers in the word tables
+            lens: (K, minibatch) lengths of the rows
+            split_pos: (K, minibatch)
+            y: (K, minibatch) normalized labels
+            sample_mask: (K, minibatch) whether a sample is real
+        """
+
+        rows = []
+        for k in range(0, self.n_models):
+            if starts[k] is None:
+                rows.append(range(0, 0))
+            else:
+                end = min(starts[k] + minibatch, len(xs[k]))
+                rows.append(range(starts[k], end))
+        n_time = max([len(xs[k][i])
+                      for k in range(0, self.n_models) for i in rows[k]] + [1])
+
+        # A padded sample is a row of one word with zero gradients
+        x = np.zeros((self.n_models, minibatch, n_time), dtype=np.int64)
+        lens = np.ones((self.n_models, minibatch), dtype=np.int64)
+        batch_split_pos = np.zeros((self.n_models, minibatch), dtype=np.int64)
+        y = np.zeros((self.n_models, minibatch), dtype=np.int64)
+        sample_mask = np.zeros((self.n_models, minibatch), dtype=bool)
+        for k in range(0, self.n_models):
+            for j, i in enumerate(rows[k]):
+                row = xs[k][i]
+                x[k, j, 0:len(row)] = row
+                lens[k, j] = len(row)
+                if split_pos[k] is None:
+                    batch_split_pos[k, j] = int(len(row) / 2)
+                else:
+                    batch_split_pos[k, j] = split_pos[k][i]
+                if ys is not None:
+                    y[k, j] = ys[k][i]
+                sample_mask[k, j] = True
+        return {"x": x, "lens": lens, "split_pos": batch_split_pos, "y": y,
+                "sample_mask": sample_mask}
+
+    def act(self, x):
+        if self.act_func == 'tanh':
+            return np.tanh(x)
+        return stable_sigmoid(x)
+
+    def grad_act(self, out):
+        """
+        The derivative of the activation function given its output
+        """
+
+        if self.act_func == 'tanh':
+            return 1 - out ** 2
+        return out * (1 - out)
+
+    def lstm_forward(self, emb):
+        """
+        Forward pass of the LSTM layers of all models from time 0
+        emb: numpy.ndarray, (K, B, T, n_i)
+        Return
+        -----
+        hts: numpy.ndarray, (K, B, T, n_h)
+        cache: tuple, used by lstm_backprop
+        """
+
+        (n_models, n_samples, n_time, _) = emb.shape
+        n_h = self.n_h
+        # Input part of the gates at all time
+        x_gates = np.matmul(
+            emb.reshape((n_models, n_samples * n_time, self.n_i)),
+            self.wx.transpose((0, 2, 1))
+        ).reshape((n_models, n_samples, n_time, 4 * n_h))
+        x_gates += self.b[:, np.newaxis, np.newaxis, :]
+        wh_t = self.wh.transpose((0, 2, 1))
+
+        hts = np.zeros((n_models, n_samples, n_time, n_h))
+        cts = np.zeros((n_models, n_samples, n_time, n_h))
+        gates = np.zeros((n_models, n_samples, n_time, 4 * n_h))
+        scaled_octs = np.zeros((n_models, n_samples, n_time, n_h))
+        ht_1 = np.zeros((n_models, n_samples, n_h))
+        ct_1 = np.zeros((n_models, n_samples, n_h))
+        for t in range(0, n_time):
+            net = x_gates[:, :, t] + np.matmul(ht_1, wh_t)
+            gate = gates[:, :, t]
+            gate[..., 0:2 * n_h] = stable_sigmoid(net[..., 0:2 * n_h])
+            gate[..., 2 * n_h:3 * n_h] = self.act(net[..., 2 * n_h:3 * n_h])
+            gate[..., 3 * n_h:] = stable_sigmoid(net[..., 3 * n_h:])
+            (it, ft, scaled_incellt, ot) = np.split(gate, 4, axis=-1)
+            ct = it * scaled_incellt + ct_1 * ft
+            scaled_oct = self.act(ct)
+            ht = ot * scaled_oct
+            hts[:, :, t] = ht
+            cts[:, :, t] = ct
+            scaled_octs[:, :, t] = scaled_oct
+            ht_1 = ht
+            ct_1 = ct
+        return (hts, (emb, hts, cts, gates, scaled_octs))
+
+    def lstm_backprop(self, ghts, cache, grads):
+        """
+        Back propagation of lstm_forward. The gradients on the LSTM weights
+        are added to grads.
+        ghts: numpy.ndarray, (K, B, T, n_h)
+        cache: tuple, returned by lstm_forward
+        grads: dict
+        Return
+        -----
+        gemb: numpy.ndarray, (K, B, T, n_i), gradients on the input
+        """
+
+        (emb, hts, cts, gates, scaled_octs) = cache
+        (n_models, n_samples, n_time, _) = emb.shape
+        g_nets = np.zeros(gates.shape)
+        ght_1 = np.zeros((n_models, n_samples, self.n_h))
+        gct_1 = np.zeros((n_models, n_samples, self.n_h))
+        for t in range(n_time - 1, -1, -1):
+            (it, ft, scaled_incellt, ot) = np.split(gates[:, :, t], 4, axis=-1)
+            scaled_oct = scaled_octs[:, :, t]
+            if t == 0:
+                ct_1 = np.zeros(gct_1.shape)
+            else:
+                ct_1 = cts[:, :, t - 1]
+            ght = ghts[:, :, t] + ght_1
+            gcell = ght * ot * self.grad_act(scaled_oct) + gct_1
+            g_net = g_nets[:, :, t]
+            (giigates, gifgates, gincell, giogates) = np.split(g_net, 4, axis=-1)
+            giigates[...] = gcell * scaled_incellt * it * (1 - it)
+            gifgates[...] = gcell * ct_1 * ft * (1 - ft)
+            gincell[...] = gcell * it * self.grad_act(scaled_incellt)
+            giogates[...] = ght * scaled_oct * ot * (1 - ot)
+            gct_1 = gcell * ft
+            ght_1 = np.matmul(g_net, self.wh)
+
+        flat_g_nets = g_nets.reshape((n_models, n_samples * n_time, -1))
+        grads["wx"] += np.matmul(
+            flat_g_nets.transpose((0, 2, 1)),
+            emb.reshape((n_models, n_samples * n_time, self.n_i))
+        )
+        if n_time > 1:
+            grads["wh"] += np.matmul(
+                g_nets[:, :, 1:].reshape((n_models, -1, 4 * self.n_h)).transpose((0, 2, 1)),
+                hts[:, :, 0:-1].reshape((n_models, -1, self.n_h))
+            )
+        if self.use_bias:
+            grads["b"] += g_nets.sum(axis=(1, 2))
+        return np.matmul(flat_g_nets, self.wx).reshape(emb.shape)
+
+    def forward(self, batch, word_table=None):
+        """
+        Forward pass of all models on batch
+        batch: dict, returned by make_batch
+        word_table: numpy.ndarray, the word tables of batch. None means the
+            tables of the training data
+        Return
+        -----
+        py: numpy.ndarray, (K, B, n_o). The probabilities of the labels
+        cache: dict, used by backprop
+        """
+
+        x = batch["x"]
+        lens = batch["lens"]
+        (n_models, n_samples, n_time) = x.shape
+        time_mask = np.arange(0, n_time) < lens[:, :, np.newaxis]
+        # Position t of the reversed row is at reverse_pos[t] of the row. The
+        # padded positions stay in place
+        times = np.arange(0, n_time)
+        reverse_pos = np.where(time_mask, lens[:, :, np.newaxis] - 1 - times, times)
+        model_index = np.arange(0, n_models)[:, np.newaxis, np.newaxis]
+
+        if word_table is None:
+            word_table = self.word_table
+        emb = word_table[model_index, x]
+        reverse_emb = word_table[
+            model_index, np.take_along_axis(x, reverse_pos, axis=2)
+        ]
+        (upper_hts, upper_cache) = self.lstm_forward(emb)
+        (lower_hts, lower_cache) = self.lstm_forward(reverse_emb)
+        hts = upper_hts + np.take_along_axis(
+            lower_hts, reverse_pos[:, :, :, np.newaxis], axis=2
+        )
+
+        # Attention
+        split_pos = batch["split_pos"]
+        global_info = np.take_along_axis(
+            hts, split_pos[:, :, np.newaxis, np.newaxis], axis=2
+        )[:, :, 0]
+        before_norm_vals = np.einsum("kbth,kbh->kbt", hts, global_info)
+        if self.norm_func == 'softmax':
+            stable_input = np.where(time_mask, before_norm_vals, -np.inf)
+            stable_input = np.exp(
+                stable_input - stable_input.max(axis=2)[:, :, np.newaxis]
+            )
+        else:
+            stable_input = stable_sigmoid(before_norm_vals) * time_mask
+        input_sums = stable_input.sum(axis=2)[:, :, np.newaxis]
+        after_norm_vals = stable_input / input_sums
+        weighted_sums = np.einsum("kbt,kbth->kbh", after_norm_vals, hts)
+
+        # Softmax layer, the labels not in a model are masked
+        net = np.matmul(weighted_sums, self.wo.transpose((0, 2, 1)))
+        net += self.bo[:, np.newaxis, :]
+        net = np.where(self.label_mask[:, np.newaxis, :], net, -np.inf)
+        py = np.exp(net - net.max(axis=2)[:, :, np.newaxis])
+        py /= py.sum(axis=2)[:, :, np.newaxis]
+
+        cache = {
+            "reverse_pos": reverse_pos, "upper_cache": upper_cache,
+            "lower_cache": lower_cache, "hts": hts, "global_info": global_info,
+            "stable_input": stable_input, "input_sums": input_sums,
+            "after_norm_vals": after_norm_vals,
+            "weighted_sums": weighted_sums, "x": x, "py": py
+        }
+        return (py, cache)
+
+    def backprop(self, batch, cache):
+        """
+        Back propagation of forward on batch
+        Return
+        -----
+        grads: dict, the gradients on the stacked parameters and on the word
+        tables
+        """
+
+        py = cache["py"]
+        (n_models, n_samples, _) = py.shape
+        grads = {"wx": np.zeros(self.wx.shape), "wh": np.zeros(self.wh.shape),
+                 "b": np.zeros(self.b.shape)}
+
+        # Softmax layer with cross entropy
+        gnet = np.copy(py)
+        model_index = np.arange(0, n_models)[:, np.newaxis]
+        sample_index = np.arange(0, n_samples)[np.newaxis, :]
+        gnet[model_index, sample_index, batch["y"]] -= 1
+        gnet *= batch["sample_mask"][:, :, np.newaxis]
+        grads["wo"] = np.matmul(gnet.transpose((0, 2, 1)), cache["weighted_sums"])
+        grads["bo"] = gnet.sum(axis=1)
+        if not self.use_bias:
+            grads["bo"].fill(0)
+        gweighted_sums = np.matmul(gnet, self.wo)
+
+        # Attention
+        hts = cache["hts"]
+        after_norm_vals = cache["after_norm_vals"]
+        ghts = after_norm_vals[:, :, :, np.newaxis] * gweighted_sums[:, :, np.newaxis, :]
+        gafter_norm_vals = np.einsum("kbh,kbth->kbt", gweighted_sums, hts)
+        stable_input = cache["stable_input"]
+        input_sums = cache["input_sums"]
+        gbefore_norm_vals = (
+            (gafter_norm_vals * input_sums -
+             (gafter_norm_vals * stable_input).sum(axis=2)[:, :, np.newaxis])
+            / input_sums ** 2
+        )
+        if self.norm_func == 'softmax':
+            gbefore_norm_vals *= stable_input
+        else:
+            gbefore_norm_vals *= stable_input * (1 - stable_sigmoid(
+                np.einsum("kbth,kbh->kbt", hts, cache["global_info"])
+            ))
+        ghts += gbefore_norm_vals[:, :, :, np.newaxis] * cache["global_info"][:, :, np.newaxis, :]
+        gglobal_info = np.einsum("kbt,kbth->kbh", gbefore_norm_vals, hts)
+        ghts[model_index, sample_index, batch["split_pos"]] += gglobal_info
+
+        # Bidirectional LSTM layers sharing the weights
+        reverse_pos = cache["reverse_pos"]
+        gemb = self.lstm_backprop(ghts, cache["upper_cache"], grads)
+        lower_ghts = np.take_along_axis(ghts, reverse_pos[:, :, :, np.newaxis], axis=2)
+        lower_gemb = self.lstm_backprop(lower_ghts, cache["lower_cache"], grads)
+        gemb += np.take_along_axis(lower_gemb, reverse_pos[:, :, :, np.newaxis], axis=2)
+
+        if self.up_wordvec:
+            grads["word_table"] = np.zeros(self.word_table.shape)
+            np.add.at(grads["word_table"],
+                      (model_index[:, :, np.newaxis], cache["x"]), gemb)
+        return grads
+
+    def batch_train(self, batch, lrs):
+        """
+        One step of all models on batch
+        lrs: numpy.ndarray, (K, ). Learning rates. Zero for the models not
+        trained in this step
+        """
+
+        (_, cache) = self.forward(batch)
+        grads = self.backprop(batch, cache)
+        param_names = ["wx", "wh", "b", "wo", "bo"]
+        if self.up_wordvec:
+            param_names.append("word_table")
+        for param_name in param_names:
+            param = getattr(self, param_name)
+            param -= lrs.reshape((-1, ) + (1, ) * (param.ndim - 1)) * grads[param_name]
+
+    def evaluate(self, models_i, minibatch, split_pos):
+        """
+        Zero-one loss and cost of the models in models_i on their training data
+        Return
+        -----
+        errors: numpy.ndarray, (K, )
+        costs: numpy.ndarray, (K, )
+        """
+
+        errors = np.zeros(self.n_models)
+        costs = np.zeros(self.n_models)
+        n_samples = [len(self.local_x[k]) for k in range(0, self.n_models)]
+        for start in range(0, max([n_samples[k] for k in models_i] + [0]), minibatch):
+            starts = [None] * self.n_models
+            for k in models_i:
+                if start < n_samples[k]:
+                    starts[k] = start
+            batch = self.make_batch(self.local_x, starts, minibatch, split_pos,
+                                    [model.y for model in self.models])
+            (py, _) = self.forward(batch)
+            mask = batch["sample_mask"]
+            errors += ((py.argmax(axis=2) != batch["y"]) * mask).sum(axis=1)
+            py_y = np.take_along_axis(py, batch["y"][:, :, np.newaxis], axis=2)[:, :, 0]
+            costs -= np.where(mask, np.log(np.where(mask, py_y, 1)), 0).sum(axis=1)
+        errors /= np.maximum(n_samples, 1)
+        return (errors, costs)
+
+    def predict(self, xs, split_pos=None, minibatch=None):
+        """
+        Prediction of all models in one batched computation. The rows of xs[k]
+        are evaluated by model k. The attention matrix of model k is kept in
+        self.attention_matrices[k] like ABiRNN.attention_matrix.
+        xs: list of 2d jagged arrays
+            The input data of each model. The index of words. An empty list
+            means no input for the model
+        split_pos: list
+            split_pos of each xs[k], see ABiRNN.predict. None means None for
+            all models
+        minibatch: int
+            Number of rows of each model evaluated at a time, which bounds the
+            memory. None means all rows at once
+        Return
+        -----
+        list of 1d numpy.ndarray, the predicted labels of each model
+        """
+
+        if len(xs) != self.n_models:
+            logging.error("%d inputs for %d models" % (len(xs), self.n_models))
+            raise Exception
+        if split_pos is None:
+            split_pos = [None] * self.n_models
+        (_, local_x, word_table) = self.build_word_tables(xs)
+        n_samples = [len(x) for x in local_x]
+        if minibatch is None:
+            minibatch = max(n_samples + [1])
+
+        y_preds = [[] for k in range(0, self.n_models)]
+        self.attention_matrices = [[] for k in range(0, self.n_models)]
+        for start in range(0, max(n_samples + [0]), minibatch):
+            starts = [start if start < n_samples[k] else None
+                      for k in range(0, self.n_models)]
+            batch = self.make_batch(local_x, starts, minibatch, split_pos)
+            (py, cache) = self.forward(batch, word_table)
+            batch_preds = py.argmax(axis=2)
+            for k in range(0, self.n_models):
+                for j in range(0, minibatch):
+                    if not batch["sample_mask"][k, j]:
+                        break
+                    y_preds[k].append(batch_preds[k, j])
+                    self.attention_matrices[k].append(
+                        cache["after_norm_vals"][k, j, 0:batch["lens"][k, j]]
+                    )
+        return [np.array([model.y_to_label[i] for i in y_pred])
+                for model, y_pred in zip(self.models, y_preds)]
+
+    def minibatch_train(self, lr=0.1, minibatch=5, max_epochs=100,
+                        split_pos=None, verbose=False,
+                        training_method='dynamic', stable_method='zero_one_loss'):
+        """
+        Minibatch training of all models. Each model is trained as by
+        ABiRNN.minibatch_train with the same arguments, and stops on its own.
+        The trained parameters are copied back into the models by
+        unstack_params or unstack_model.
+
+        lr: float
+            Learning rate
+        minibatch: int
+            Mini batch size
+        max_epochs: int
+            the max epoch
+        split_pos: list
+            split_pos of the training data of each model, see
+            ABiRNN.minibatch_train. None means None for all models
+        verbose: bool
+            whether to print information during each epoch training
+        training_method: str, two options are:
+            dynamic: The leaning rate is dynamically adjusted.
+            fixed: The learning rate is fixed.
+        stable_method: two options are:
+            'zero_one_loss': The training considers to be stable when zero one loss is zero.
+            'cost_stable': The training considers to be stable when the cost is continuously
+            stable. The 'fixed' and 'cost_table' combination are not supported.
+        Return
+        ----
+        epochs: list of int
+            The epoch number of each model
+        """
+
+        if training_method not in ['dynamic', 'fixed']:
+            logging.error("Unknown training method argument: %s" % training_method)
+            raise Exception
+        if stable_method not in ['zero_one_loss', 'cost_stable']:
+            logging.error("Unknown stable method argument: %s" % training_method)
+            raise Exception
+        if stable_method == 'cost_stable' and training_method == 'fixed':
+            logging.error("Current combination is not supported")
+            raise Exception
+        if split_pos is None:
+            split_pos = [None] * self.n_models
+        self.set_train_data()
+        ys = [model.y for model in self.models]
+
+        # The state of each model
+        lrs = np.zeros(self.n_models) + lr
+        epochs = [0] * self.n_models
+        last_costs = [None] * self.n_models
+        stable_times = [0] * self.n_models
+        stable_threshold = 2
+        stable_max_times = 3
+        active = list(range(0, self.n_models))
+        n_samples = [len(self.local_x[k]) for k in range(0, self.n_models)]
+
+        for epoch in range(1, max_epochs + 1):
+            if len(active) == 0:
+                break
+            max_samples = max(n_samples[k] for k in active)
+            for start in range(0, max_samples, minibatch):
+                starts = [None] * self.n_models
+                step_lrs = np.zeros(self.n_models)
+                for k in active:
+                    if start < n_samples[k]:
+                        starts[k] = start
+                        step_lrs[k] = lrs[k]
+                batch = self.make_batch(self.local_x, starts, minibatch,
+                                        split_pos, ys)
+                self.batch_train(batch, step_lrs)
+
+            (errors, costs) = self.evaluate(active, minibatch, split_pos)
+            stopped = []
+            for k in active:
+                epochs[k] = epoch
+                if verbose:
+                    logging.info("model: %d, epoch: %d training,on train data, "
+                                 "cross-entropy:%f, zero-one loss: %f"
+                                 % (k, epoch, costs[k], errors[k]))
+                if abs(errors[k] - 0.0) <= 0.0001 and stable_method == 'zero_one_loss':
+                    if training_method == 'fixed' or last_costs[k] is not None:
+                        stopped.append(k)
+                        continue
+                if training_method == 'fixed':
+                    continue
+
+                # The first epoch
+                if last_costs[k] is None:
+                    last_costs[k] = costs[k]
+                    continue
+                if stable_method == 'cost_stable':
+                    if abs(costs[k] - last_costs[k]) <= stable_threshold:
+                        stable_times[k] += 1
+                        if stable_times[k] >= stable_max_times:
+                            stopped.append(k)
+                            continue
+                    else:
+                        stable_times[k] = 0
+
+                # Dynamically adjust the learning rate as ABiRNN
+                reduced_percentage = 0.10
+                increased_percentage = 0.05
+                diff = last_costs[k] - costs[k]
+                if (diff > 0 and (diff / last_costs[k]) >= reduced_percentage):
+                    lrs[k] *= (1 + increased_percentage)
+                decrease_percentage = 0.05
+                cost_dec_percentage = 0.05
+                if diff < 0 and abs(diff) / last_costs[k] >= cost_dec_percentage:
+                    lrs[k] *= (1 - decrease_percentage)
+                last_costs[k] = costs[k]
+            active = [k for k in active if k not in stopped]
+            if verbose and len(stopped) != 0:
+                logging.info("epoch: %d, models %s stopped, %d models left"
+                             % (epoch, stopped, len(active)))
+        return epochs
+
+    def write_to_files(self, target_dirs):
+        """
+        Write each model to its directory in the format of ABiRNN
+        target_dirs: list of str
+        """
+
+        self.unstack_params()
+        for model, target_dir in zip(self.models, target_dirs):
+            model.write_to_files(target_dir)
+
+
+def load_stack(model_dirs):
+    """
+    Load the ABiRNN models written in model_dirs into a stack, e.g., for
+    predicting with the models of many verbs at once.
+    model_dirs: list of str
+    Return
+    -----
+    ABiRNNStack
+    """
+
+    models = []
+    for model_dir in model_dirs:
+        model = ABiRNN()
+        model.load_from_files(model_dir)
+        models.append(model)
+    return ABiRNNStack(models)
+
+
+def abirnn_stack_test():
+    n_h = 6
+    word_dim = 4
+    voc_size = 30
+    n_models = 3
+    word2vec = np.random.uniform(low=-1, high=1, size=(voc_size, word_dim))
+    data = []
+    for k in range(0, n_models):
+        x_row = 20 + 7 * k
+        x = make_jagged_array(n_row=x_row, min_col=2, max_col=7,
+                              max_int=voc_size, min_int=0, dim_unit=None)
+        label_y = np.random.randint(low=0, high=2 + k, size=x_row)
+        split_pos = np.array([np.random.randint(0, len(row)) for row in x])
+        data.append((x, label_y, split_pos))
+
+    # Each model trained alone and in the stack from the same init
+    models = []
+    stacked_models = []
+    for k in range(0, n_models):
+        (x, label_y, split_pos) = data[k]
+        model = ABiRNN()
+        model.init(x, label_y, np.copy(word2vec), n_h, up_wordvec=True)
+        models.append(model)
+        stacked_model = ABiRNN()
+        stacked_model.init(x, label_y, np.copy(word2vec), n_h, up_wordvec=True)
+        stacked_model.flat_params[...] = model.flat_params
+        stacked_models.append(stacked_model)
+
+    epochs = []
+    for k in range(0, n_models):
+        epochs.append(models[k].minibatch_train(
+            0.1, 5, 10, data[k][2], training_method='dynamic'
+        ))
+    stack = ABiRNNStack(stacked_models)
+    stacked_epochs = stack.minibatch_train(
+        0.1, 5, 10, [split_pos for (_, _, split_pos) in data],
+        training_method='dynamic'
+    )
+    stack.unstack_params()
+    print("epochs: %s, stacked epochs: %s" % (epochs, stacked_epochs))
+    for k in range(0, n_models):
+        print("model %d, max difference of parameters: %s, of word vectors: %s"
+              % (k, np.abs(models[k].flat_params - stacked_models[k].flat_params).max(),
+                 np.abs(models[k].embedding_layer.word2vec -
+                        stacked_models[k].embedding_layer.word2vec).max()))
+
+    # Prediction of all models at once
+    y_preds = stack.predict([x for (x, _, _) in data],
+                            [split_pos for (_, _, split_pos) in data])
+    for k in range(0, n_models):
+        (x, _, split_pos) = data[k]
+        print("model %d, the same prediction: %s" % (
+            k, np.array_equal(y_preds[k], models[k].predict(x, split_pos))
+        ))
+
+if __name__ == "__main__":
+    abirnn_stack_test()
@@ -16,9 +16,10 @@ from inc import*
 from gradient_checker import GradientChecker
 import layer
 import metrics
+from parallel import make_trainer
 
 
-class FNN(object):
+class FNN(FlatParamsMixin):
     """
     Feedward Neural Network (FNN) class
     """
@@ -93,6 +94,14 @@ class FNN(object):
         self.params += softmax_layer.params
         self.param_names += softmax_layer.param_names
         self.layers.append(softmax_layer)
+        self.init_flat_params()
+
+    def param_layers(self):
+        """
+        Return the layers holding self.params, see FlatParamsMixin
+        """
+
+        return self.layers
 
     def cost(self, x, y):
         """
@@ -153,15 +162,15 @@ class FNN(object):
         self.forward(x)
         gx = self.backprop(y)
         # Update parameters
-        for gparam, param in zip(self.gparams, self.params):
-            param -= lr * gparam
+        self.flat_params -= lr * self.flat_gparams
         if self.up_wordvec:
             (word_indexs, gword_vectors) = self.embedding_layer.backprop(gx)
             for word_index, gword_vector in zip(word_indexs, gword_vectors):
                 self.word2vec[word_index] -= lr * gword_vector
 
     def minibatch_train(self, lr=0.1, minibatch=5, max_epochs=100,
-                        verbose=False):
+                        verbose=False, n_workers=1, parallel_method='sync',
+                        server_address=None, server_authkey=None):
         """
         Minibatch training over x. Training will be stopped when the zero-one
         loss is zero on x.
@@ -174,36 +183,61 @@ class FNN(object):
             the max epoch
         verbose: bool
             whether to print information during each epoch training
+        n_workers: int
+            Number of processes among which each minibatch is split. The
+            gradients of the shards are summed before one update, see
+            parallel.DataParallelTrainer. 1 means training in this process
+        parallel_method: str
+            'sync', 'hogwild', 'thread' or 'param_server'. See
+            parallel.make_trainer
+        server_address: tuple
+            (host, port) where the parameter server waits for n_workers remote
+            workers started by param_server.run_param_worker. None means the
+            workers are started on this machine
+        server_authkey: str
+            The secret key of the parameter server, which the remote workers
+            pass to run_param_worker. It is needed unless server_address is on
+            loopback
         Return
         ----
         train_epoch: int
             The epoch number during traing on train data
         """
 
-        for epoch in range(1, max_epochs + 1):
-            n_batches = int(self.y.shape[0] / minibatch)
-            for batch_i in range(0, n_batches):
-                self.batch_train(
-                    self.x[batch_i * minibatch:(batch_i + 1) * minibatch],
-                    self.y[batch_i * minibatch:(batch_i + 1) * minibatch],
-                    lr
-                )
-            # Train the rest if it has
-            if n_batches * minibatch != self.y.shape[0]:
-                self.batch_train(
-                    self.x[(batch_i + 1) * minibatch:],
-                    self.y[(batch_i + 1) * minibatch:],
-                    lr
-                )
-            label_preds = self.predict(self.x)
-            error = metrics.zero_one_loss(self.label_y, label_preds)
-            cost = self.cost(self.x, self.y)
-            if verbose:
-                logging.info("epoch: %d training,on train data, "
-                             "cross-entropy:%f, zero-one loss: %f"
-                             % (epoch, cost, error))
-            if abs(error - 0.0) <= 0.00001:
-                break
+        trainer = make_trainer(self, n_workers, parallel_method, None, server_address,
+                               server_authkey)
+
+        try:
+            for epoch in range(1, max_epochs + 1):
+                if trainer is not self and parallel_method in ['hogwild', 'param_server']:
+                    trainer.train_epoch(lr, minibatch, None)
+                else:
+                    n_batches = int(self.y.shape[0] / minibatch)
+                    for batch_i in range(0, n_batches):
+                        trainer.batch_train(
+                            self.x[batch_i * minibatch:(batch_i + 1) * minibatch],
+                            self.y[batch_i * minibatch:(batch_i + 1) * minibatch],
+                            lr
+                        )
+                    # Train the rest if it has
+                    if n_batches * minibatch != self.y.shape[0]:
+                        trainer.batch_train(
+                            self.x[(batch_i + 1) * minibatch:],
+                            self.y[(batch_i + 1) * minibatch:],
+                            lr
+                        )
+                label_preds = self.predict(self.x)
+                error = metrics.zero_one_loss(self.label_y, label_preds)
+                cost = self.cost(self.x, self.y)
+                if verbose:
+                    logging.info("epoch: %d training,on train data, "
+                                 "cross-entropy:%f, zero-one loss: %f"
+                                 % (epoch, cost, error))
+                if abs(error - 0.0) <= 0.00001:
+                    break
+        finally:
+            if trainer is not self:
+                trainer.close()
         return epoch
 
     def predict(self, x):
@@ -0,0 +1,451 @@
+#! /usr/bin/env python3
+"""
+Authors: fengyukun
+Date: 2016-10-18
+Brief:  ABiRNN for all verbs: one shared encoder and attention, and one frame
+softmax masked to the frames of the verb of each sentence
+"""
+
+# For python2
+from __future__ import print_function
+# Activate automatic float divison for python2.
+from __future__ import division
+import os
+import sys
+sys.path.append("../lib/")
+sys.path.append("../utils/")
+from inc import*
+import layer
+import checkpoint
+import metrics
+import birecurrent_layer
+from layer import AttentionLayer
+from layer import MaskedSoftmaxLayer
+from abirnn import ABiRNN
+
+
+class MultiVerbABiRNN(ABiRNN):
+    """
+    One ABiRNN trained on the sentences of all verbs. The embedding, the
+    bidirectional recurrent layer and the attention are shared by all verbs.
+    The output is a softmax over the frames of all verbs, where a frame is a
+    (verb, label) pair, and only the frames of the verb of a sentence are
+    allowed for it. So each verb is still a classification over its own
+    labels, while the encoder learns from the whole corpus.
+    """
+    def init(self, x, verbs, label_y, word2vec, n_h, up_wordvec=False,
+             use_bias=True, act_func='tanh', use_lstm=True,
+             norm_func='softmax', embedding_store=None):
+        """
+        Init MultiVerbABiRNN
+        x: numpy.ndarray, 2d jagged arry
+            The input data. The index of words
+        verbs: 1d array like
+            The verb of each row of x
+        label_y: numpy.ndarray, 1d array
+            The right label of x, among the labels of its verb
+        word2vec: numpy.ndarray, 2d array
+            Each row represents word vectors. E.g.,
+            word_vectors = word2vec[word_index]
+        n_h: int
+            Number of hidden unit
+        up_wordvec: boolean
+            Whether update word vectors
+        use_bias: boolean
+            Whether use bias on the layers of nn
+        act_func: str
+            Activation function in hidden layer.
+            Two values are tanh and sigmoid
+        use_lstm: bool
+            Whether use lstm layer, default is lstm layer
+        norm_func: str
+            Attention normalization function.
+            Two options are 'softmax' and 'sigmoid'
+        embedding_store: str
+            The directory of the shared store of word vectors. If it is given,
+            write_to_files only writes a reference to the word vectors in the
+            store (see layer.EmbeddingLayer). None means the word vectors are
+            written to the model directory
+        """
+
+        self.x = x
+        self.verbs = verbs
+        self.word2vec = word2vec
+        self.up_wordvec = up_wordvec
+        self.n_h = n_h
+        self.act_func = act_func
+        self.use_bias = use_bias
+        self.use_lstm = use_lstm
+        self.norm_func = norm_func
+        self.global_independent = False
+
+        self.label_y = label_y
+        self.set_frames(sorted(set(zip(verbs, label_y))))
+        self.y = self.frames_of(verbs, label_y)
+        self.n_o = len(self.frames)
+        self.n_i = self.word2vec.shape[1]
+
+        # Init layers
+        self.embedding_layer = layer.EmbeddingLayer()
+        self.embedding_layer.init_layer(self.word2vec, embedding_store, not up_wordvec)
+        self.layers = []
+        self.params = []
+        self.param_names = []
+
+        self.bir_layer = birecurrent_layer.BiRecurrentLayer()
+        self.bir_layer.init_layer(n_i=self.n_i, n_o=self.n_h,
+                                  act_func=self.act_func,
+                                  use_bias=self.use_bias,
+                                  use_lstm=self.use_lstm)
+        self.params += self.bir_layer.params
+        self.param_names += self.bir_layer.param_names
+
+        self.attention_layer = AttentionLayer(norm_func=self.norm_func)
+
+        # Output layer over all frames
+        self.softmax_layer = MaskedSoftmaxLayer()
+        self.softmax_layer.init_layer(n_i=self.n_h, n_o=self.n_o,
+                                      use_bias=self.use_bias)
+        self.params += self.softmax_layer.params
+        self.param_names += self.softmax_layer.param_names
+        self.init_flat_params()
+
+    def set_frames(self, frames):
+        """
+        Set the frames of the output layer
+        frames: list of (verb, label)
+            The frame of output unit i is frames[i]
+        """
+
+        self.frames = [(str(verb), str(label)) for (verb, label) in frames]
+        self.frame_to_y = dict((frame, i) for i, frame in enumerate(self.frames))
+        self.verb_frames = {}
+        for i, (verb, label) in enumerate(self.frames):
+            self.verb_frames.setdefault(verb, []).append(i)
+        self.y_to_label = dict((i, label) for i, (verb, label) in enumerate(self.frames))
+
+    def frames_of(self, verbs, label_y):
+        """
+        Return numpy.ndarray, the output units of the frames (verbs[i],
+        label_y[i])
+        """
+
+        frames = [(str(verb), str(label)) for verb, label in zip(verbs, label_y)]
+        for frame in frames:
+            if frame not in self.frame_to_y:
+                logging.error("Unknown frame: %s" % (frame, ))
+                raise Exception
+        return np.array([self.frame_to_y[frame] for frame in frames])
+
+    def frame_mask(self, verbs):
+        """
+        Return numpy.ndarray, boolean array with the shape (len(verbs),
+        number of frames). Row i allows the frames of verbs[i]
+        """
+
+        mask = np.zeros((len(verbs), self.n_o), dtype=bool)
+        for i, verb in enumerate(verbs):
+            verb = str(verb)
+            if verb not in self.verb_frames:
+                logging.error("Unknown verb: %s" % verb)
+                raise Exception
+            mask[i, self.verb_frames[verb]] = True
+        return mask
+
+    def write_to_files(self, target_dir, prune_embedding=False, oov_index=None):
+        """Write the attributes and the parameters to files
+
+        :target_dir: str, a directory where the attribute file and paramter file are. A directory
+        will be created if the target_dir does not exist.
+        :prune_embedding: bool, whether only the vectors of the words in the training data and oov
+        are written (see layer.EmbeddingLayer.write_to_files). The words of other data are mapped to
+        oov by the loaded model. A loaded model has no training data and keeps its vectors.
+        :oov_index: int, the word index of oov. None means the last row of word2vec.
+
+        """
+
+        try:
+            checkpoint.makedirs(target_dir)
+        except:
+            if not os.path.isdir(target_dir):
+                raise Exception("%s is not a directory" % (target_dir,))
+
+        # Write the attributes to file
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "w")
+        print("%s %s %s %s %s %s %s %s" % (self.n_i, self.n_o, self.act_func, self.use_bias,
+              self.use_lstm, self.n_h, self.up_wordvec, self.norm_func),
+              file=attributes_file)
+        attributes_file.close()
+        # One frame per line in the order of output units
+        frames_file = checkpoint.open_file("%s/frames.txt" % target_dir, "w")
+        for (verb, label) in self.frames:
+            print("%s\t%s" % (verb, label), file=frames_file)
+        frames_file.close()
+
+        # Write paramters to file
+        word_indexs = None
+        if prune_embedding and getattr(self, 'x', None) is not None:
+            word_indexs = batch_word_indexs(self.x)
+        self.embedding_layer.write_to_files("%s/embedding_out.npz" % (target_dir,),
+                                            word_indexs, oov_index)
+        bilayer_dir = "%s/%s" % (target_dir, self.bir_layer.__class__.__name__)
+        self.bir_layer.write_to_files(bilayer_dir)
+        softmax_target_dir = "%s/%s" % (target_dir, self.softmax_layer.__class__.__name__)
+        self.softmax_layer.write_to_files(softmax_target_dir)
+        logging.info("Finish writting %s layer to %s" % (self.__class__.__name__, target_dir))
+
+    def load_from_files(self, target_dir):
+        """Load files to recover one object of this class.
+
+        :target_dir: str, a directory where the attribute file and paramter file are.
+
+        """
+
+        # Load attributes file
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "r")
+        try:
+            (n_i, n_o, act_func, use_bias, use_lstm, n_h, up_wordvec,
+             norm_func) = (attributes_file.readline().strip().split(" "))
+            self.n_i = int(n_i)
+            self.n_o = int(n_o)
+            self.act_func = act_func
+            self.use_bias = use_bias == 'True'
+            self.use_lstm = use_lstm == 'True'
+            self.n_h = int(n_h)
+            self.up_wordvec = up_wordvec == 'True'
+            self.norm_func = norm_func
+            self.global_independent = False
+        except:
+            raise Exception("%s/attributes.txt format error" % target_dir)
+        attributes_file.close()
+        frames_file = checkpoint.open_file("%s/frames.txt" % target_dir, "r")
+        frames = [line.rstrip("\n").split("\t") for line in frames_file if line.strip()]
+        frames_file.close()
+        if len(frames) != self.n_o:
+            raise Exception("%s/frames.txt format error" % target_dir)
+        self.set_frames(frames)
+
+        # Load parameters file
+        self.embedding_layer = layer.EmbeddingLayer()
+        self.embedding_layer.load_from_files("%s/embedding_out.npz" % (target_dir,))
+        self.embedding_layer.frozen = not self.up_wordvec
+
+        self.layers = []
+        self.params = []
+        self.param_names = []
+
+        self.bir_layer = birecurrent_layer.BiRecurrentLayer()
+        bilayer_dir = "%s/%s" % (target_dir, self.bir_layer.__class__.__name__)
+        self.bir_layer.load_from_files(bilayer_dir)
+        self.params += self.bir_layer.params
+        self.param_names += self.bir_layer.param_names
+
+        self.attention_layer = AttentionLayer(norm_func=self.norm_func)
+
+        self.softmax_layer = MaskedSoftmaxLayer()
+        softmax_target_dir = "%s/%s" % (target_dir, self.softmax_layer.__class__.__name__)
+        self.softmax_layer.load_from_files(softmax_target_dir)
+        self.params += self.softmax_layer.params
+        self.param_names += self.softmax_layer.param_names
+        self.init_flat_params()
+
+        logging.info("Finish loading %s from %s" % (self.__class__.__name__, target_dir))
+
+    def cost(self, x, verbs, y, split_pos=None):
+        """
+        Cost function
+        verbs: 1d array like, the verb of each row of x
+        y: numpy.ndarray, the output units of the right frames
+        """
+
+        py = self.forward(x, verbs, split_pos)
+        cross_entropy = -np.sum(
+            np.log(py[np.arange(0, y.shape[0]), y])
+        )
+        return cross_entropy
+
+    def forward(self, x, verbs, split_pos=None):
+        """
+        Compute forward pass
+        x: numpy.ndarray, 2d arry
+            The input data. The index of words
+        verbs: 1d array like
+            The verb of each row of x
+        split_pos: 1d array like
+            See ABiRNN.forward
+        """
+
+        self.softmax_layer.set_mask(self.frame_mask(verbs))
+        return ABiRNN.forward(self, x, split_pos)
+
+    def batch_train(self, x, verbs, y, lr, split_pos):
+        """
+        Batch training on x given right frames y
+        verbs: 1d array like, the verb of each row of x
+        y: numpy.ndarray, the output units of the right frames
+        lr: float
+            Learning rate
+        split_pos: 1d array like
+            See ABiRNN.batch_train
+        """
+
+        self.forward(x, verbs, split_pos)
+        gx = self.backprop(y)
+        # Update parameters
+        self.flat_params -= lr * self.flat_gparams
+        if self.up_wordvec:
+            (vectorized_x, go) = self.embedding_layer.backprop(gx)
+            for i in range(0, len(vectorized_x)):
+                for j in range(0, len(vectorized_x[i])):
+                    vectorized_x[i][j] -= lr * go[i][j]
+
+    def minibatch_train(self, lr=0.1, minibatch=5, max_epochs=100,
+                        split_pos=None, verbose=False,
+                        is_write_to_file=False, target_dir=None, freq=None,
+                        valid_x=None, valid_verbs=None, valid_label_y=None,
+                        valid_split_pos=None, valid_freq=1, patience=None,
+                        background_write=True):
+        """
+        Minibatch training over x with a fixed learning rate. Training will be
+        stopped when the zero-one loss is zero on x. The sentences of the
+        verbs should be mixed in x, e.g., shuffled, so that each minibatch has
+        several verbs.
+
+        lr: float
+            Learning rate
+        minibatch: int
+            Mini batch size
+        max_epochs: int
+            the max epoch
+        split_pos: 1d array like
+            See ABiRNN.minibatch_train
+        verbose: bool
+            whether to print information during each epoch training
+        is_write_to_file:, bool, whether write models to file in a real time.
+        target_dir: model is saved in target_dir if is_write_to_file is True
+        freq: int, save the model every freq epoch
+        valid_x: numpy.ndarray, 2d jagged array
+            Validation data. If it is given, the zero-one loss on it is
+            computed every valid_freq epochs, the parameters with the lowest
+            loss are kept in memory and restored when the training ends.
+        valid_verbs: 1d array like, the verb of each row of valid_x
+        valid_label_y: numpy.ndarray, 1d array
+            The right label of valid_x
+        valid_split_pos: 1d array like
+            split_pos of valid_x
+        valid_freq: int, evaluate on valid_x every valid_freq epoch
+        patience: int
+            Stop the training when the validation loss is not improved for
+            patience evaluations. None means no early stopping
+        background_write: bool
+            Whether the models are written by a background thread while the
+            training goes on (see checkpoint.AsyncCheckpointWriter). The last
+            model is written before minibatch_train returns
+        Return
+        ----
+        train_epoch: int
+            The epoch number during traing on train data
+        """
+
+        if split_pos is None:
+            split_pos = [int(len(row) / 2) for row in self.x]
+        use_validation = valid_x is not None and len(valid_x) > 0
+        if use_validation:
+            early_stopping = EarlyStopping(self, patience)
+            self.best_epoch = 0
+
+        model_writer = checkpoint.AsyncCheckpointWriter()
+        for epoch in range(1, max_epochs + 1):
+            for start in range(0, len(self.x), minibatch):
+                end = start + minibatch
+                self.batch_train(self.x[start:end], self.verbs[start:end],
+                                 self.y[start:end], lr, split_pos[start:end])
+            label_preds = self.predict(self.x, self.verbs, split_pos)
+            error = metrics.zero_one_loss(self.label_y, label_preds)
+            if verbose:
+                logging.info("epoch: %d training,on train data, zero-one loss: %f"
+                             % (epoch, error))
+
+            if use_validation and epoch % valid_freq == 0:
+                valid_preds = self.predict(valid_x, valid_verbs, valid_split_pos)
+                valid_error = metrics.zero_one_loss(valid_label_y, valid_preds)
+                stop = early_stopping.update(epoch, valid_error, verbose)
+                self.best_epoch = early_stopping.best_epoch
+                if stop:
+                    break
+
+            if is_write_to_file and epoch % freq == 0:
+                model_writer.write(self, target_dir)
+                if not background_write:
+                    model_writer.wait()
+            if abs(error - 0.0) <= 0.0001:
+                break
+
+        if use_validation:
+            early_stopping.restore(verbose)
+        if is_write_to_file:
+            model_writer.write(self, target_dir)
+        model_writer.wait()
+        return epoch
+
+    def predict(self, x, verbs, split_pos=None):
+        """
+        Prediction on x. The label of each row is one of the labels of its
+        verb.
+        x: numpy.ndarray, 2d arry
+            The input data. The index of words
+        verbs: 1d array like
+            The verb of each row of x
+        split_pos: 1d array like
+            See ABiRNN.predict
+        Return
+        -----
+        numpy.ndarray, 1d array. The predict label on x
+        """
+
+        py = self.forward(x, verbs, split_pos)
+        y = py.argmax(axis=1)
+        return np.array([self.y_to_label[i] for i in y])
+
+
+def multi_verb_abirnn_test():
+    n_h = 8
+    voc_size = 30
+    word_dim = 4
+    word2vec = np.random.uniform(low=-1, high=1, size=(voc_size, word_dim))
+    x = []
+    verbs = []
+    label_y = []
+    # The labels of verb k are "0", ..., str(k + 1)
+    for k in range(0, 4):
+        rows = make_jagged_array(n_row=15, min_col=2, max_col=6,
+                                 max_int=voc_size, min_int=0, dim_unit=None)
+        x += rows
+        verbs += ["verb%d" % k] * len(rows)
+        label_y += [str(i) for i in np.random.randint(0, k + 2, size=len(rows))]
+    order = np.random.permutation(len(x))
+    x = [x[i] for i in order]
+    verbs = [verbs[i] for i in order]
+    label_y = np.array([label_y[i] for i in order])
+
+    nntest = MultiVerbABiRNN()
+    nntest.init(x, verbs, label_y, word2vec, n_h, up_wordvec=True)
+    epoch = nntest.minibatch_train(lr=0.1, minibatch=5, max_epochs=30,
+                                   verbose=True)
+    label_preds = nntest.predict(x, verbs)
+    print("epoch: %d, zero-one loss on train data: %f"
+          % (epoch, metrics.zero_one_loss(label_y, label_preds)))
+    # The label of each sentence is one of its verb
+    print("Labels within the verbs: %s" % all(
+        int(label) < int(verb[4:]) + 2 for label, verb in zip(label_preds, verbs)
+    ))
+
+    # Write and load test
+    nntest.write_to_files("multi_verb_abirnn_dir")
+    nntest_bak = MultiVerbABiRNN()
+    nntest_bak.load_from_files("multi_verb_abirnn_dir")
+    print("The same prediction after loading: %s"
+          % np.array_equal(label_preds, nntest_bak.predict(x, verbs)))
+
+if __name__ == "__main__":
+    multi_verb_abirnn_test()
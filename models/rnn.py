@@ -16,17 +16,20 @@ sys.path.append("../utils/")
 from inc import*
 from gradient_checker import GradientChecker
 import layer
+import checkpoint
 import metrics
 import recurrent_layer
 import lstm_layer
+from parallel import make_trainer
 
 
-class RNN(object):
+class RNN(FlatParamsMixin):
     """
     Recurrent Neural Network (RNN) class
     """
     def init(self, x, label_y, word2vec, n_h, up_wordvec=False,
-                 use_bias=True, act_func='tanh', use_lstm=False):
+                 use_bias=True, act_func='tanh', use_lstm=False,
+                 embedding_store=None):
         """
         Init RNN
         x: numpy.ndarray, 2d jagged arry
@@ -47,6 +50,11 @@ class RNN(object):
             Two values are tanh and sigmoid
         use_lstm: bool
             Whether use lstm layer, default is rnn layer
+        embedding_store: str
+            The directory of the shared store of word vectors. If it is given,
+            write_to_files only writes a reference to the word vectors in the
+            store (see layer.EmbeddingLayer). None means the word vectors are
+            written to the model directory
         """
 
         self.x = x
@@ -73,7 +81,7 @@ class RNN(object):
 
         # Init layers
         self.embedding_layer = layer.EmbeddingLayer()
-        self.embedding_layer.init_layer(self.word2vec)
+        self.embedding_layer.init_layer(self.word2vec, embedding_store, not up_wordvec)
         self.layers = []
         self.params = []
         self.param_names = []
@@ -97,23 +105,35 @@ class RNN(object):
         self.params += softmax_layer.params
         self.param_names += softmax_layer.param_names
         self.layers.append(softmax_layer)
+        self.init_flat_params()
 
-    def write_to_files(self, target_dir):
+    def param_layers(self):
+        """
+        Return the layers holding self.params, see FlatParamsMixin
+        """
+
+        return self.layers
+
+    def write_to_files(self, target_dir, prune_embedding=False, oov_index=None):
         """Write the attributes and the parameters to files
 
         :target_dir: str, a directory where the attribute file and paramter file are. A directory
         will be created if the target_dir does not exist.
+        :prune_embedding: bool, whether only the vectors of the words in the training data and oov
+        are written (see layer.EmbeddingLayer.write_to_files). The words of other data are mapped to
+        oov by the loaded model. A loaded model has no training data and keeps its vectors.
+        :oov_index: int, the word index of oov. None means the last row of word2vec.
 
         """
 
         try:
-            os.makedirs(target_dir)
+            checkpoint.makedirs(target_dir)
         except:
             if not os.path.isdir(target_dir):
                 raise Exception("%s is not a directory" % (target_dir,))
 
         # Write the attributes to file
-        attributes_file = open("%s/attributes.txt" % target_dir, "w")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "w")
         print("%s %s %s %s %s %s %s" % (self.n_i, self.n_o, self.act_func, self.use_bias,
               self.use_lstm, self.n_h, self.up_wordvec), file=attributes_file)
         y_to_label = ",".join(['%s:%s' % (k, v) for k, v in self.y_to_label.items()]) 
@@ -123,7 +143,11 @@ class RNN(object):
         attributes_file.close()
 
         # Write paramters to file
-        self.embedding_layer.write_to_files("%s/embedding_out.npz" % (target_dir,))
+        word_indexs = None
+        if prune_embedding and getattr(self, 'x', None) is not None:
+            word_indexs = batch_word_indexs(self.x)
+        self.embedding_layer.write_to_files("%s/embedding_out.npz" % (target_dir,),
+                                            word_indexs, oov_index)
         for neural_layer in self.layers:
             layer_target_dir = "%s/%s" % (target_dir, neural_layer.__class__.__name__)
             neural_layer.write_to_files(layer_target_dir)
@@ -138,7 +162,7 @@ class RNN(object):
         """
 
         # Load attributes file
-        attributes_file = open("%s/attributes.txt" % target_dir, "r")
+        attributes_file = checkpoint.open_file("%s/attributes.txt" % target_dir, "r")
         try:
             (n_i, n_o, act_func, use_bias, use_lstm, n_h, up_wordvec) = (
                 attributes_file.readline().strip().split(" ")
@@ -174,6 +198,7 @@ class RNN(object):
 
         self.embedding_layer = layer.EmbeddingLayer()
         self.embedding_layer.load_from_files("%s/embedding_out.npz" % (target_dir,))
+        self.embedding_layer.frozen = not self.up_wordvec
 
         self.layers = []
         self.params = []
@@ -188,6 +213,7 @@ class RNN(object):
             self.layers.append(neural_layer)
             self.params += neural_layer.params
             self.param_names += neural_layer.param_names
+        self.init_flat_params()
 
         logging.info("Finish loading %s from %s" % (self.__class__.__name__, target_dir))
 
@@ -254,8 +280,7 @@ class RNN(object):
         self.forward(x)
         gx = self.backprop(y)
         # Update parameters
-        for gparam, param in zip(self.gparams, self.params):
-            param -= lr * gparam
+        self.flat_params -= lr * self.flat_gparams
         if self.up_wordvec:
             (vectorized_x, go) = self.embedding_layer.backprop(gx)
             for i in range(0, len(vectorized_x)):
@@ -263,7 +288,9 @@ class RNN(object):
                     vectorized_x[i][j] -= lr * go[i][j]
 
     def minibatch_train(self, lr=0.1, minibatch=5, max_epochs=100,
-                        verbose=False, training_method='dynamic', stable_method='zero_one_loss'):
+                        verbose=False, training_method='dynamic', stable_method='zero_one_loss',
+                        n_workers=1, parallel_method='sync',
+                        server_address=None, server_authkey=None):
         """
         Minibatch training over x. Training will be stopped when the zero-one
         loss is zero on x.
@@ -283,6 +310,21 @@ class RNN(object):
             'zero_one_loss': The training considers to be stable when zero one loss is zero.
             'cost_stable': The training considers to be stable when the cost is continuously
             stable. The 'fixed' and 'cost_table' combination are not supported.
+        n_workers: int
+            Number of processes among which each minibatch is split. The
+            gradients of the shards are summed before one update, see
+            parallel.DataParallelTrainer. 1 means training in this process
+        parallel_method: str
+            'sync', 'hogwild', 'thread' or 'param_server'. See
+            parallel.make_trainer
+        server_address: tuple
+            (host, port) where the parameter server waits for n_workers remote
+            workers started by param_server.run_param_worker. None means the
+            workers are started on this machine
+        server_authkey: str
+            The secret key of the parameter server, which the remote workers
+            pass to run_param_worker. It is needed unless server_address is on
+            loopback
         Return
         ----
         train_epoch: int
@@ -305,77 +347,86 @@ class RNN(object):
             stable_max_times = 3
             stable_times = 0
 
-        for epoch in range(1, max_epochs + 1):
-            n_batches = int(self.y.shape[0] / minibatch)
-            batch_i = 0
-            for batch_i in range(0, n_batches):
-                self.batch_train(
-                    self.x[batch_i * minibatch:(batch_i + 1) * minibatch],
-                    self.y[batch_i * minibatch:(batch_i + 1) * minibatch],
-                    lr
-                )
-            # Train the rest if it has
-            if n_batches * minibatch != self.y.shape[0]:
-                self.batch_train(
-                    self.x[(batch_i + 1) * minibatch:],
-                    self.y[(batch_i + 1) * minibatch:],
-                    lr
-                )
-            label_preds = self.predict(self.x)
-            error = metrics.zero_one_loss(self.label_y, label_preds)
-            cost = self.cost(self.x, self.y)
-            if verbose:
-                logging.info("epoch: %d training,on train data, "
-                             "cross-entropy:%f, zero-one loss: %f"
-                             % (epoch, cost, error))
-
-            if training_method == 'dynamic':
-                # The first epoch
-                if last_cost is None:
-                    last_cost = cost
-                    continue
-                # If the cost is stable for stable_max_times within stable_threshold,
-                # the training is stopped.
-                if stable_method == 'cost_stable':
-                    if abs(cost - last_cost) <= stable_threshold:
-                        stable_times += 1
-                        if verbose:
-                            logging.info("The cost is continuously stable for %s times" % stable_times)
-                        if stable_times >= stable_max_times:
+        trainer = make_trainer(self, n_workers, parallel_method, None, server_address,
+                               server_authkey)
+
+        try:
+            for epoch in range(1, max_epochs + 1):
+                if trainer is not self and parallel_method in ['hogwild', 'param_server']:
+                    trainer.train_epoch(lr, minibatch, None)
+                else:
+                    n_batches = int(self.y.shape[0] / minibatch)
+                    batch_i = 0
+                    for batch_i in range(0, n_batches):
+                        trainer.batch_train(
+                            self.x[batch_i * minibatch:(batch_i + 1) * minibatch],
+                            self.y[batch_i * minibatch:(batch_i + 1) * minibatch],
+                            lr
+                        )
+                    # Train the rest if it has
+                    if n_batches * minibatch != self.y.shape[0]:
+                        trainer.batch_train(
+                            self.x[(batch_i + 1) * minibatch:],
+                            self.y[(batch_i + 1) * minibatch:],
+                            lr
+                        )
+                label_preds = self.predict(self.x)
+                error = metrics.zero_one_loss(self.label_y, label_preds)
+                cost = self.cost(self.x, self.y)
+                if verbose:
+                    logging.info("epoch: %d training,on train data, "
+                                 "cross-entropy:%f, zero-one loss: %f"
+                                 % (epoch, cost, error))
+
+                if training_method == 'dynamic':
+                    # The first epoch
+                    if last_cost is None:
+                        last_cost = cost
+                        continue
+                    # If the cost is stable for stable_max_times within stable_threshold,
+                    # the training is stopped.
+                    if stable_method == 'cost_stable':
+                        if abs(cost - last_cost) <= stable_threshold:
+                            stable_times += 1
+                            if verbose:
+                                logging.info("The cost is continuously stable for %s times" % stable_times)
+                            if stable_times >= stable_max_times:
+                                break
+                        else:
+                            stable_times = 0
+                    if stable_method == 'zero_one_loss':
+                        if abs(error - 0.0) <= 0.0001:
                             break
-                    else:
-                        stable_times = 0
-                if stable_method == 'zero_one_loss':
-                    if abs(error - 0.0) <= 0.0001:
-                        break
 
-                # Dynamically adjust the learning rate.
-                # If cost is reduced bigger than reduced_percentage, the learning rate is increased
-                # by increased_percentage.
-                reduced_percentage = 0.10
-                increased_percentage = 0.05
-                diff = last_cost - cost
-                if (diff > 0 and (diff / last_cost) >= reduced_percentage):
-                    lr *= (1 + increased_percentage)
-                    if verbose:
-                        logging.info("The cost has been reduced by more than %s. Learning rate "\
-                                "is increased to %s" % (reduced_percentage, lr))
-                # If cost is actually increasing by cost_dec_percentage, decrease the learning rate
-                # by decrease_percentage
-                decrease_percentage = 0.05
-                cost_dec_percentage = 0.05
-                if diff < 0 and abs(diff) / last_cost >= cost_dec_percentage:
-                    lr *= (1 - decrease_percentage) 
-                    if verbose:
-                        logging.info("The cost increased. Learning rate is decreased to %s" % lr)
-
-                last_cost = cost
-
-            if training_method == 'fixed' and stable_method == 'zero_one_loss':
-                # If the zero-one loss is zero, the training is stopped.
-                if abs(error - 0.0) <= 0.0001:
-                    break
+                    # Dynamically adjust the learning rate.
+                    # If cost is reduced bigger than reduced_percentage, the learning rate is increased
+                    # by increased_percentage.
+                    reduced_percentage = 0.10
+                    increased_percentage = 0.05
+                    diff = last_cost - cost
+                    if (diff > 0 and (diff / last_cost) >= reduced_percentage):
+                        lr *= (1 + increased_percentage)
+                        if verbose:
+                            logging.info("The cost has been reduced by more than %s. Learning rate "\
+                                    "is increased to %s" % (reduced_percentage, lr))
+                    # If cost is actually increasing by cost_dec_percentage, decrease the learning rate
+                    # by decrease_percentage
+                    decrease_percentage = 0.05
+                    cost_dec_percentage = 0.05
+                    if diff < 0 and abs(diff) / last_cost >= cost_dec_percentage:
+                        lr *= (1 - decrease_percentage) 
+                        if verbose:
+                            logging.info("The cost increased. Learning rate is decreased to %s" % lr)
+
+                    last_cost = cost
 
+                if training_method == 'fixed' and stable_method == 'zero_one_loss':
+                    # If the zero-one loss is zero, the training is stopped.
+                    if abs(error - 0.0) <= 0.0001:
+                        break
+        finally:
+            if trainer is not self:
+                trainer.close()
         return epoch
 
     def predict(self, x):
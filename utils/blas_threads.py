@@ -0,0 +1,45 @@
+#! /usr/bin/env python3
+"""
+Authors: fengyukun
+Date:   2016-10-18
+Brief:  Limit the threads of the BLAS libraries. The BLAS libraries read the
+        environment variables only when they are loaded, so this module must
+        be imported and used before numpy is imported.
+"""
+
+# For python2
+from __future__ import print_function
+# Activate automatic float divison for python2.
+from __future__ import division
+import os
+
+# Environment variables limiting the threads of the BLAS libraries
+BLAS_THREAD_VARS = [
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"
+]
+
+
+def set_blas_threads(n_threads):
+    """
+    Limit the BLAS libraries loaded later in this process and its child
+    processes to n_threads threads. The variables already set by the user are
+    kept.
+    n_threads: int
+    """
+
+    for var in BLAS_THREAD_VARS:
+        os.environ.setdefault(var, str(n_threads))
+
+
+def blas_threads_set(n_threads):
+    """
+    Return whether all the environment variables limit the BLAS libraries to
+    n_threads threads.
+    n_threads: int
+    """
+
+    for var in BLAS_THREAD_VARS:
+        if os.environ.get(var) != str(n_threads):
+            return False
+    return True
@@ -30,13 +30,91 @@ logging.basicConfig(
     format=" [%(levelname)s]%(filename)s:%(lineno)s[function:%(funcName)s] %(message)s"
 )
 
+def tokenize_line(line, lower=False):
+    """
+    Tokenize one line of data file
+    line: str, see the format of data files
+    lower: bool, whether lowercase the sentences
+    Return
+    -----
+    frame_id: str
+    sents: list of list of str. sents[0](left sentences), sents[1](verb),
+        sents[2](right sentence)
+    """
+
+    if lower:
+        line = line.lower()
+    items = line.split("\t")
+    if len(items) != 4:
+        logging.error("data format error: %s" % line)
+        raise Exception
+    frame_id = items[0].strip()
+    sents = [nltk.word_tokenize(items[i]) for i in range(1, len(items))]
+    return (frame_id, sents)
+
+
+def strip_key_words(sents, key_words_tag):
+    """
+    Remove key_words_tag from the tagged key words of sents in place
+    Return
+    -----
+    key_words_list: list of int, 1 for key word and 0 for not of each word
+    """
+
+    key_words_list = []
+    for i in range(0, len(sents)):
+        for j in range(0, len(sents[i])):
+            key_pos = sents[i][j].find(key_words_tag)
+            if key_pos >= 0:
+                key_words_list.append(1)
+                sents[i][j] = sents[i][j][0:key_pos]
+            else:
+                key_words_list.append(0)
+    return key_words_list
+
+
+def corpus_words(data_paths, lower=False, show_key_words=False,
+                 key_words_tag="keywordtag", file_names=None):
+    """
+    Return the set of words in the data files, tokenized as DataLoader does.
+    It is the vocabulary needed from the word vectors (see load_word_vectors)
+    data_paths: list of str, the directories of data files
+    file_names: list of str, the data files (verbs) in data_paths to scan.
+        None will scan all files
+    Other parameters are the same as DataLoader
+    """
+
+    words = set()
+    for data_path in data_paths:
+        names = file_names
+        if names is None:
+            names = os.listdir(data_path)
+        for file_name in names:
+            file_path = "%s/%s" % (data_path, file_name)
+            if not os.path.isfile(file_path):
+                continue
+            fh = open(file_path, "r")
+            for line in fh:
+                line = line.strip("\n")
+                if line == "":
+                    continue
+                (_, sents) = tokenize_line(line, lower)
+                if show_key_words:
+                    strip_key_words(sents, key_words_tag)
+                for sent in sents:
+                    words.update(sent)
+            fh.close()
+    return words
+
+
 class DataLoader(object):
     """
     Data loader class
     """
     def __init__(self, data_path, vocab, oov, left_win=5, right_win=5,
                  use_verb=False, lower=False, use_padding=True,
-                 show_key_words=False, key_words_tag="keywordtag"):
+                 show_key_words=False, key_words_tag="keywordtag",
+                 file_names=None):
         """
         vocab: dict, word to word index. The vocab must have oov and keep
         oov_index=vocab[oov]
@@ -48,12 +126,15 @@ class DataLoader(object):
         lower: bool, whether lowercase the sentences
         show_key_words: bool, whether the text show key words
         key_words_tag: str, the keys words with attention is tagged with it.
+        file_names: list of str, the data files (verbs) in data_path to load.
+        None will load all files in data_path
         """
 
         self.show_key_words = show_key_words
         # verb to data set x and data answer y
         self.verb2x = {}
-        file_names = os.listdir(data_path)
+        if file_names is None:
+            file_names = os.listdir(data_path)
         for file_name in file_names:
             file_path = "%s/%s" % (data_path, file_name)
             fh = open(file_path, "r")
@@ -62,26 +143,9 @@ class DataLoader(object):
                 # Skip empty line
                 if line == "":
                     continue
-                if lower:
-                    line = line.lower()
-                items = line.split("\t")
-                if len(items) != 4:
-                    logging.error("data format error: %s" % line)
-                    raise Exception
-                frame_id = items[0].strip()
-                # sents[0](left sentences), sents[1](verb), sents[2](right sentence)
-                sents = [nltk.word_tokenize(items[i]) for i in range(1, len(items))]
-                # 1 for true and 0 for false
+                (frame_id, sents) = tokenize_line(line, lower)
                 if show_key_words:
-                    key_words_list = []
-                    for i in range(0, len(sents)):
-                        for j in range(0, len(sents[i])):
-                            key_pos = sents[i][j].find(key_words_tag)
-                            if key_pos >= 0:
-                                key_words_list.append(1)
-                                sents[i][j] = sents[i][j][0:key_pos]
-                            else:
-                                key_words_list.append(0)
+                    key_words_list = strip_key_words(sents, key_words_tag)
                 sents_indexs = sents2indexs(sents, vocab, oov)
                 left_sent = sent_indexs_trunc(sents_indexs[0], left_win,
                                               "left", vocab[oov],
@@ -0,0 +1,452 @@
+#! /usr/bin/env python3
+"""
+Authors: fengyukun
+Date:   2016-10-18
+Brief:  A job queue in a shared directory for running per-verb jobs on many
+machines. All state changes are atomic renames, so any number of worker
+processes on any machine mounting the directory can pull jobs from it.
+The directory looks like:
+    jobs/JOB_ID.json     The published jobs, {"job_id", "verb", "config"}
+    pending/JOB_ID       Jobs waiting for a worker, {"attempts", "errors"}
+    running/JOB_ID       Jobs taken by a worker. The mtime is the heartbeat
+    failed/JOB_ID        Jobs failed for max_attempts times
+    results/JOB_ID/      result.json and the files (e.g., model) of a job
+    tmp/                 Staging area of results
+"""
+
+# For python2
+from __future__ import print_function
+# Activate automatic float divison for python2.
+from __future__ import division
+import os
+import json
+import time
+import multiprocessing
+import errno
+import shutil
+import socket
+import hashlib
+import threading
+import traceback
+import logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="[%(levelname)s]%(filename)s:%(lineno)s[function:%(funcName)s] %(message)s"
+)
+
+
+def json_default(obj):
+    """
+    Make numpy values serializable by json
+    """
+
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError("%r is not JSON serializable" % (obj, ))
+
+
+def write_json(file_path, obj):
+    """
+    Write obj to file_path atomically: it is written to a temporary file which
+    is then renamed to file_path
+    """
+
+    tmp_path = "%s.%s.%s.%s.tmp" % (file_path, socket.gethostname(), os.getpid(),
+                                  threading.current_thread().ident)
+    fh = open(tmp_path, "w")
+    json.dump(obj, fh, default=json_default, sort_keys=True)
+    fh.close()
+    os.rename(tmp_path, file_path)
+
+
+def read_json(file_path):
+    fh = open(file_path, "r")
+    obj = json.load(fh)
+    fh.close()
+    return obj
+
+
+class JobQueue(object):
+    """
+    The job queue in a shared directory. A job is identified by its verb and
+    the hash of its config, so publishing the same job again is a no-op and a
+    result is stored only once however many times the job runs.
+    """
+    def __init__(self, queue_dir, max_attempts=3, lease_timeout=3600):
+        """
+        queue_dir: str
+            The shared directory. It is created if it does not exist
+        max_attempts: int
+            A job is moved to failed after failing max_attempts times
+        lease_timeout: float
+            Seconds. A running job whose worker has not sent a heartbeat for
+            lease_timeout is considered lost and is pending again
+        """
+
+        self.queue_dir = queue_dir
+        self.max_attempts = max_attempts
+        self.lease_timeout = lease_timeout
+        for sub_dir in ["jobs", "pending", "running", "failed", "results", "tmp"]:
+            try:
+                os.makedirs(self.path(sub_dir))
+            except OSError:
+                if not os.path.isdir(self.path(sub_dir)):
+                    raise
+
+    def path(self, *names):
+        return os.path.join(self.queue_dir, *names)
+
+    def job_id(self, verb, config):
+        """
+        The id of the job of verb with config
+        verb: str
+        config: dict, serializable by json
+        """
+
+        config_str = json.dumps(config, default=json_default, sort_keys=True)
+        config_hash = hashlib.sha1(config_str.encode("utf-8")).hexdigest()[0:12]
+        return "%s.%s" % (verb, config_hash)
+
+    def publish(self, verb, config):
+        """
+        Publish the job of verb with config. Nothing is done if the job has
+        been published
+        verb: str, the verb (data file name)
+        config: dict, serializable by json. The parameters of the job
+        Return
+        -----
+        job_id: str
+        """
+
+        job_id = self.job_id(verb, config)
+        job_file = self.path("jobs", "%s.json" % job_id)
+        if os.path.exists(job_file):
+            return job_id
+        write_json(job_file, {"job_id": job_id, "verb": verb, "config": config})
+        write_json(self.path("pending", job_id), {"attempts": 0, "errors": []})
+        return job_id
+
+    def claim(self, worker_id):
+        """
+        Take one pending job
+        worker_id: str
+        Return
+        -----
+        job: dict, the published job with its state, or None if no job is
+        pending
+        """
+
+        for job_id in sorted(os.listdir(self.path("pending"))):
+            if job_id.endswith(".tmp"):
+                continue
+            try:
+                # The lease starts before the rename, since the pending file
+                # may be older than the lease and rename keeps its mtime, in
+                # which case requeue_stale would release the job at once
+                os.utime(self.path("pending", job_id), None)
+                os.rename(self.path("pending", job_id), self.path("running", job_id))
+            except OSError:
+                # Taken by another worker
+                continue
+            if os.path.exists(self.path("results", job_id)):
+                # Done by a worker whose lease expired
+                self.remove_running(job_id)
+                continue
+            state = read_json(self.path("running", job_id))
+            state["worker"] = worker_id
+            write_json(self.path("running", job_id), state)
+            job = read_json(self.path("jobs", "%s.json" % job_id))
+            job["state"] = state
+            return job
+        return None
+
+    def heartbeat(self, job_id):
+        """
+        Tell the queue that the worker of job_id is alive
+        """
+
+        try:
+            os.utime(self.path("running", job_id), None)
+        except OSError:
+            pass
+
+    def remove_running(self, job_id):
+        try:
+            os.remove(self.path("running", job_id))
+        except OSError:
+            pass
+
+    def staging_dir(self, job):
+        """
+        Return a new empty directory where the worker of job puts the files of
+        its result before complete
+        """
+
+        staging_dir = self.path("tmp", "%s.%s.%s.%s" % (
+            job["job_id"], socket.gethostname(), os.getpid(),
+            threading.current_thread().ident
+        ))
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
+        return staging_dir
+
+    def complete(self, job, result, staging_dir=None):
+        """
+        Store the result of job. If a result of the job has been stored, the
+        new one is dropped
+        job: dict, returned by claim
+        result: dict, serializable by json
+        staging_dir: str, returned by staging_dir. Its files are stored with
+        the result
+        """
+
+        job_id = job["job_id"]
+        if staging_dir is None:
+            staging_dir = self.staging_dir(job)
+        write_json(os.path.join(staging_dir, "result.json"),
+                   {"job": job, "result": result})
+        try:
+            os.rename(staging_dir, self.path("results", job_id))
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            logging.info("The result of %s has been stored" % job_id)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        self.remove_running(job_id)
+
+    def fail(self, job, error):
+        """
+        Record a failure of job. The job is pending again unless it has failed
+        max_attempts times
+        job: dict, returned by claim
+        error: str
+        """
+
+        self.release(job["job_id"], error)
+
+    def release(self, job_id, error):
+        """
+        Move a running job back to pending, or to failed after max_attempts
+        """
+
+        running_file = self.path("running", job_id)
+        try:
+            state = read_json(running_file)
+        except (IOError, OSError, ValueError):
+            return
+        state["attempts"] += 1
+        state["errors"].append(error)
+        state.pop("worker", None)
+        write_json(running_file, state)
+        if state["attempts"] >= self.max_attempts:
+            logging.error("Job %s failed for %d times:\n%s"
+                          % (job_id, state["attempts"], error))
+            target = self.path("failed", job_id)
+        else:
+            target = self.path("pending", job_id)
+        try:
+            os.rename(running_file, target)
+        except OSError:
+            pass
+
+    def requeue_stale(self):
+        """
+        Release the running jobs whose lease has expired
+        Return
+        -----
+        int, the number of released jobs
+        """
+
+        n_released = 0
+        now = time.time()
+        for job_id in os.listdir(self.path("running")):
+            if job_id.endswith(".tmp"):
+                continue
+            try:
+                mtime = os.path.getmtime(self.path("running", job_id))
+            except OSError:
+                continue
+            if now - mtime > self.lease_timeout:
+                self.release(job_id, "lease expired")
+                n_released += 1
+        return n_released
+
+    def retry_failed(self):
+        """
+        Make the failed jobs pending again with the attempts reset
+        """
+
+        for job_id in os.listdir(self.path("failed")):
+            if job_id.endswith(".tmp"):
+                continue
+            write_json(self.path("failed", job_id), {"attempts": 0, "errors": []})
+            os.rename(self.path("failed", job_id), self.path("pending", job_id))
+
+    def status(self):
+        """
+        Return the number of jobs in each state
+        """
+
+        status = {}
+        for sub_dir in ["pending", "running", "failed", "results"]:
+            names = os.listdir(self.path(sub_dir))
+            status[sub_dir] = len([name for name in names if not name.endswith(".tmp")])
+        return status
+
+    def is_finished(self):
+        """
+        Whether no job is pending or running
+        """
+
+        status = self.status()
+        return status["pending"] == 0 and status["running"] == 0
+
+    def results(self):
+        """
+        Return dict, job id to {"job", "result"} of all finished jobs. The files
+        of job_id are in result_dir(job_id)
+        """
+
+        results = {}
+        for job_id in os.listdir(self.path("results")):
+            result_file = self.path("results", job_id, "result.json")
+            if os.path.exists(result_file):
+                results[job_id] = read_json(result_file)
+        return results
+
+    def result_dir(self, job_id):
+        return self.path("results", job_id)
+
+
+def run_worker(queue, job_func, context=None, worker_id=None, poll_interval=5,
+               wait=False, heartbeat_interval=60):
+    """
+    Pull jobs from queue and run them until no job is left.
+    job_func(job, context, staging_dir) returns the result of job (a dict
+    serializable by json) and may write files into staging_dir, which are
+    stored with the result. A job raising an exception is retried by the queue.
+    queue: JobQueue
+    job_func: function
+    context: object, anything job_func needs besides the job, e.g., a cache of
+        word vectors
+    worker_id: str, None means hostname:pid
+    poll_interval: float, seconds between the polls of the queue
+    wait: bool
+        False: return when no job is pending.
+        True: wait until no job is pending or running, so that the jobs of
+        lost workers are taken over.
+    heartbeat_interval: float, seconds between the heartbeats of a running job
+    Return
+    -----
+    int, the number of finished jobs of this worker
+    """
+
+    if worker_id is None:
+        worker_id = "%s:%s" % (socket.gethostname(), os.getpid())
+    n_finished = 0
+    while True:
+        queue.requeue_stale()
+        job = queue.claim(worker_id)
+        if job is None:
+            if not wait or queue.is_finished():
+                return n_finished
+            time.sleep(poll_interval)
+            continue
+
+        # Keep the lease while the job is running
+        stopped = threading.Event()
+        def send_heartbeats():
+            while not stopped.wait(heartbeat_interval):
+                queue.heartbeat(job["job_id"])
+        heartbeat_thread = threading.Thread(target=send_heartbeats)
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+        staging_dir = None
+        try:
+            logging.info("%s runs job %s" % (worker_id, job["job_id"]))
+            staging_dir = queue.staging_dir(job)
+            result = job_func(job, context, staging_dir)
+            queue.complete(job, result, staging_dir)
+            n_finished += 1
+        except Exception:
+            error = traceback.format_exc()
+            logging.error("Job %s failed:\n%s" % (job["job_id"], error))
+            queue.fail(job, error)
+            if staging_dir is not None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        finally:
+            stopped.set()
+            heartbeat_thread.join()
+
+
+def job_queue_test():
+    import tempfile
+    queue_dir = tempfile.mkdtemp()
+    queue = JobQueue(queue_dir, max_attempts=2, lease_timeout=60)
+    job_ids = [queue.publish(verb, {"lr": 0.1}) for verb in ["a", "b"]]
+    # Publishing again is a no-op
+    print(queue.publish("a", {"lr": 0.1}) == job_ids[0], queue.status())
+
+    job = queue.claim("worker1")
+    queue.complete(job, {"score": 1})
+    print(job["job_id"], "is done", queue.status())
+
+    # Fail the other job max_attempts times, then retry it
+    for attempt in range(0, queue.max_attempts):
+        job = queue.claim("worker1")
+        queue.fail(job, "error %d" % attempt)
+    print(job["job_id"], "failed", queue.status())
+    queue.retry_failed()
+    print("retry", queue.status())
+
+    # A worker which stops sending heartbeats loses its job
+    job = queue.claim("worker2")
+    old_time = time.time() - 2 * queue.lease_timeout
+    os.utime(queue.path("running", job["job_id"]), (old_time, old_time))
+    print("requeued", queue.requeue_stale(), queue.status())
+
+    def job_func(job, context, staging_dir):
+        write_json(os.path.join(staging_dir, "model.json"), job["config"])
+        return {"score": 2}
+    print("finished by worker", run_worker(queue, job_func), queue.status(),
+          queue.is_finished())
+    results = queue.results()
+    for job_id in job_ids:
+        print(job_id, results[job_id]["result"],
+              os.listdir(queue.result_dir(job_id)))
+    shutil.rmtree(queue_dir)
+
+    # Several worker processes share the queue. The pending files are older
+    # than the lease, but a claimed job is not released and run again
+    queue_dir = tempfile.mkdtemp()
+    runs_dir = tempfile.mkdtemp()
+    queue = JobQueue(queue_dir, lease_timeout=60)
+    job_ids = [queue.publish("verb%d" % i, {"lr": 0.1}) for i in range(0, 40)]
+    old_time = time.time() - 2 * queue.lease_timeout
+    for job_id in job_ids:
+        os.utime(queue.path("pending", job_id), (old_time, old_time))
+
+    def count_job_func(job, context, staging_dir):
+        # One file for each run of the job
+        (fd, _) = tempfile.mkstemp(prefix="%s." % job["job_id"], dir=runs_dir)
+        os.close(fd)
+        time.sleep(0.01)
+        return {"pid": os.getpid()}
+    mp_context = multiprocessing.get_context('fork')
+    workers = [mp_context.Process(target=run_worker, args=(queue, count_job_func))
+               for _ in range(0, 4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    runs = [name.rsplit(".", 1)[0] for name in os.listdir(runs_dir)]
+    pids = set(result["result"]["pid"] for result in queue.results().values())
+    print("%d workers" % len(pids), queue.status(),
+          "each job run once: %s" % (sorted(runs) == sorted(job_ids)))
+    shutil.rmtree(queue_dir)
+    shutil.rmtree(runs_dir)
+
+
+if __name__ == "__main__":
+    job_queue_test()
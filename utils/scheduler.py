@@ -0,0 +1,162 @@
+#! /usr/bin/env python3
+"""
+Authors: fengyukun
+Date:   2016-10-18
+Brief:  Run independent jobs (e.g., one model per verb) on a pool of processes
+"""
+
+# For python2
+from __future__ import print_function
+# Activate automatic float divison for python2.
+from __future__ import division
+import multiprocessing
+import zlib
+import numpy as np
+import logging
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="[%(levelname)s]%(filename)s:%(lineno)s[function:%(funcName)s] %(message)s"
+)
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+from blas_threads import blas_threads_set
+
+# The job function and the context of the current pool. They are set before
+# the workers are forked, so the workers inherit them without pickling.
+_job_func = None
+_context = None
+_blas_limiter = None
+
+
+def check_blas_threads(n_threads):
+    """
+    Check that the BLAS libraries of the worker processes can be limited to
+    n_threads threads. numpy is already loaded, so either threadpoolctl is
+    needed or the environment variables must have been set before numpy was
+    imported (see blas_threads.set_blas_threads).
+    n_threads: int
+    """
+
+    if threadpool_limits is None and not blas_threads_set(n_threads):
+        logging.error("Can not limit the BLAS libraries to %d threads: "
+                      "threadpoolctl is not installed and the environment "
+                      "variables were not set before importing numpy"
+                      % n_threads)
+        raise Exception
+
+
+def pin_blas_threads(n_threads):
+    """
+    Limit the number of threads used by the BLAS libraries loaded in this
+    process by threadpoolctl. Nothing is needed if threadpoolctl is not
+    installed, since check_blas_threads has checked the environment variables.
+    n_threads: int
+    """
+
+    global _blas_limiter
+    if threadpool_limits is not None:
+        # Keep the limiter alive for the life of the process
+        _blas_limiter = threadpool_limits(limits=n_threads)
+
+
+def _init_worker(blas_threads):
+    if blas_threads is not None:
+        pin_blas_threads(blas_threads)
+
+
+def job_seed(seed, job):
+    """
+    Return the seed of the random generator of numpy for job. It only depends
+    on seed and the name of job, so a job (e.g., a verb) gets the same seed
+    whatever other jobs are run, in what order and by how many workers.
+    seed: int
+    job: object, a verb or anything with a stable str
+    """
+
+    return (seed + zlib.crc32(str(job).encode("utf-8"))) % (2 ** 32)
+
+
+def _run_job(seeded_job):
+    (job_seed, job) = seeded_job
+    if job_seed is not None:
+        np.random.seed(job_seed)
+    return (job, _job_func(job, _context))
+
+
+def run_jobs(job_func, jobs, context=None, n_workers=1, job_size=None,
+             blas_threads=1, seed=None):
+    """
+    Run job_func(job, context) for each job and yield (job, result) as soon as
+    each job is done. With n_workers > 1 the jobs run in a pool of processes
+    forked at this call, so context (e.g., the word vectors and the data) is
+    shared with the workers copy-on-write and is never pickled. Only the jobs
+    and the results are pickled, so they should be small. The jobs are
+    started from the largest one for load balance, and results come back in
+    the order of completion.
+    job_func: function
+        A function defined at module level, called as job_func(job, context)
+    jobs: list
+        The jobs, e.g., verbs
+    context: object
+        Anything job_func needs besides the job
+    n_workers: int
+        Number of worker processes. 1 means the jobs run in this process in the
+        given order
+    job_size: function
+        job_size(job) gives the cost of job for ordering. None means the given
+        order is used
+    blas_threads: int
+        Number of BLAS threads of each worker, which avoids oversubscription
+        of cores when n_workers > 1. It needs threadpoolctl, or the
+        environment variables set before importing numpy. None means no limit
+    seed: int
+        If it is given, the random generator of numpy is seeded with
+        job_seed(seed, job) before each job, so the results do not depend on
+        n_workers or the order of running. None means no seeding
+    """
+
+    global _job_func
+    global _context
+
+    jobs = list(jobs)
+    job_seeds = [None] * len(jobs)
+    if seed is not None:
+        job_seeds = [job_seed(seed, job) for job in jobs]
+    seeded_jobs = list(zip(job_seeds, jobs))
+    if n_workers <= 1:
+        _job_func = job_func
+        _context = context
+        try:
+            for seeded_job in seeded_jobs:
+                yield _run_job(seeded_job)
+        finally:
+            _job_func = None
+            _context = None
+        return
+
+    try:
+        mp_context = multiprocessing.get_context('fork')
+    except ValueError:
+        logging.error("The scheduler needs the fork start method")
+        raise Exception
+    if blas_threads is not None:
+        check_blas_threads(blas_threads)
+
+    if job_size is not None:
+        seeded_jobs.sort(key=lambda seeded_job: job_size(seeded_job[1]),
+                         reverse=True)
+    _job_func = job_func
+    _context = context
+    pool = mp_context.Pool(n_workers, initializer=_init_worker,
+                           initargs=(blas_threads, ))
+    try:
+        for res in pool.imap_unordered(_run_job, seeded_jobs, chunksize=1):
+            yield res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _job_func = None
+        _context = None
@@ -9,8 +9,13 @@ Brief:  Some commonly used functions in other modules
 from __future__ import print_function
 # Activate automatic float divison for python2.
 from __future__ import division
+import io
 import os
+import json
+import shutil
 import string
+import gzip
+import hashlib
 import numpy as np
 from random import shuffle
 import logging
@@ -142,74 +147,406 @@ def shuffle_two_lists(lista, listb):
         listb_shuf.append(listb[i])
     return (lista_shuf, listb_shuf)
 
-def load_word_vectors(vector_path, add_oov=False, oov="O_O_V"):
+def word_vectors_chunks(vector_path, chunk_size):
+    """
+    Split the file of word vectors into byte ranges of about chunk_size bytes
+    which end at line ends
+    Return
+    -----
+    list of (start, end)
+    """
+
+    file_size = os.path.getsize(vector_path)
+    chunks = []
+    fh = open(vector_path, "rb")
+    start = 0
+    while start < file_size:
+        fh.seek(min(start + chunk_size, file_size))
+        fh.readline()
+        end = min(fh.tell(), file_size)
+        chunks.append((start, end))
+        start = end
+    fh.close()
+    return chunks
+
+
+def open_word_vectors(vector_path):
+    """
+    Open the file of word vectors for reading bytes. A file ending with .gz is
+    decompressed while it is read
+    """
+
+    if vector_path.endswith(".gz"):
+        return gzip.open(vector_path, "rb")
+    return open(vector_path, "rb")
+
+
+def parse_word_vectors_data(data, vector_dimension, target_words, where):
+    """
+    Parse the lines of word vectors in text
+    data: bytes, the lines
+    vector_dimension: int
+    target_words: set of str. Only the lines of these words are parsed. None
+        means all lines
+    where: str, the position of data in error messages
+    Return
+    -----
+    words: list of str
+    vectors: numpy.ndarray, the vectors of words with the shape
+        (len(words), vector_dimension)
+    """
+
+    words = []
+    values = []
+    for word_line in data.split(b"\n"):
+        word_vector = word_line.split(None, 1)
+        if len(word_vector) == 0:
+            continue
+        word = word_vector[0].decode("utf-8")
+        if target_words is not None and word not in target_words:
+            continue
+        words.append(word)
+        values.append(word_vector[1] if len(word_vector) == 2 else b"")
+    # Parse all floats of the chunk in one call
+    vectors = np.fromstring(b" ".join(values).decode("ascii"), dtype=FLOAT, sep=" ")
+    if vectors.shape[0] != len(words) * vector_dimension:
+        for word, line_values in zip(words, values):
+            if len(line_values.split()) != vector_dimension:
+                logging.error("Vector format error. word: %s, in %s" % (word, where))
+                raise Exception
+        logging.error("Vector format error in %s" % where)
+        raise Exception
+    return (words, vectors.reshape((len(words), vector_dimension)))
+
+
+def parse_word_vectors_chunk(chunk):
+    """
+    Parse the lines of word vectors in a byte range of the file
+    chunk: tuple, (vector_path, start, end, vector_dimension, words)
+        Only the lines of the words in the set words are parsed. None means
+        all lines
+    Return
+    -----
+    See parse_word_vectors_data
+    """
+
+    (vector_path, start, end, vector_dimension, target_words) = chunk
+    fh = open(vector_path, "rb")
+    fh.seek(start)
+    data = fh.read(end - start)
+    fh.close()
+    return parse_word_vectors_data(data, vector_dimension, target_words,
+                                   "%s bytes [%s, %s)" % (vector_path, start, end))
+
+
+def parse_word_vectors_block(block):
+    """
+    parse_word_vectors_data on block, (data, vector_dimension, words, where)
+    """
+
+    return parse_word_vectors_data(*block)
+
+
+def word_vectors_blocks(vector_path, vector_dimension, words, block_size):
+    """
+    Read the (e.g., compressed) file of word vectors in blocks of about
+    block_size bytes which end at line ends
+    Return
+    -----
+    Iterator of (data, vector_dimension, words, where), see
+    parse_word_vectors_block
+    """
+
+    fh = open_word_vectors(vector_path)
+    rest = b""
+    n_read = 0
+    while True:
+        data = fh.read(block_size)
+        if not data:
+            break
+        data = rest + data
+        line_end = data.rfind(b"\n") + 1
+        rest = data[line_end:]
+        yield (data[0:line_end], vector_dimension, words,
+               "%s block at %s" % (vector_path, n_read))
+        n_read += line_end
+    fh.close()
+    if rest.strip() != b"":
+        yield (rest, vector_dimension, words, "%s block at %s" % (vector_path, n_read))
+
+
+def read_binary_word_vectors(vector_path, words=None, chunk_words=2 ** 16,
+                             block_size=2 ** 22):
+    """
+    Read word vectors in the binary format of word2vec: a header line
+    "word_count vector_dimension", then for each word the word, a space and
+    vector_dimension float32 values. The file may be compressed by gzip
+    (.gz). The values are copied by np.frombuffer from the read blocks into
+    preallocated arrays of chunk_words rows.
+    words: set of str, only the vectors of words are read. None means all
+    Return
+    -----
+    Iterator of (words, vectors) of chunks, see parse_word_vectors_data
+    """
+
+    fh = open_word_vectors(vector_path)
+    try:
+        (word_count, vector_dimension) = [int(value) for value in fh.readline().split()]
+    except ValueError:
+        logging.error("Header format error of %s" % vector_path)
+        raise Exception
+    vector_bytes = 4 * vector_dimension
+    chunk_words = max(1, min(chunk_words, word_count))
+
+    buf = b""
+    pos = 0
+    chunk_words_list = []
+    chunk_vectors = np.empty(shape=(chunk_words, vector_dimension), dtype=FLOAT)
+    for word_index in range(0, word_count):
+        # Make sure that buf has the word and its vector
+        space = buf.find(b" ", pos)
+        while space < 0 or len(buf) - space - 1 < vector_bytes:
+            data = fh.read(block_size)
+            if not data:
+                logging.error("%s ends at word %s of %s" % (vector_path, word_index, word_count))
+                raise Exception
+            buf = buf[pos:] + data
+            pos = 0
+            space = buf.find(b" ")
+        # Vectors may be followed by a line break
+        word = buf[pos:space].strip().decode("utf-8", "replace")
+        start = space + 1
+        pos = start + vector_bytes
+        if words is not None and word not in words:
+            continue
+        chunk_vectors[len(chunk_words_list)] = np.frombuffer(
+            buf, dtype="<f4", count=vector_dimension, offset=start
+        )
+        chunk_words_list.append(word)
+        if len(chunk_words_list) == chunk_words:
+            yield (chunk_words_list, chunk_vectors)
+            chunk_words_list = []
+            chunk_vectors = np.empty(shape=(chunk_words, vector_dimension), dtype=FLOAT)
+    fh.close()
+    yield (chunk_words_list, chunk_vectors[0:len(chunk_words_list)])
+
+
+def parse_word_vectors(vector_path, n_workers=1, chunk_size=2 ** 25, words=None,
+                       binary=False):
+    """
+    Parse the file of word vectors in chunks, in parallel by n_workers
+    processes if n_workers > 1. Only the vectors of words (a set) are parsed
+    if it is given.
+    vector_path: str, text file, text file compressed by gzip (.gz) or, if
+        binary is True, binary word2vec file (compressed or not)
+    Return
+    -----
+    Iterator of (words, vectors) of the chunks in the order of the file, see
+    parse_word_vectors_data
+    """
+
+    if binary:
+        for parsed in read_binary_word_vectors(vector_path, words):
+            yield parsed
+        return
+
+    fh = open_word_vectors(vector_path)
+    word_line = b""
+    for word_line in fh:
+        if word_line.strip() != b"":
+            break
+    fh.close()
+    vector_dimension = len(word_line.split()) - 1
+    if vector_dimension < 1:
+        logging.error("Vector format error.")
+        raise Exception
+
+    if vector_path.endswith(".gz"):
+        # Compressed file can only be read in order
+        parse_func = parse_word_vectors_block
+        chunks = word_vectors_blocks(vector_path, vector_dimension, words, chunk_size)
+    else:
+        parse_func = parse_word_vectors_chunk
+        chunks = [(vector_path, start, end, vector_dimension, words)
+                  for (start, end) in word_vectors_chunks(vector_path, chunk_size)]
+    if n_workers <= 1:
+        for chunk in chunks:
+            yield parse_func(chunk)
+        return
+    import multiprocessing
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        for parsed in pool.imap(parse_func, chunks):
+            yield parsed
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def word_vectors_cache(vector_path, cache_dir):
+    """
+    Return the directory of the binary cache of vector_path in cache_dir
+    """
+
+    abs_path = os.path.abspath(vector_path)
+    path_hash = hashlib.sha1(abs_path.encode("utf-8")).hexdigest()[0:12]
+    return os.path.join(cache_dir, "%s.%s" % (os.path.basename(abs_path), path_hash))
+
+
+def source_stat(vector_path):
+    """
+    The size and mtime of vector_path, which validate its binary cache
+    """
+
+    stat = os.stat(vector_path)
+    return {"path": os.path.abspath(vector_path), "size": stat.st_size,
+            "mtime": stat.st_mtime}
+
+
+def convert_word_vectors(vector_path, target_dir, n_workers=1, binary=False):
+    """
+    Convert the text file of word vectors to the binary cache in target_dir:
+        vectors.bin   The raw matrix of vectors (FLOAT) with a zero row at
+                      the end for oov
+        vocab.txt     One word per line in the order of the rows
+        meta.json     The shape of the matrix and the size and mtime of the
+                      text file
+    The cache is written to a temporary directory which is renamed to
+    target_dir at last.
+    vector_path: str, the file of word vectors, see parse_word_vectors
+    target_dir: str
+    n_workers: int, the number of processes parsing the text file
+    binary: bool, whether vector_path is in the binary format of word2vec
+    """
+
+    logging.info("Start converting word vectors %s to %s" % (vector_path, target_dir))
+    stat = source_stat(vector_path)
+    tmp_dir = "%s.%s.tmp" % (target_dir, os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    word_count = 0
+    vector_dimension = 0
+    vectors_fh = open(os.path.join(tmp_dir, "vectors.bin"), "wb")
+    vocab_fh = io.open(os.path.join(tmp_dir, "vocab.txt"), "w", encoding="utf-8")
+    for (words, vectors) in parse_word_vectors(vector_path, n_workers, binary=binary):
+        vector_dimension = vectors.shape[1]
+        vectors_fh.write(np.ascontiguousarray(vectors).tobytes())
+        for word in words:
+            vocab_fh.write(u"%s\n" % word)
+        word_count += len(words)
+    # The row of oov
+    vectors_fh.write(np.zeros(shape=vector_dimension, dtype=FLOAT).tobytes())
+    vectors_fh.close()
+    vocab_fh.close()
+
+    stat["shape"] = [word_count, vector_dimension]
+    stat["dtype"] = FLOAT
+    meta_fh = open(os.path.join(tmp_dir, "meta.json"), "w")
+    json.dump(stat, meta_fh)
+    meta_fh.close()
+    if os.path.exists(target_dir):
+        shutil.rmtree(target_dir)
+    os.rename(tmp_dir, target_dir)
+    logging.info("Finish converting. Word vector (shape): %s" % ((word_count, vector_dimension), ))
+
+
+def load_word_vectors_cache(vector_path, cache_dir, n_workers=1, binary=False):
+    """
+    Load the binary cache of vector_path in cache_dir. The cache is made by
+    convert_word_vectors if it does not exist or it does not match the size
+    and mtime of vector_path.
+    Return
+    -----
+    words: list of str
+    word2vec: numpy.memmap, copy-on-write. The vectors of words followed by
+        the zero row of oov
+    """
+
+    target_dir = word_vectors_cache(vector_path, cache_dir)
+    meta = None
+    meta_path = os.path.join(target_dir, "meta.json")
+    if os.path.exists(meta_path):
+        meta_fh = open(meta_path, "r")
+        meta = json.load(meta_fh)
+        meta_fh.close()
+        stat = source_stat(vector_path)
+        if meta["size"] != stat["size"] or meta["mtime"] != stat["mtime"]:
+            logging.info("%s has been changed since its cache was made" % vector_path)
+            meta = None
+    if meta is None:
+        convert_word_vectors(vector_path, target_dir, n_workers, binary)
+        meta_fh = open(meta_path, "r")
+        meta = json.load(meta_fh)
+        meta_fh.close()
+
+    (word_count, vector_dimension) = meta["shape"]
+    vocab_fh = io.open(os.path.join(target_dir, "vocab.txt"), "r", encoding="utf-8")
+    words = vocab_fh.read().split(u"\n")[0:word_count]
+    vocab_fh.close()
+    # Writes (e.g., updating word vectors) stay in this process
+    word2vec = np.memmap(os.path.join(target_dir, "vectors.bin"), dtype=meta["dtype"],
+                         mode="c", shape=(word_count + 1, vector_dimension))
+    return (words, word2vec)
+
+
+def load_word_vectors(vector_path, add_oov=False, oov="O_O_V", cache_dir=None,
+                      n_workers=1, words=None, binary=False):
     """Load GloVe vectors. The format of vector is one word and its float values per line seperated
-    by only space characters (e.g., '\t', ' ').
+    by only space characters (e.g., '\t', ' '). The file may be compressed by gzip (.gz).
 
     :vector_path: str, the GloVe word vectors path
     :add_oov: boolean, whether out-of-vocabulary word is added to word2vec, which is often helpful
     when meating some unknown words.
     :oov: str, if add_oov is true the defined oov will be added to word2vec; zero vectors will be
     used as the vectors of oov.
-    of oov 
+    :cache_dir: str, the directory of the binary caches of word vectors. If it is given, the text
+    file is converted once to a binary cache (see convert_word_vectors), and the later loads map
+    the cache into memory (copy-on-write) instead of parsing the text file. None means no cache.
+    :n_workers: int, the number of processes parsing the text file.
+    :words: set of str, the vocabulary needed, e.g., by corpus_words of data_loader. If it is
+    given, only the vectors of these words are loaded into a compact word2vec (in the order of the
+    file) with oov as the last row. None means all words.
+    :binary: boolean, whether vector_path is in the binary format of word2vec.
     return [vocab(dict), inverse_vocab(dict), word2vec(numpy.ndarray)]
 
     """
 
-    #  First read to count the number of words as well as the dimension of each vector.
     logging.info("Start loading word vectors: %s", vector_path)
-    first_line = True
-    word_count = 0
-    vector_dimension = 0
-    fh = open(vector_path, "r")
-    for word_line in fh:
-        word_line = word_line.strip()
-        if word_line == '':
-            continue
-        word_count += 1
-        if first_line:
-            try:
-                word_vector = word_line.split()
-                vector_dimension = len(word_vector) - 1
-            except Exception as e:
-                logging.error("Vector format error.")
-                raise Exception
-            first_line = False
-    fh.close()
+    target_words = words
+    if cache_dir is not None:
+        (words, word2vec) = load_word_vectors_cache(vector_path, cache_dir, n_workers,
+                                                    binary)
+        if target_words is not None:
+            rows = [i for i, word in enumerate(words) if word in target_words]
+            words = [words[i] for i in rows]
+            # The zero row of oov is the last one
+            rows.append(word2vec.shape[0] - 1)
+            word2vec = np.array(word2vec[rows])
+        if not add_oov:
+            word2vec = word2vec[0:len(words)]
+    else:
+        words = []
+        vectors = []
+        for (chunk_words, chunk_vectors) in parse_word_vectors(vector_path, n_workers,
+                                                               words=target_words,
+                                                               binary=binary):
+            words += chunk_words
+            vectors.append(chunk_vectors)
+        if add_oov:
+            vectors.append(np.zeros(shape=(1, vectors[0].shape[1]), dtype=FLOAT))
+        word2vec = np.concatenate(vectors)
 
-    # Second read to allocate the whole vectors based on the first read.
-    if add_oov:
-        word_count += 1
-    word2vec = np.zeros(shape=(word_count, vector_dimension), dtype=float)
     vocab = {}
     invocab = {}
-    word_index = 0
-    line_index = 0
-    fh = open(vector_path, "r")
-    for word_line in fh:
-        line_index += 1
-        word_line = word_line.strip()
-        if word_line == '':
-            continue
-        try:
-            word_vector = word_line.split()
-            word = word_vector[0]
-            vectors = [float(value) for value in word_vector[1:]]
-            if len(vectors) != vector_dimension:
-                raise Exception
-        except Exception as e:
-            logging.error("Vector format error. line: %s" % line_index)
-            raise Exception
-
-        for column_index in range(0, vector_dimension):
-            word2vec[word_index][column_index] = vectors[column_index]
+    for word_index, word in enumerate(words):
         vocab[word] = word_index
         invocab[word_index] = word
-        word_index += 1
-    fh.close()
     if add_oov:
-        vocab[oov] = word_index
-        invocab[word_index] = oov
+        vocab[oov] = len(words)
+        invocab[len(words)] = oov
     logging.info("Finish loading. Add oov: %s. Word vector (shape): %s"
                  % (add_oov, str(word2vec.shape)))
 